@@ -41,17 +41,28 @@ Example::
 
 The `res` variable has now a coordinate `time` and res.TbV() returns a timeseries.
 
+Large lists of snowpacks can be distributed over several processes with the `parallel` argument. The results are the same as with the
+serial computation and are returned in the same order.
+
+Example::
+
+    res = m.run(sensor, snowpacks, snowpack_dimension=('time', times), parallel=True)  # use all the cores
+
+    res = m.run(sensor, snowpacks, snowpack_dimension=('time', times), parallel=4, chunksize=50)  # use 4 processes, send 50 snowpacks per task
+
 """
 
 import collections
 import inspect
 import copy
+import math
+import multiprocessing
 import six
 
 import numpy as np
 
 from .error import SMRTError
-from .result import concat_results
+from .result import concat_results, join_results
 from .plugin import import_class
 from .sensitivity_study import SensitivityStudy
 from .sensor import Sensor
@@ -122,13 +133,23 @@ class Model(object):
         self.emmodel_kwargs = emmodel_kwargs if emmodel_kwargs is not None else dict()
         self.rtsolver_kwargs = rtsolver_kwargs if rtsolver_kwargs is not None else dict()
 
-    def run(self, sensor, snowpack, atmosphere=None, snowpack_dimension=None, progressbar=False):
+    def run(self, sensor, snowpack, atmosphere=None, snowpack_dimension=None, progressbar=False,
+            parallel=False, executor=None, chunksize=None, batch=False):
         """ Run the model for the given sensor configuration and return the results
 
             :param sensor: sensor to use for the calculation
             :param snowpack: snowpack to use for the calculation. Can be a singel snowpack, a list or a SensitivityStudy object.
             :param snowpack_dimension: name and values (as a tuple) of the dimension to create for the results when a list of snowpack is provided. E.g. time, point, longitude, latitude. By default the dimension is called 'snowpack' and the values are from 1 to the number of snowpacks.
             :param progressbar: if True, display a progress bar during multi-snowpacks computation
+            :param parallel: if True or an integer, distribute the snowpacks of a list over a pool of processes. The integer gives the number of processes,
+                True uses all the cores. Only used when a list of snowpacks is provided.
+            :param executor: object with a `map` method (e.g. :py:class:`multiprocessing.Pool` or :py:class:`concurrent.futures.ProcessPoolExecutor`)
+                used to distribute the snowpacks instead of the pool created with `parallel`. The executor is not closed by this method.
+            :param chunksize: number of snowpacks sent to each task of the pool. By default, the list is split in about four chunks per process to reduce the
+                cost of pickling the snowpacks, the model and the sensor.
+            :param batch: if True and the rtsolver is able to solve the snowpacks together (e.g. DORT, see
+                :py:meth:`~smrt.rtsolver.dort.DORT.solve_batch`), the list of snowpacks is solved by chunks instead of one by one.
+                The results may differ slightly from those of the snowpacks solved one by one. Ignored otherwise.
             :returns: result of the calculation(s) as a :py:class:`Results` instance
         """
 
@@ -148,7 +169,8 @@ class Model(object):
                 for x in values:  # iterate over the values
                     sensor_subset = copy.copy(sensor)  # shallow copy... hope sensor attributes are immutable!!
                     setattr(sensor_subset, dim, x)  # change the sensor
-                    res = self.run(sensor_subset, snowpack, atmosphere=atmosphere, snowpack_dimension=snowpack_dimension)  # recursive call
+                    res = self.run(sensor_subset, snowpack, atmosphere=atmosphere, snowpack_dimension=snowpack_dimension,
+                                   parallel=parallel, executor=executor, chunksize=chunksize, batch=batch)  # recursive call
                     result_list.append(res)
 
                 return concat_results(result_list, (dim, values))
@@ -169,12 +191,29 @@ class Model(object):
             if progressbar:
                 pb = Progress(len(snowpack))
 
-            result_list = list()
-            for i, sp in enumerate(snowpack):  # parallel computation would be better !
-                res = self.run(sensor, sp, atmosphere=atmosphere)
-                result_list.append(res)
-                if progressbar:
-                    pb.animate(i + 1)
+            if parallel or executor is not None:
+                result_list = self.run_parallel(sensor, snowpack, atmosphere=atmosphere, parallel=parallel, executor=executor,
+                                                chunksize=chunksize, progressbar=pb if progressbar else None)
+            elif batch and hasattr(self.rtsolver, "_broadcast_capability") and "snowpack" in self.rtsolver._broadcast_capability:
+                # the rtsolver solves the snowpacks together. The emmodels are created by chunks to bound the memory usage
+                batch_size = getattr(self.rtsolver, "_batch_size", None) or len(snowpack)
+                rtsolver = self.make_rtsolver()
+                result_list = list()
+                for i in range(0, len(snowpack), batch_size):
+                    chunk = snowpack[i:i + batch_size]
+                    emmodel_instances = [self.make_emmodel_instances_all_frequencies(sensor, sp) for sp in chunk]
+                    result_list.append(rtsolver.solve_batch(chunk, emmodel_instances, sensor, atmosphere,
+                                                            snowpack_dimension=(dimension_name, dimension_values[i:i + batch_size])))
+                    if progressbar:
+                        pb.animate(i + len(chunk))
+                return join_results(result_list, dimension_name) if len(result_list) > 1 else result_list[0]
+            else:
+                result_list = list()
+                for i, sp in enumerate(snowpack):
+                    res = self.run(sensor, sp, atmosphere=atmosphere)
+                    result_list.append(res)
+                    if progressbar:
+                        pb.animate(i + 1)
 
             return concat_results(result_list, (dimension_name, dimension_values))
 
@@ -182,6 +221,48 @@ class Model(object):
         # prepare to run
 
         # create a list of emmodel instances (ready to run)
+        emmodel_instances = self.make_emmodel_instances_all_frequencies(sensor, snowpack)
+
+        # run the rtsolver
+        result = self.make_rtsolver().solve(snowpack, emmodel_instances, sensor, atmosphere)
+
+        return result
+
+    def make_rtsolver(self):
+        """return the rtsolver instance, created with the rtsolver_kwargs if the model was given a class. This method is called
+        by :py:meth:`run` and should not be needed for normal usage.
+        """
+
+        # need to create the rtsolver ?
+        if inspect.isclass(self.rtsolver):
+            return self.rtsolver(**self.rtsolver_kwargs)  # create with arguments
+        else:
+            # no use the instance as it is (with possible memory of the last solve...)
+            return self.rtsolver
+
+    def make_emmodel_instances_all_frequencies(self, sensor, snowpack):
+        """create the list of emmodel instances (one per layer) for a snowpack, or a list of such lists (one per frequency) if the
+        sensor has several frequencies. This method is called by :py:meth:`run` and should not be needed for normal usage.
+        """
+
+        if np.ndim(sensor.frequency) > 0:
+            # the rtsolver deals with the frequency dimension. The emmodels depend on the frequency, so a list of emmodel instances
+            # is created for each frequency
+            emmodel_instances = list()
+            for frequency in sensor.frequency:
+                sensor_subset = copy.copy(sensor)
+                sensor_subset.frequency = frequency
+                emmodel_instances.append(self.make_emmodel_instances(sensor_subset, snowpack))
+        else:
+            emmodel_instances = self.make_emmodel_instances(sensor, snowpack)
+
+        return emmodel_instances
+
+    def make_emmodel_instances(self, sensor, snowpack):
+        """create the list of emmodel instances (one per layer) for a given sensor with a single frequency and a snowpack.
+        This method is called by :py:meth:`run` and should not be needed for normal usage.
+        """
+
         emmodel_instances = list()
 
         if isinstance(self.emmodel, collections.Sequence) and not isinstance(self.emmodel, six.string_types):
@@ -198,14 +279,55 @@ class Model(object):
             for layer in snowpack.layers:
                 emmodel_instances.append(make_emmodel(self.emmodel, sensor, layer, **self.emmodel_kwargs))
 
-        # need to create the rtsolver ?
-        if inspect.isclass(self.rtsolver):
-            rtsolver = self.rtsolver(**self.rtsolver_kwargs)  # create with arguments
+        return emmodel_instances
+
+    def run_parallel(self, sensor, snowpacks, atmosphere=None, parallel=True, executor=None, chunksize=None, progressbar=None):
+        """Run the model for a list of snowpacks distributed over a pool of processes and return the list of results in the same order
+        as the snowpacks. This method is called by :py:meth:`run` and should not be needed for normal usage.
+
+            :param sensor: sensor to use for the calculation
+            :param snowpacks: list of snowpacks
+            :param parallel: number of processes to create, or True to use all the cores. Ignored if `executor` is given.
+            :param executor: object with a `map` method used instead of creating a pool of processes.
+            :param chunksize: number of snowpacks per task.
+            :param progressbar: :py:class:`Progress` instance to update when a chunk is finished.
+            :returns: list of :py:class:`Results`
+        """
+
+        snowpacks = list(snowpacks)
+
+        if executor is None:
+            nworkers = multiprocessing.cpu_count() if parallel is True else int(parallel)
+            pool = multiprocessing.Pool(nworkers)
         else:
-            # no use the instance as it is (with possible memory of the last solve...)
-            rtsolver = self.rtsolver
+            pool = executor
+            nworkers = multiprocessing.cpu_count()  # the size of the executor is unknown, assume it uses all the cores
 
-        # run the rtsolver
-        result = rtsolver.solve(snowpack, emmodel_instances, sensor, atmosphere)
+        if chunksize is None:
+            # same heuristic as multiprocessing.Pool.map: about four chunks per worker
+            chunksize = max(1, int(math.ceil(len(snowpacks) / (4. * nworkers))))
 
-        return result
+        # the model, the sensor and the atmosphere are pickled once per chunk, not once per snowpack
+        tasks = [(self, sensor, snowpacks[i:i+chunksize], atmosphere) for i in range(0, len(snowpacks), chunksize)]
+
+        # imap returns the chunks as soon as they are ready (in order), which is nicer for the progress bar
+        mapfunc = getattr(pool, "imap", pool.map)
+
+        result_list = list()
+        try:
+            for results in mapfunc(_run_chunk, tasks):
+                result_list += results
+                if progressbar is not None:
+                    progressbar.animate(len(result_list))
+        finally:
+            if executor is None:
+                pool.close()
+                pool.join()
+
+        return result_list
+
+
+def _run_chunk(task):
+    # run a chunk of snowpacks in a worker. Must be a module-level function to be pickled.
+    model, sensor, snowpacks, atmosphere = task
+    return [model.run(sensor, sp, atmosphere=atmosphere) for sp in snowpacks]
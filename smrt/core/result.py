@@ -49,9 +49,11 @@ def open_result(filename):
 class Result(object):
     """ Contains the results of a/many computations and provides convenience functions to access these results
 
+    Some RT solvers return additional results (e.g. weighting functions). They are hold in the `other_data` attribute, a dict of xarray.
+
     """
 
-    def __init__(self, intensity, coords=None):
+    def __init__(self, intensity, coords=None, other_data=None):
         """Construct results array with the given intensity array (numpy array or xarray) and dimensions if numpy array is given
 
 """
@@ -60,6 +62,8 @@ class Result(object):
         else:
             self.data = xr.DataArray(intensity, coords)
 
+        self.other_data = other_data if other_data is not None else dict()
+
     @property
     def coords(self):
         return self.data.coords
@@ -171,7 +175,30 @@ def concat_results(result_list, coord):
 
     dim_name, dim_value = coord
 
-    return Result(xr.concat([result.data for result in result_list], pd.Index(dim_value, name=dim_name)))
+    # concatenate the other data available in all the results
+    other_data_list = [getattr(result, 'other_data', dict()) for result in result_list]
+    other_data = {name: xr.concat([od[name] for od in other_data_list], pd.Index(dim_value, name=dim_name))
+                  for name in other_data_list[0] if all(name in od for od in other_data_list)}
+
+    return Result(xr.concat([result.data for result in result_list], pd.Index(dim_value, name=dim_name)), other_data=other_data)
+
+
+def join_results(result_list, dim_name):
+    """Join several results (of type :py:class:`Result`) along an existing dimension into a single result (of type :py:class:`Result`),
+    e.g. the results of consecutive chunks of a list of snowpacks.
+
+    :param result_list: list of results with the dimension dim_name.
+    :param dim_name: name of the dimension along which the results are joined.
+
+    :returns: :py:class:`Result` instance
+
+    """
+
+    other_data_list = [getattr(result, 'other_data', dict()) for result in result_list]
+    other_data = {name: xr.concat([od[name] for od in other_data_list], dim_name)
+                  for name in other_data_list[0] if all(name in od for od in other_data_list)}
+
+    return Result(xr.concat([result.data for result in result_list], dim_name), other_data=other_data)
 
 
 def _strongsqueeze(x):
@@ -19,11 +19,14 @@ Example::
 """
 
 import collections
+import copy
+import numbers
 import numpy as np
 import pandas as pd
 import six
 
 from .error import SMRTError
+from .globalconstants import DENSITY_OF_ICE
 from ..interface.flat import Flat
 
 
@@ -78,3 +81,123 @@ class Snowpack(object):
 
         if len(self.interfaces) != len(self.layers):
             raise SMRTError("The number of layers must equal the number of interfaces")
+
+    def merge_layers(self, frac_volume_tolerance=0.01, temperature_tolerance=0.5, microstructure_tolerance=0.05):
+        """return a new snowpack where the adjacent layers with similar properties are merged. This reduces the number of layers
+        of detailed profiles (e.g. from snow evolution models) and the computation time of the radiative transfer solvers.
+
+        Adjacent layers are merged when they have the same microstructure model, permittivity models and other properties
+        (e.g. liquid_water, salinity) and when the range of their fractional volumes, temperatures and microstructure
+        parameters is within the tolerances. The interface between the merged layers must be flat. The total thickness
+        and the mass are conserved: the fractional volume of the merged layer is the thickness-weighted mean, the temperature
+        and the microstructure parameters are the mass-weighted means. Use :py:func:`~smrt.utils.layer_merging.merging_bias`
+        to evaluate the effect on the simulations.
+
+        :param frac_volume_tolerance: maximum difference of fractional volume between the merged layers.
+        :param temperature_tolerance: maximum difference of temperature (K) between the merged layers.
+        :param microstructure_tolerance: maximum relative difference of the (numerical) microstructure parameters (e.g.
+            corr_length, radius, stickiness) between the merged layers.
+
+        :returns: :py:class:`Snowpack` instance. The layers are copies, the snowpack is not modified.
+"""
+
+        groups = list()  # list of the layers merged together
+
+        for layer, interface in zip(self.layers, self.interfaces):
+            flat = interface is Flat or type(interface) is Flat
+            if groups and flat:
+                group = groups[-1]
+                if _similar_layers(group + [layer], frac_volume_tolerance, temperature_tolerance, microstructure_tolerance):
+                    group.append(layer)
+                    continue
+            groups.append([layer])
+
+        layers = list()
+        interfaces = list()
+        i = 0
+        for group in groups:
+            layers.append(_merge_layers(group))
+            interfaces.append(self.interfaces[i])  # interface at the top of the group
+            i += len(group)
+
+        return Snowpack(layers=layers, interfaces=interfaces, substrate=self.substrate)
+
+
+def _microstructure_parameters(layer):
+    # return the microstructure parameters of the layer, except the fractional volume
+    if layer.microstructure_model is None:
+        return {}
+    return {name: getattr(layer.microstructure, name) for name in layer.microstructure_model.valid_arguments() if name != "frac_volume"}
+
+
+def _other_properties(layer):
+    # return the properties of the layer other than the thickness, temperature, fractional volume, density and microstructure
+    excluded = {"thickness", "temperature", "frac_volume", "density", "microstructure", "_ssa"}
+    return {name: value for name, value in layer.__dict__.items() if name not in excluded}
+
+
+def _is_number(x):
+    return isinstance(x, numbers.Real) and not isinstance(x, bool)
+
+
+def _similar_layers(layers, frac_volume_tolerance, temperature_tolerance, microstructure_tolerance):
+    # return True if the layers can be merged
+
+    first = layers[0]
+
+    for layer in layers[1:]:
+        if layer.microstructure_model is not first.microstructure_model:
+            return False
+        properties, first_properties = _other_properties(layer), _other_properties(first)
+        if properties.keys() != first_properties.keys() or \
+                any(np.any(properties[name] != first_properties[name]) for name in properties):
+            return False
+
+    def within(values, tolerance):
+        return max(values) - min(values) <= tolerance
+
+    if not within([layer.frac_volume for layer in layers], frac_volume_tolerance):
+        return False
+
+    if not within([layer.temperature for layer in layers], temperature_tolerance):
+        return False
+
+    parameters = [_microstructure_parameters(layer) for layer in layers]
+    for name, value in parameters[0].items():
+        values = [p[name] for p in parameters]
+        if _is_number(value):
+            if not within(values, microstructure_tolerance * max(abs(v) for v in values)):
+                return False
+        elif any(np.any(v != value) for v in values):
+            return False
+
+    return True
+
+
+def _merge_layers(layers):
+    # return a single layer with the total thickness and mass of the layers
+
+    if len(layers) == 1:
+        return layers[0]
+
+    thickness = np.array([layer.thickness for layer in layers], dtype=np.float64)
+    mass = thickness * np.array([layer.frac_volume for layer in layers])
+
+    merged = copy.deepcopy(layers[0])
+    merged.thickness = np.sum(thickness)
+    merged.frac_volume = np.sum(mass) / merged.thickness
+    merged.temperature = np.sum(mass * [layer.temperature for layer in layers]) / np.sum(mass)
+
+    params = _microstructure_parameters(layers[0])
+    for name, value in params.items():
+        if _is_number(value):
+            params[name] = np.sum(mass * [getattr(layer.microstructure, name) for layer in layers]) / np.sum(mass)
+    if merged.microstructure_model is not None:
+        params['frac_volume'] = merged.frac_volume
+        merged.microstructure = merged.microstructure_model(params)
+    merged._ssa = None
+
+    if hasattr(merged, "density"):
+        merged.density = merged.frac_volume * DENSITY_OF_ICE
+
+    return merged
@@ -0,0 +1,58 @@
+
+import numpy as np
+
+from smrt import make_snowpack
+from smrt.core.sensor import passive
+from smrt.core.model import Model
+from smrt.interface.transparent import Transparent
+from smrt.utils.layer_merging import merging_bias
+
+
+def detailed_snowpack(**kwargs):
+    # three groups of almost identical layers
+    thickness = [0.02, 0.03, 0.05, 0.1, 0.1, 0.2, 0.5]
+    density = [150, 152, 151, 300, 302, 400, 401]
+    temperature = [250, 250.1, 250.2, 260, 260.2, 265, 265.3]
+    corr_length = [1e-4, 1.01e-4, 1.02e-4, 2e-4, 2.02e-4, 3e-4, 3e-4]
+    return make_snowpack(thickness, "exponential", density=density, temperature=temperature, corr_length=corr_length, **kwargs)
+
+
+def test_merge_layers():
+
+    sp = detailed_snowpack()
+    merged = sp.merge_layers()
+
+    assert merged.nlayer == 3
+    np.testing.assert_allclose(sum(merged.layer_thicknesses), sum(sp.layer_thicknesses))
+
+    mass = sum(layer.thickness * layer.density for layer in sp.layers)
+    np.testing.assert_allclose(sum(layer.thickness * layer.density for layer in merged.layers), mass)
+    np.testing.assert_allclose(merged.layers[0].frac_volume, merged.layers[0].microstructure.frac_volume)
+
+    # the original snowpack is unchanged
+    assert sp.nlayer == 7
+    assert sp.layers[0].thickness == 0.02
+
+
+def test_merge_layers_tolerance():
+
+    sp = detailed_snowpack()
+
+    assert sp.merge_layers(frac_volume_tolerance=0).nlayer == 7
+    assert sp.merge_layers(microstructure_tolerance=0).nlayer == 6  # the last two layers have the same corr_length
+    assert sp.merge_layers(temperature_tolerance=0.25).nlayer == 4
+
+
+def test_merge_layers_interface():
+
+    # the layers separated by a non-flat interface are not merged
+    sp = detailed_snowpack(interface=[None, None, None, None, Transparent, None, None])
+    assert sp.merge_layers().nlayer == 4
+
+
+def test_merging_bias():
+
+    merged, bias = merging_bias(Model("iba", "dort"), passive(37e9, 55), detailed_snowpack())
+
+    assert bias.attrs['nlayer'] == 7 and bias.attrs['nlayer_merged'] == 3
+    assert np.all(np.abs(bias) < 1)
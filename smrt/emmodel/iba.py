@@ -221,7 +221,7 @@ class IBA(object):
         if npol is None:
             npol = self.npol  # npol is set from sensor mode except in call to energy conservation test
 
-        if (not hasattr(self, "cached_mu")) or (not np.array_equal(self.cached_mu, mu)) or (len(self.cached_phase) < m):
+        if (not hasattr(self, "cached_mu")) or (not np.array_equal(self.cached_mu, mu)) or (len(self.cached_phase) <= m):
             self.precompute_ft_even_phase(mu, max(m, self.m_max), npol)
         return self.cached_phase[m]
 
@@ -350,15 +350,32 @@ class IBA(object):
         dphi_interval = 2. * np.pi / nsamples  # sampling interval. Period is 2pi
         dphi = np.arange(0, 2. * np.pi, dphi_interval)  # evenly spaced from 0 to period (but not including period)
 
+        # The Fourier transform of the previous call is reused when more modes are needed for the same streams (e.g. with the
+        # mode convergence test of DORT). The number of samples is then doubled, the previous samples being the even ones, and
+        # the transform is completed with the transform of the odd samples (decimation in time of the FFT). Each sample is
+        # computed once whatever the number of calls.
+        previous = getattr(self, "cached_decomposed_phase", None)
+        if previous is not None and previous[0] == npol and np.array_equal(self.cached_mu, mu) and \
+                len(dphi) == 2 * len(previous[1]) and \
+                np.array_equal(previous[1], dphi[0::2]):
+            # the new samples are in between the previous ones, the two transforms are combined with the twiddle factors
+            n = len(previous[1])
+            twiddle = np.exp(-1j * np.pi * np.arange(n) / n)[:, np.newaxis, np.newaxis]
+            odd = twiddle * np.fft.fft(self.phase(mu, mu, dphi[1::2], npol), axis=2)
+            decomposed_p = np.concatenate((previous[2] + odd, previous[2] - odd), axis=2)
+        else:
+            p = self.phase(mu, mu, dphi, npol)
+            decomposed_p = np.fft.fft(p, axis=2)
+
+        # the transform is only kept in active mode, where the modes m > 0 are needed
+        self.cached_decomposed_phase = (npol, dphi, decomposed_p) if npol > 2 and decomposed_p.ndim == 5 else None
+
         # Determine size of mode-dependent array
         # 2 x 2 phase matrix for mode m=0, otherwise 3 x 3
         pm_size = ([2] + [npol] * m_max)
         self.cached_phase = [np.empty((pm_size[m] * len(mu), pm_size[m] * len(mu))) for m in range(m_max + 1)]
         self.cached_mu = mu
 
-        p = self.phase(mu, mu, dphi, npol)
-        decomposed_p = np.fft.fft(p, axis=2)
-
         delta = 1.0 / dphi.size  # Delta is 1 for m=0 mode
         self.cached_phase[0][0::2, 0::2] = decomposed_p[0, 0, 0].real * delta
         self.cached_phase[0][0::2, 1::2] = decomposed_p[0, 1, 0].real * delta
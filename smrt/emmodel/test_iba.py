@@ -260,6 +260,20 @@ def test_iba_vs_rayleigh_active_m2():
     ok_((abs(em_iba.ft_even_phase(2, mu, npol=3) / em_iba.ks - em_ray.ft_even_phase(2, mu, npol=3) / em_ray.ks) < tolerance_pc).all())
 
 
+def test_ft_even_phase_increasing_modes():
+    # the phase matrices computed with a maximum mode announced step by step (mode convergence test of DORT) are the same as
+    # those computed at once
+    em = setup_func_active()
+    em_ref = setup_func_active()
+    mu = setup_mu(1. / 32, bypass_exception=True)
+    em_ref.set_max_mode(4)
+    for m in range(5):
+        em.set_max_mode(m)
+        em.ft_even_phase(m, mu)
+    for m in range(5):
+        np.testing.assert_allclose(em.ft_even_phase(m, mu), em_ref.ft_even_phase(m, mu), rtol=1e-10, atol=1e-12 * em.ks)
+
+
 def test_permittivity_model():
 
     new_iba = derived_IBA(effective_permittivity_model=effective_permittivity.maxwell_garnett)
@@ -4,6 +4,8 @@ Currently only flat interfaces are implemented.
 .. admonition::  **For developers**
 
     All the different type of interface must defined the methods: `specular_reflection_matrix` and `coherent_transmission_matrix`.
+    When the matrices are diagonal, these methods should accept the `return_as_diagonal` optional argument to return the
+    diagonal as a vector. DORT then computes the matrices once per frequency and avoids the sparse matrix operations.
 
     It is currently not possible to implement rough interface, a (small) change is needed in DORT. Please contact the authors.
 
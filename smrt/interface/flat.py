@@ -16,7 +16,7 @@ class Flat(object):
 
     @classmethod  # we use a classmethod here because Flat does not have parameter, no need to create instances.
     # Most if not all the other interface classes should be instance as they contain parameters (e.g. roughness)
-    def specular_reflection_matrix(cls, frequency, eps_1, eps_2, mu1, npol, compute_coherent_only):
+    def specular_reflection_matrix(cls, frequency, eps_1, eps_2, mu1, npol, compute_coherent_only, return_as_diagonal=False):
         """compute the reflection coefficients for the azimuthal mode m
            and for an array of incidence angles (given by their cosine)
            in medium 1. Medium 2 is where the beam is transmitted.
@@ -25,16 +25,17 @@ class Flat(object):
         :param eps_2: permittivity of the other medium
         :param mu1: array of cosine of incident angles
         :param npol: number of polarization
+        :param return_as_diagonal: if True, return the diagonal of the matrix as a vector
 
-        :return: the reflection matrix
+        :return: the reflection matrix or its diagonal
 """
 
-        return fresnel_reflection_matrix(eps_1, eps_2, mu1, npol)
+        return fresnel_reflection_matrix(eps_1, eps_2, mu1, npol, return_as_diagonal=return_as_diagonal)
 
 
     @classmethod  # we use a classmethod here because Flat does not have parameter, no need to create instances.
     # Most if not all the other interface classes should be instance as they contain parameters (e.g. roughness)
-    def coherent_transmission_matrix(cls, frequency, eps_1, eps_2, mu1, npol, compute_coherent_only):
+    def coherent_transmission_matrix(cls, frequency, eps_1, eps_2, mu1, npol, compute_coherent_only, return_as_diagonal=False):
         """compute the transmission coefficients for the azimuthal mode m
            and for an array of incidence angles (given by their cosine)
            in medium 1. Medium 2 is where the beam is transmitted.
@@ -43,9 +44,10 @@ class Flat(object):
         :param eps_2: permittivity of the other medium
         :param mu1: array of cosine of incident angles
         :param npol: number of polarization
+        :param return_as_diagonal: if True, return the diagonal of the matrix as a vector
 
-        :return: the transmission matrix
+        :return: the transmission matrix or its diagonal
 """
 
-        return fresnel_transmission_matrix(eps_1, eps_2, mu1, npol)
+        return fresnel_transmission_matrix(eps_1, eps_2, mu1, npol, return_as_diagonal=return_as_diagonal)
 
@@ -2,12 +2,14 @@
 
 """
 
+import numpy as np
+
 
 class Transparent(object):
 
     @classmethod  # we use a classmethod here because Flat does not have parameter, no need to create instances.
     # Most if not all the other interface classes should be normal object as they contain parameter (e.g. roughness)
-    def specular_reflection_matrix(cls, frequency, eps_1, eps_2, mu1, npol, compute_coherent_only):
+    def specular_reflection_matrix(cls, frequency, eps_1, eps_2, mu1, npol, compute_coherent_only, return_as_diagonal=False):
         """compute the reflection coefficients for the azimuthal mode m
            and for an array of incidence angles (given by their cosine)
            in medium 1. Medium 2 is where the beam is transmitted.
@@ -16,31 +18,29 @@ class Transparent(object):
         :param eps_2: permittivity of the other medium
         :param mhu1: array of cosine of incident angles
         :param npol: number of polarization
+        :param return_as_diagonal: if True, return the diagonal of the matrix as a vector
 
 """
         assert len(mu1.shape) == 1  # 1D array
 
-        return 0
+        return np.zeros(npol * len(mu1)) if return_as_diagonal else 0
 
     @classmethod  # we use a classmethod here because Flat does not have parameter, no need to create instances.
     # Most if not all the other interface classes should be instance as they contain parameters (e.g. roughness)
-    def coherent_transmission_matrix(cls, frequency, eps_1, eps_2, mu1, npol, compute_coherent_only):
+    def coherent_transmission_matrix(cls, frequency, eps_1, eps_2, mu1, npol, compute_coherent_only, return_as_diagonal=False):
         """compute the transmission coefficients for the azimuthal mode m
            and for an array of incidence angles (given by their cosine)
            in medium 1. Medium 2 is where the beam is transmitted.
 
-<<<<<<< local
-=======
-        :param npol: number of polarizations
->>>>>>> other
         :param eps_1: permittivity of the medium where the incident beam is propagating.
         :param eps_2: permittivity of the other medium
         :param mu1: array of cosine of incident angles
         :param npol: number of polarization
+        :param return_as_diagonal: if True, return the diagonal of the matrix as a vector
 
         :return: the transmission matrix
 """
-        return 1
+        return np.ones(npol * len(mu1)) if return_as_diagonal else 1
 
 
 
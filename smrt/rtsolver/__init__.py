@@ -6,7 +6,10 @@ each layer computed by the EM model, these RT solvers compute the emission and p
 dealt with independently in dedicated modules in :py:mod:`smrt.atmosphere`).
 
 The solvers differ by the approximations and numerical methods. :py:mod:`~smrt.rtsolver.dort` is currently the most accurate and recommended
-in most cases unless the computation time is a constraint.
+in most cases unless the computation time is a constraint. :py:mod:`~smrt.rtsolver.doubling_adding` solves the same equations as DORT
+by doubling and adding layer operators and is an alternative for snowpacks with many or optically thick layers.
+:py:mod:`~smrt.rtsolver.successive_orders` solves the same equations by successive orders of scattering and is faster
+for weakly scattering snowpacks (e.g. dry snow at low frequency). :py:mod:`~smrt.rtsolver.six_flux` is a fast and approximate solver in passive mode for screening runs.
 
 The selection of the solver is done with the :py:func:`~smrt.core.model.make_model` function.
 
@@ -16,7 +19,11 @@ The selection of the solver is done with the :py:func:`~smrt.core.model.make_mod
     :py:func:`~smrt.core.model.make_model`.
 
     To develop a new solver that will be accessible by the :py:func:`~smrt.core.model.make_model` function, you need to add
-    a file in this directory, give a look at dort.py which is not simple but the only one at the moment. Only the method solve needs
+    a file in this directory, give a look at dort.py which is not simple, or doubling_adding.py which shows how to reuse the DORT machinery. Only the method solve needs
     to be implemented. It must return a :py:class:`~smrt.core.result.Result` instance with the results. Contact the core developers to have more details.
+    The dimensions of the sensor that the solver is able to deal with are declared in the `_broadcast_capability` class attribute, the others are
+    managed by the :py:class:`~smrt.core.model.Model`. Note that a solver declaring the `frequency` dimension receives a list of emmodel
+    instances for each frequency. A solver declaring the `snowpack` dimension receives the lists of snowpacks in its `solve_batch` method
+    when :py:meth:`~smrt.core.model.Model.run` is called with `batch=True` (see :py:meth:`~smrt.rtsolver.dort.DORT.solve_batch`).
 
  """
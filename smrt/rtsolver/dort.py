@@ -15,7 +15,14 @@ It is important not to set too low a value for n_max_stream. E.g. 32 is usually
 
 
 # Stdlib import
+import copy
 import math
+import hashlib
+import inspect
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 
 # other import
 import numpy as np
@@ -23,10 +30,18 @@ import scipy.special.orthogonal
 import scipy.linalg
 import scipy.interpolate
 import scipy.sparse
+import xarray as xr
+import pandas as pd
 
 # local import
 from ..core.error import SMRTError
-from ..core.result import Result
+from ..core.result import Result, concat_results
+
+DEBUG_DENSE_BOUNDARY_MATRIX = False  # allow the computation of the dense boundary condition matrix (see DORT.dort special_return)
+
+BATCH_SIZE = 32  # maximum number of snowpacks solved together by DORT.solve_batch
+
+JACOBIAN_PARAMETERS = ['ka', 'ks', 'thickness', 'temperature']  # parameters of the layers in the Jacobian and the gradient
 
 
 class DORT(object):
@@ -34,31 +49,500 @@ class DORT(object):
 
         :param n_max_stream: number of stream in the most refringent layer
         :param m_max: number of mode (azimuth)
+        :param eigenvalue_cache: cache of the eigenvalue solutions of the layers. Either an
+            :py:class:`EigenvalueCache` instance that can be shared between several DORT instances (e.g. given in the rtsolver_kwargs
+            of :py:func:`~smrt.core.model.make_model`) or an integer giving the maximum size of a cache private to this instance.
+            This is useful for time series or sensitivity studies where most of the layers are unchanged between consecutive calls.
+            Default is None (no cache).
+        :param weighting_functions: if True, compute the temperature weighting functions in passive mode. The brightness temperature
+            is linear in the temperature of the layers and of the substrate, so that
+            Tb = incident_contribution + sum(weighting_function * layer temperature) + substrate_weighting_function * substrate temperature.
+            The three terms are returned in the `other_data` attribute of the :py:class:`~smrt.core.result.Result` and allow
+            to compute the brightness temperature of any temperature profile with a dot product. They are obtained with a single
+            solve of the boundary system (one right-hand side per layer). The brightness temperatures are computed as usual. This
+            option is ignored in active mode.
+        :param parallel_modes: if True or an integer (number of threads), the azimuthal modes are solved in parallel by a pool of threads.
+            This is useful in active mode with large m_max, as LAPACK releases the GIL. The phase matrices of the layers are computed
+            before starting the threads, so that the threads only read the caches of the emmodels (e.g. IBA). Note that the numpy/scipy libraries may already use several threads (e.g. with OpenBLAS or MKL),
+            in which case setting the number of threads of these libraries to 1 may give better performance. Default is False.
+        :param mode_tolerance: if set, the azimuthal modes are added until the contribution of two successive modes is smaller than
+            mode_tolerance times the upwelling intensity (maximum over the streams and polarizations), or until m_max is reached. m_max
+            is then an upper bound and can be set to a large value. The number of modes used is returned in
+            `other_data['n_modes']` of the :py:class:`~smrt.core.result.Result`. Default is None (all the modes up to m_max are used).
+        :param boundary_solver: method to solve the boundary condition system. "banded" (default) uses a LAPACK banded solver.
+            "block_tridiagonal" exploits the block-tridiagonal structure of the layer-to-layer coupling with a block Thomas
+            algorithm. The latter can be faster for deep snowpacks with many layers.
+        :param jacobian: if True, compute the derivatives of the brightness temperature with respect to the absorption coefficient
+            (ka), the scattering coefficient (ks), the thickness and the temperature of each layer in passive mode. A list of
+            these parameter names selects some of them. The derivatives are obtained with the tangent-linear of the boundary
+            system at the cost of a second solve with the same factorization and are returned in `other_data['jacobian']` of
+            the :py:class:`~smrt.core.result.Result` with the `parameter` and `layer` dimensions. The phase matrix is assumed to
+            be proportional to ks (i.e. the phase function is unchanged). This option is ignored in active mode.
+
+            The derivative with respect to the effective permittivity is not available. The permittivity of a layer moves the
+            stream cosines of the layer (and of all the layers and the air when it is the most refringent one) and changes the
+            reflection and transmission coefficients of its interfaces. Its derivative therefore requires the derivatives of the
+            phase matrix and of the extinction of the emmodel with respect to the cosines, and of the interface and substrate
+            matrices with respect to the permittivity and the cosines, which the emmodels, interfaces and substrates do not
+            provide (they only return values). Asking for 'permittivity' raises an error.
+        :param cost_gradient: function returning the gradient of a scalar cost with respect to the brightness temperature. The
+            function receives the brightness temperature (the `data` DataArray of the :py:class:`~smrt.core.result.Result`, with
+            the frequency dimension when the sensor has several frequencies) and returns an array of the same shape. If set, the
+            gradient of the cost with respect to ka, ks, thickness and temperature of each layer is computed with the adjoint of
+            the boundary system (one transposed solve per frequency with the forward factorization, whatever the number of layers)
+            and returned in `other_data['gradient']` with the `parameter` and `layer` dimensions. The same assumptions as for the
+            jacobian apply. This option is ignored in active mode.
+        :param exact_angles: if True, the viewing angles are added as streams with a zero weight in the quadrature, so that the
+            brightness temperatures are computed exactly at these angles instead of being interpolated between the streams. The
+            accuracy at the viewing angles then depends less on the number of streams. The cost increases with the number of
+            viewing angles. This option is ignored in active mode.
+        :param stream_tolerance: if set, the number of streams is chosen adaptively. The solver is run with n_max_stream streams, then
+            with twice as many, and so on until the relative change of the result (maximum over the angles, polarizations and
+            frequencies) is smaller than stream_tolerance or until max_stream is reached. The number of streams used is returned
+            in `other_data['n_max_stream']` of the :py:class:`~smrt.core.result.Result`. n_max_stream is then the starting
+            value and can be set to a low value (e.g. 8). The other_data (weighting functions, jacobian, ...) are those of the
+            last run. Default is None (n_max_stream is used).
+        :param max_stream: upper bound of the number of streams in the adaptive mode. Default is 256.
+        :param richardson: if True and stream_tolerance is set, the last results are extrapolated to an infinite number of streams
+            (Richardson extrapolation). The convergence order is estimated from the three last results, or is assumed to be
+            1 (error inversely proportional to the number of streams) when only two results are available. The extrapolated value
+            is usually more accurate than the last result when the convergence is regular, that is with a small stream_tolerance,
+            but is not a solution of the discretized radiative transfer equation. Default is False.
+        :param workspace: pool of preallocated arrays for the boundary system. Either a :py:class:`Workspace` instance that can be
+            shared between several DORT instances (e.g. given in the rtsolver_kwargs of :py:func:`~smrt.core.model.make_model`)
+            or True for a pool private to this instance. The arrays are reused for all the modes and for the next snowpacks,
+            which avoids the allocation of large matrices at each call. This is useful for long series of simulations. The
+            workspace is not used when the jacobian or the gradient is computed, as the factorization is then kept for later
+            use. Default is None (the arrays are allocated for each mode).
+        :param nonscattering_albedo: the layers with a single scattering albedo ks / (ka + ks) smaller than or equal to this value
+            are considered as non-scattering. Their eigenvalue problem is trivial (exponential attenuation along each stream) and
+            is not diagonalised. The scattering of these layers is neglected, this is an approximation for small positive values.
+            The emmodels must provide the ka and ks attributes. Default is 0, only the non-scattering layers (e.g. pure ice or
+            water with the nonscattering emmodel) use the closed-form solution.
+        :param stream_geometry_tolerance: relative tolerance on the permittivities of the layers and of the substrate to reuse the
+            stream geometry (angles and weights of the streams in each layer) computed for a previous snowpack. The geometry is
+            memoized with the permittivities rounded to this tolerance, so that larger values increase the reuse (e.g. in long
+            series of similar snowpacks) at the cost of accuracy: the streams are then those of a slightly different permittivity
+            profile. Default is 1e-12, i.e. the geometry is only reused for practically identical permittivities.
 
     """
 
     # this specifies which dimension this solver is able to deal with. Those not in this list must be managed by the called (Model object)
-    # e.g. here, frequency, time, ... are not managed
-    _broadcast_capability = {"theta_inc", "polarization_inc", "theta", "phi", "polarization"}
-
-    def __init__(self, n_max_stream=32, m_max=2):
+    # e.g. here, time, ... are not managed. The frequency is managed by the solver, in this case the emmodels are given for each frequency
+    # The snowpack dimension means that a list of snowpacks can be solved together when Model.run is called with batch=True, see solve_batch
+    _broadcast_capability = {"frequency", "theta_inc", "polarization_inc", "theta", "phi", "polarization", "snowpack"}
+    # number of snowpacks given to solve_batch by the Model at once, their emmodels are created for each call to bound the memory usage
+    _batch_size = BATCH_SIZE
+
+    def __init__(self, n_max_stream=32, m_max=2, eigenvalue_cache=None, weighting_functions=False, parallel_modes=False,
+                 mode_tolerance=None, boundary_solver="banded", jacobian=False, cost_gradient=None, exact_angles=False,
+                 stream_tolerance=None, max_stream=256, richardson=False, workspace=None,
+                 nonscattering_albedo=0, stream_geometry_tolerance=1e-12):
         # """
         # :param n_max_stream: number of stream in the most refringent layer
         # :param m_max: number of mode (azimuth)
+        # :param eigenvalue_cache: EigenvalueCache instance or maximum size of the cache
+        # :param weighting_functions: compute the temperature weighting functions (passive only)
+        # :param parallel_modes: solve the modes with a pool of threads (True or number of threads)
+        # :param mode_tolerance: relative tolerance to stop adding modes
+        # :param boundary_solver: "banded" or "block_tridiagonal"
+        # :param jacobian: compute the derivatives with respect to the layer parameters (passive only), True or list of parameters
+        # :param cost_gradient: function returning the gradient of the cost with respect to Tb (adjoint mode, passive only)
+        # :param exact_angles: add the viewing angles as zero-weight streams (passive only)
+        # :param stream_tolerance: relative tolerance to stop doubling the number of streams
+        # :param max_stream: maximum number of streams in the adaptive mode
+        # :param richardson: extrapolate the two last results in the adaptive mode
+        # :param workspace: Workspace instance or True for a private pool of arrays
+        # :param nonscattering_albedo: single scattering albedo below which the layers are considered as non-scattering
+        # :param stream_geometry_tolerance: relative tolerance on the permittivities to reuse a memoized stream geometry
 
         # """
         self.n_max_stream = n_max_stream
         self.m_max = m_max
+        self.weighting_functions = weighting_functions
+        self.parallel_modes = parallel_modes
+        self.mode_tolerance = mode_tolerance
+        if jacobian and jacobian is not True:
+            jacobian = list(jacobian)
+            if "permittivity" in jacobian or "effective_permittivity" in jacobian:
+                raise SMRTError("The Jacobian with respect to the effective permittivity is not available in DORT: it requires the "
+                                "derivatives of the phase matrices with respect to the stream cosines and of the interface matrices "
+                                "with respect to the permittivity, which the emmodels and interfaces do not provide")
+            unknown = [parameter for parameter in jacobian if parameter not in JACOBIAN_PARAMETERS]
+            if unknown:
+                raise SMRTError("Unknown Jacobian parameters '%s'. Valid values are: %s" % ("', '".join(unknown), ", ".join(JACOBIAN_PARAMETERS)))
+        self.jacobian = jacobian
+        self.cost_gradient = cost_gradient
+        self.exact_angles = exact_angles
+        self.stream_tolerance = stream_tolerance
+        self.max_stream = max_stream
+        self.richardson = richardson
+        self.nonscattering_albedo = nonscattering_albedo
+        self.stream_geometry_tolerance = stream_geometry_tolerance
+
+        if boundary_solver not in boundary_systems:
+            raise SMRTError("Unknown boundary_solver '%s'. Valid values are: %s" % (boundary_solver, ", ".join(boundary_systems)))
+        self.boundary_solver = boundary_solver
+
+        if eigenvalue_cache is not None and not isinstance(eigenvalue_cache, EigenvalueCache):
+            eigenvalue_cache = EigenvalueCache(maxsize=eigenvalue_cache)
+        self.eigenvalue_cache = eigenvalue_cache
+
+        if workspace is True:
+            workspace = Workspace()
+        self.workspace = workspace or None
 
     def solve(self, snowpack, emmodels, sensor, atmosphere=None):
         """solve the radiative transfer equation for a given snowpack, emmodels and sensor configuration.
 
+        :param snowpack: snowpack to solve
+        :param emmodels: list of emmodel instances, one per layer. When the sensor has several frequencies, list of such lists, one per frequency.
+        :param sensor: sensor configuration
+        :param atmosphere: atmosphere above the snowpack (optional)
+
+        :returns: :py:class:`~smrt.core.result.Result` instance. A `frequency` dimension is added when the sensor has several frequencies.
 """
+
+        if self.stream_tolerance is None:
+            return self.solve_n_stream(snowpack, emmodels, sensor, atmosphere)
+
+        n_max_stream = self.n_max_stream
         try:
-            len(self.sensor.phi)
-        except Exception:
-            pass
+            result = self.solve_n_stream(snowpack, emmodels, sensor, atmosphere)
+            differences = []
+
+            while 2 * self.n_max_stream <= self.max_stream:
+                # the quadrature of 2n streams does not include the n streams, the previous result is only used for the
+                # convergence criteria and for the extrapolation
+                self.n_max_stream *= 2
+                previous, result = result, self.solve_n_stream(snowpack, emmodels, sensor, atmosphere)
+                differences.append(result.data.values - previous.data.values)
+
+                change = np.max(np.abs(differences[-1])) / np.max(np.abs(result.data.values))
+                if change < self.stream_tolerance:
+                    break
+
+            if self.richardson and differences:
+                # the differences between successive results are assumed to decrease geometrically, by a factor 2 for a
+                # first order convergence
+                ratio = np.linalg.norm(differences[-2]) / np.linalg.norm(differences[-1]) if len(differences) > 1 else 2.
+                if ratio > 1:
+                    result.data.values += differences[-1] / (ratio - 1)
+
+            result.other_data['n_max_stream'] = xr.DataArray(self.n_max_stream)
+        finally:
+            self.n_max_stream = n_max_stream
+
+        return result
+
+    def solve_n_stream(self, snowpack, emmodels, sensor, atmosphere=None):
+        # not to be called by the user
+        # solve for the current number of streams
+
+        self.adjoint_gradients = list()  # one function per frequency to compute the gradient of the cost
+
+        if np.ndim(sensor.frequency) > 0:
+            # solve all the frequencies in a single call. The results are assembled here rather than by the Model
+            intensity = list()
+            other_data = list()
+            for frequency, emmodels_f in zip(sensor.frequency, emmodels):
+                sensor_f = copy.copy(sensor)  # shallow copy as in Model.run
+                sensor_f.frequency = frequency
+                intensity_f, coords, other_data_f = self.solve_single_frequency(snowpack, emmodels_f, sensor_f, atmosphere)
+                intensity.append(intensity_f)
+                other_data.append(other_data_f)
+
+            other_data = {name: xr.concat([od[name] for od in other_data], pd.Index(sensor.frequency, name='frequency'))
+                          for name in other_data[0]}
+
+            result = Result(np.array(intensity), [('frequency', sensor.frequency)] + coords, other_data=other_data)
         else:
+            intensity, coords, other_data = self.solve_single_frequency(snowpack, emmodels, sensor, atmosphere)
+            result = Result(intensity, coords, other_data=other_data)
+
+        if self.adjoint_gradients:
+            # adjoint mode, the gradient of the cost with respect to Tb is propagated backward for each frequency
+            g = np.asarray(self.cost_gradient(result.data))
+            coords = [('parameter', JACOBIAN_PARAMETERS), ('layer', np.arange(snowpack.nlayer))]
+            if np.ndim(sensor.frequency) > 0:
+                gradient = [f(g_f) for f, g_f in zip(self.adjoint_gradients, g)]
+                coords = [('frequency', sensor.frequency)] + coords
+            else:
+                gradient = self.adjoint_gradients[0](g)
+            result.other_data['gradient'] = xr.DataArray(np.array(gradient), coords)
+            self.adjoint_gradients = list()  # release the factorizations
+
+        return result
+
+    def solve_batch(self, snowpacks, emmodels, sensor, atmosphere=None, snowpack_dimension=None):
+        """solve the radiative transfer equation for a list of snowpacks. The snowpacks with the same number of layers and of
+        streams in each layer are solved together: the eigenvalue problems of all their layers are diagonalised by batches and
+        their boundary systems are assembled and solved as a single banded system. This is faster than solving the snowpacks one
+        by one for ensembles of similar snowpacks. The snowpacks with different structures are solved by groups.
+
+        The batched solution is only available in passive mode without the options computing other data (weighting_functions,
+        jacobian, cost_gradient, stream_tolerance, mode_tolerance) and with the banded boundary solver. The interfaces and the substrates must
+        have a specular reflection, otherwise the snowpacks of the same chunk (at most BATCH_SIZE snowpacks of a group) are
+        solved one by one. Without batched solution, or for the solvers derived from DORT without the `snowpack` capability, all the
+        snowpacks are solved one by one with :py:meth:`solve`.
+
+        This method is called by :py:meth:`~smrt.core.model.Model.run` when a list of snowpacks is given with batch=True, with chunks of at most
+        BATCH_SIZE snowpacks whose emmodels are created for each call.
+
+        :param snowpacks: list of snowpacks to solve
+        :param emmodels: list of the emmodel instances of each snowpack, as given to :py:meth:`solve`
+        :param sensor: sensor configuration
+        :param atmosphere: atmosphere above the snowpacks (optional)
+        :param snowpack_dimension: name and values (as a tuple) of the dimension of the snowpacks. By default the dimension is
+            called 'Snowpack' and the values are from 0 to the number of snowpacks - 1, as in :py:meth:`~smrt.core.model.Model.run`.
+
+        :returns: :py:class:`~smrt.core.result.Result` instance with the snowpack dimension first.
+"""
+
+        dimension_name, dimension_values = snowpack_dimension if snowpack_dimension is not None else ("Snowpack", None)
+        if dimension_values is None:
+            dimension_values = range(len(snowpacks))
+
+        batch = "snowpack" in self._broadcast_capability and sensor.mode == 'P' and self.boundary_solver == "banded" and \
+            not (self.weighting_functions or self.jacobian or self.cost_gradient is not None or self.stream_tolerance is not None or
+                 self.mode_tolerance is not None)
+
+        intensity = None
+        if batch:
+            if np.ndim(sensor.frequency) > 0:
+                intensity = list()
+                for i, frequency in enumerate(sensor.frequency):
+                    sensor_f = copy.copy(sensor)  # shallow copy as in Model.run
+                    sensor_f.frequency = frequency
+                    intensity.append(self.solve_batch_single_frequency(snowpacks, [emmodels_sp[i] for emmodels_sp in emmodels], sensor_f, atmosphere))
+                intensity = np.stack(intensity, axis=1)
+                coords = [(dimension_name, dimension_values), ('frequency', sensor.frequency)]
+            else:
+                intensity = self.solve_batch_single_frequency(snowpacks, emmodels, sensor, atmosphere)
+                coords = [(dimension_name, dimension_values)]
+
+        if intensity is None:
+            # solve the snowpacks one by one
+            result_list = [self.solve(snowpack, emmodels_sp, sensor, atmosphere) for snowpack, emmodels_sp in zip(snowpacks, emmodels)]
+            return concat_results(result_list, (dimension_name, dimension_values))
+
+        return Result(intensity, coords + [('theta', sensor.theta), ('polarization', ['V', 'H'])])
+
+    def solve_batch_single_frequency(self, snowpacks, emmodels, sensor, atmosphere=None):
+        # not to be called by the user
+        # return the intensity array (snowpack, theta, polarization) for a list of snowpacks and a sensor with a single
+        # frequency in passive mode. The chunks with non-specular interfaces are solved one by one
+
+        self.sensor = sensor
+        self.atmosphere = atmosphere
+        self.interface_cache = dict()  # the keys include the interface and the arguments, it can be shared by the snowpacks
+
+        npol = 2
+        frequency = sensor.frequency
+        mu = np.cos(sensor.theta)
+        exact_angles = self.exact_angles
+        user_outmu = mu if exact_angles else None
+
+        # compute the streams of each snowpack and group the snowpacks by structure
+        snowpack_streams = list()
+        groups = dict()
+        for k, (snowpack, emmodels_sp) in enumerate(zip(snowpacks, emmodels)):
+            permittivity = np.array([emmodel.effective_permittivity() for emmodel in emmodels_sp])
+            permittivity_substrate = snowpack.substrate.permittivity(frequency) if snowpack.substrate is not None else None
+            streams = compute_stream(self.n_max_stream, permittivity, permittivity_substrate, user_outmu=user_outmu,
+                                     tolerance=self.stream_geometry_tolerance)
+            snowpack_streams.append((permittivity, ) + streams)
+
+            n_stream, mu_k, outmu = streams[0], streams[1], streams[3]
+            groups.setdefault((tuple(n_stream), mu_k.shape[1], len(outmu)), []).append(k)
+
+            for emmodel in emmodels_sp:
+                if hasattr(emmodel, "set_max_mode"):
+                    emmodel.set_max_mode(0)  # passive mode
+
+        intensity = np.empty((len(snowpacks), len(mu), npol))
+
+        # the groups are solved by chunks to limit the size of the banded system
+        chunks = [group[i:i + BATCH_SIZE] for group in groups.values() for i in range(0, len(group), BATCH_SIZE)]
+
+        for group in chunks:
+            outmu = [snowpack_streams[k][4] for k in group]
+
+            if atmosphere is not None:
+                intensity_down = np.array([atmosphere.tbdown(frequency, outmu_k, npol) for outmu_k in outmu])[:, :, np.newaxis]
+            else:
+                intensity_down = np.zeros((len(group), len(outmu[0]) * npol, 1))
+
+            intensity_up = self.dort_modem_batch([snowpacks[k] for k in group], [emmodels[k] for k in group],
+                                                 [snowpack_streams[k] for k in group], intensity_down)
+            if intensity_up is None:
+                # a snowpack of the chunk has a non-specular interface, the snowpacks of this chunk are solved one by one
+                for k in group:
+                    intensity[k] = self.solve_single_frequency(snowpacks[k], emmodels[k], sensor, atmosphere)[0]
+                continue
+
+            for i, k in enumerate(group):
+                intensity_up_k = intensity_up[i, :, 0]
+                if atmosphere is not None:
+                    intensity_up_k = atmosphere.tbup(frequency, outmu[i], npol) + atmosphere.trans(frequency, outmu[i], npol) * intensity_up_k
+
+                check_viewing_angles(mu, outmu[i], exact_angles)
+                intensity[k] = interpolate_streams(intensity_up_k, outmu[i], mu, npol, exact_angles)
+
+        return intensity
+
+    def dort_modem_batch(self, snowpacks, emmodels, snowpack_streams, intensity_down):
+        # """compute the upwelling intensity of mode 0 in passive mode for snowpacks with the same number of streams in each layer
+        # and in the air. This is the same computation as dort_modem_banded where the operations are done for all the snowpacks at
+        # once: the eigenvalue problems of the layers are diagonalised by batches and the boundary systems of the snowpacks are
+        # solved as a single banded system.
+        #
+        # :param snowpack_streams: list of the permittivity of the layers and of the streams (see compute_stream) of each snowpack
+        # :param intensity_down: downwelling intensity in the air (snowpack x stream x 1)
+        # :returns: the upwelling intensity (snowpack x stream x 1) or None if an interface matrix is not diagonal
+        # """
+
+        m = 0
+        npol = 2
+        nbatch = len(snowpacks)
+        nlayer = snowpacks[0].nlayer
+        frequency = self.sensor.frequency
+        compute_coherent_only = False
+
+        permittivity = [streams[0] for streams in snowpack_streams]
+        n_stream = snowpack_streams[0][1]
+        mu = np.array([streams[2] for streams in snowpack_streams])
+        weight = np.array([streams[3] for streams in snowpack_streams])
+        outmu = [streams[4] for streams in snowpack_streams]
+        n_stream0 = len(outmu[0])
+
+        thickness = np.array([snowpack.layer_thicknesses for snowpack in snowpacks])
+        temperature = np.array([[layer.temperature for layer in snowpack.layers] for snowpack in snowpacks])
+
+        # same indexes as in dort_modem_banded
+        jl = 2 * (np.cumsum(n_stream)-n_stream) * npol
+        il_top = 2 * (np.cumsum(n_stream)-n_stream) * npol
+        il_bottom = il_top + n_stream * npol
+        nboundary = sum(n_stream) * 2 * npol
+
+        def diagonal(interface, method, *args):
+            # diagonal of an interface matrix, the last argument is mu
+            d = self.interface_matrix(interface, method, frequency, *(args + (npol, compute_coherent_only)), as_diagonal=True)
+            if d is None:
+                raise _NonDiagonalInterface()
+            return np.broadcast_to(d, (len(args[-1]) * npol, ))
+
+        def diagonals(interface, method, *args):
+            # diagonals of the interface matrices of all the snowpacks. interface and args are functions of the snowpack index
+            return np.array([diagonal(interface(k), method, *[arg(k) for arg in args]) for k in range(nbatch)])
+
+        # solve the eigenvalue problem of all the layers of all the snowpacks
+        ke = [emmodel.ke for emmodels_sp in emmodels for emmodel in emmodels_sp]
+        ft_even_phase = [None if is_nonscattering(emmodel, self.nonscattering_albedo) else emmodel.ft_even_phase
+                         for emmodels_sp in emmodels for emmodel in emmodels_sp]
+
+        eigenvalue_solutions = solve_eigenvalue_problems(m, ke, ft_even_phase, mu.reshape(nbatch * nlayer, -1),
+                                                         weight.reshape(nbatch * nlayer, -1), np.tile(n_stream, nbatch),
+                                                         cache=self.eigenvalue_cache)
+
+        boundary_system = _BandedBoundarySystem(n_stream, npol, nbatch=nbatch)
+        b = np.zeros((nbatch, nboundary, 1))
+
+        try:
+            for l in range(nlayer):
+                nsl = n_stream[l]
+                nslnpol = nsl * npol
+                nslm1npol = (n_stream[l-1] * npol) if l > 0 else (n_stream0 * npol)
+                nslp1npol = (n_stream[l+1] * npol) if l < nlayer-1 else None
+
+                beta = np.array([eigenvalue_solutions[k * nlayer + l][0] for k in range(nbatch)])
+                Eu = np.array([eigenvalue_solutions[k * nlayer + l][1] for k in range(nbatch)])
+                Ed = np.array([eigenvalue_solutions[k * nlayer + l][2] for k in range(nbatch)])
+
+                transt = np.exp(-np.maximum(beta, 0) * thickness[:, l, np.newaxis])[:, np.newaxis, :]
+                transb = np.exp(np.minimum(beta, 0) * thickness[:, l, np.newaxis])[:, np.newaxis, :]
+
+                if l == 0:
+                    Eu_0, transt_0 = Eu, transt
+
+                epslm1 = (lambda k: permittivity[k][l-1]) if l > 0 else (lambda k: 1)
+                eps_l = lambda k: permittivity[k][l]
+                mu_l = lambda k: mu[k, l, 0:nsl]
+
+                Rtop_l = diagonals(lambda k: snowpacks[k].interfaces[l], "specular_reflection_matrix", eps_l, epslm1, mu_l)
+
+                if l < nlayer - 1:
+                    ns_lp1 = min(nslnpol, nslp1npol)
+                    eps_lp1 = lambda k: permittivity[k][l+1]
+                    Tbottom_lp1 = diagonals(lambda k: snowpacks[k].interfaces[l], "coherent_transmission_matrix", eps_l, eps_lp1,
+                                            lambda k: mu[k, l, 0:(ns_lp1//npol)])
+                    Rbottom_l = diagonals(lambda k: snowpacks[k].interfaces[l], "specular_reflection_matrix", eps_l, eps_lp1, mu_l)
+                else:
+                    Rbottom_l = np.zeros((nbatch, nslnpol))  # fully absorbant substrate
+                    absorption_sub = np.zeros((nbatch, nslnpol))
+                    for k, substrate in enumerate(snowpack.substrate for snowpack in snowpacks):
+                        if substrate is None:
+                            continue
+                        if hasattr(substrate, "ft_even_diffuse_reflection_matrix"):
+                            raise _NonDiagonalInterface()
+                        Rbottom_l[k] = diagonal(substrate, "specular_reflection_matrix", eps_l(k), mu_l(k))
+                        if substrate.temperature is not None:
+                            absorption_sub[k] = substrate.temperature * diagonal(substrate, "absorption_matrix", eps_l(k), mu_l(k))
+
+                if l > 0:
+                    ns_lm1 = min(nslnpol, nslm1npol)
+                    Ttop_lm1 = diagonals(lambda k: snowpacks[k].interfaces[l], "coherent_transmission_matrix", eps_l, epslm1,
+                                         lambda k: mu[k, l, 0:(ns_lm1//npol)])
+
+                # fill the matrix, the blocks are those of boundary_blocks for diagonal interface matrices
+                j = jl[l]
+                boundary_system.add_block((il_top[l], j), (Ed - Rtop_l[:, :, np.newaxis] * Eu) * transt)
+                boundary_system.add_block((il_bottom[l], j), (Eu - Rbottom_l[:, :, np.newaxis] * Ed) * transb)
+                if l < nlayer - 1:
+                    boundary_system.add_block((il_top[l+1], j), - Tbottom_lp1[:, :, np.newaxis] * Ed[:, 0:ns_lp1, :] * transb)
+                if l > 0:
+                    boundary_system.add_block((il_bottom[l-1], j), - Ttop_lm1[:, :, np.newaxis] * Eu[:, 0:ns_lm1, :] * transt)
+
+                # fill the vector
+                temperature_l = temperature[:, l, np.newaxis]
+                b[:, il_top[l]:il_top[l]+nslnpol, 0] -= (1.0 - Rtop_l) * temperature_l
+                if l < nlayer - 1:
+                    b[:, il_top[l+1]:il_top[l+1]+ns_lp1, 0] += Tbottom_lp1 * temperature_l
+
+                if l == 0:  # Air-snow interface
+                    Tbottom_air_down = diagonals(lambda k: snowpacks[k].interfaces[0], "coherent_transmission_matrix", lambda k: 1,
+                                                 eps_l, lambda k: outmu[k])
+                    b[:, 0:n_stream0*npol, :] += Tbottom_air_down[:, :, np.newaxis] * intensity_down
+
+                b[:, il_bottom[l]:il_bottom[l]+nslnpol, 0] -= (1.0 - Rbottom_l) * temperature_l
+                if l > 0:
+                    b[:, il_bottom[l-1]:il_bottom[l-1]+ns_lm1, 0] += Ttop_lm1 * temperature_l
+
+            b[:, il_bottom[-1]:il_bottom[-1]+n_stream[-1]*npol, 0] += absorption_sub
+
+            Rbottom_air_down = diagonals(lambda k: snowpacks[k].interfaces[0], "specular_reflection_matrix", lambda k: 1,
+                                         lambda k: permittivity[k][0], lambda k: outmu[k])
+            Ttop_0 = diagonals(lambda k: snowpacks[k].interfaces[0], "coherent_transmission_matrix", lambda k: permittivity[k][0],
+                               lambda k: 1, lambda k: mu[k, 0, 0:n_stream[0]])
+        except _NonDiagonalInterface:
+            return None
+
+        # solve the boundary systems of all the snowpacks at once
+        x = boundary_system.solve(np.asfortranarray(b.reshape((nbatch * nboundary, 1))))
+        x = x.reshape((nbatch, nboundary, 1))
+
+        # calculate the intensity emerging from the snowpacks
+        nsl2npol = 2 * n_stream[0] * npol
+        I1up_m = np.matmul(Eu_0 * transt_0, x[:, 0:nsl2npol, :]) + temperature[:, 0, np.newaxis, np.newaxis]
+
+        nout = npol * n_stream0
+        return Rbottom_air_down[:, :, np.newaxis] * intensity_down + Ttop_0[:, 0:nout, np.newaxis] * I1up_m[:, 0:nout, :]
+
+    def solve_single_frequency(self, snowpack, emmodels, sensor, atmosphere=None):
+        # not to be called by the user
+        # return the intensity array, the coordinates and the other data (dict of DataArray) for a sensor with a single frequency
+
+        if np.size(sensor.phi) > 1:
             raise Exception("phi as an array must be implemented")
 
         # all these assignements are for convenience, be carefull with // !
@@ -74,13 +558,36 @@ class DORT(object):
         self.interfaces = self.snowpack.interfaces
 
         self.ke = [emmodel.ke for emmodel in emmodels]
-        self.ft_even_phase = [emmodel.ft_even_phase for emmodel in emmodels]
+        # the non-scattering layers have no phase function, their eigenvalue problem is solved analytically
+        self.ft_even_phase = [None if is_nonscattering(emmodel, self.nonscattering_albedo) else emmodel.ft_even_phase
+                              for emmodel in emmodels]
         self.permittivity = np.array([emmodel.effective_permittivity() for emmodel in emmodels])
-
-        if self.sensor.mode == 'P':
+        self.interface_cache = dict()  # interface matrices for this frequency, see interface_matrix
+
+        # the Jacobian and the gradient are computed with the weighting functions to obtain the derivatives with respect to the
+        # temperatures
+        compute_jacobian = self.jacobian and self.sensor.mode == 'P'
+        compute_gradient = self.cost_gradient is not None and self.sensor.mode == 'P'
+        compute_weighting_functions = (self.weighting_functions or compute_jacobian or compute_gradient) and self.sensor.mode == 'P'
+
+        if compute_weighting_functions:
+            # the temperature are replaced by unit vectors, one column per layer and one for the substrate. The first column is
+            # for the incident intensity
+            ncol = self.nlayer + 2
+            self.temperature = list(np.eye(ncol)[1:-1])
+            has_substrate_temperature = self.snowpack.substrate is not None and self.snowpack.substrate.temperature is not None
+            self.substrate_temperature = np.eye(ncol)[-1] if has_substrate_temperature else None
+
+            # weights of the columns to recover the intensity for the actual temperatures
+            temperature = [layer.temperature for layer in self.snowpack.layers]
+            substrate_temperature = self.snowpack.substrate.temperature if has_substrate_temperature else 0
+            self.source_weights = np.array([1] + temperature + [substrate_temperature], dtype=np.float64)
+        elif self.sensor.mode == 'P':
             self.temperature = [layer.temperature for layer in self.snowpack.layers]
+            self.substrate_temperature = self.snowpack.substrate.temperature if self.snowpack.substrate is not None else None
         else:
             self.temperature = None
+            self.substrate_temperature = None
 
         m_max = self.m_max if self.sensor.mode == 'A' else 0  # force m_max=0 for passive microwave
 
@@ -92,21 +599,14 @@ class DORT(object):
         pola = ['V', 'H'] if self.sensor.mode == 'P' else ['V', 'H', 'U']
         npol = len(pola)
 
-        # reshape the first dimension in two dimensions (theta, pola)
-        intensity = intensity.reshape([intensity.shape[0]//npol, npol]+list(intensity.shape[1:]))
-
         mu = np.cos(sensor.theta)
-        if min(mu) < min(outmu) or max(mu) > max(outmu):
-            raise SMRTError("viewing zenith angle is outside the range of stream angles computed by DORT. Increase the number of streams or change your viewing zenith angle range. In the future it will be possible to explicitly force the extrapolation.")
-
-        # reverse is necessary for "old" scipy version
-        intfct = scipy.interpolate.interp1d(outmu[::-1], intensity[::-1, :, ...], axis=0)  # could use fill_value to be smart about extrapolation, but it's safer to return NaN (default)
+        exact_angles = self.exact_angles and self.sensor.mode == 'P'
+        check_viewing_angles(mu, outmu, exact_angles)
 
-        # it seems there is a bug in scipy at least when checking the boundary, mu must be sorted, outmu does not !
-        i = np.argsort(mu)
+        def interpolate(intensity):
+            return interpolate_streams(intensity, outmu, mu, npol, exact_angles)
 
-        # original that should work: intensity = intfct(mu)
-        intensity = intfct(mu[i])[np.argsort(i)]  # mu[i] sort mu, and [np.argsort(i)] put in back
+        intensity = interpolate(intensity)
 
         if sensor.mode == 'A':
             # reshape the outer/first dimension in two dimensions (theta_inc, pola_inc)
@@ -116,7 +616,43 @@ class DORT(object):
         if sensor.mode == 'A':
             coords = [('theta_inc', sensor.theta_inc), ('polarization_inc', pola)] + coords
 
-        return Result(intensity, coords)
+        other_data = dict()
+
+        if self.mode_tolerance is not None:
+            other_data['n_modes'] = xr.DataArray(self.n_modes)
+
+        if compute_weighting_functions:
+            # the last dimension holds the incident contribution, the layer weighting functions and the substrate weighting function
+            if self.weighting_functions:
+                other_data['incident_contribution'] = xr.DataArray(intensity[..., 0], coords)
+                other_data['weighting_function'] = xr.DataArray(intensity[..., 1:-1], coords + [('layer', np.arange(self.nlayer))])
+                other_data['substrate_weighting_function'] = xr.DataArray(intensity[..., -1], coords)
+
+            if compute_jacobian:
+                # the derivative with respect to the temperature of a layer is its weighting function
+                jacobian = np.concatenate((interpolate(self.tangent_up), intensity[..., np.newaxis, 1:-1]), axis=-2)
+                other_data['jacobian'] = xr.DataArray(jacobian, coords + [('parameter', JACOBIAN_PARAMETERS),
+                                                                          ('layer', np.arange(self.nlayer))])
+                if self.jacobian is not True:
+                    other_data['jacobian'] = other_data['jacobian'].sel(parameter=self.jacobian)
+
+            if compute_gradient:
+                # the gradient is computed by solve once the gradient of the cost with respect to Tb is known. The interpolation
+                # from the streams to the sensor angles is linear, its transpose is applied to the gradient of the cost.
+                interpolation = interpolate(np.eye(len(outmu) * npol))  # (theta, polarization, stream)
+                weighting_function = intensity[..., 1:-1]
+                adjoint_state = self.adjoint_state
+                trans = self.atmosphere.trans(self.sensor.frequency, outmu, npol) if self.atmosphere is not None else 1
+
+                def gradient(g):
+                    g_up = np.tensordot(g, interpolation, axes=2) * trans
+                    return np.vstack((dort_modem_adjoint(g_up, *adjoint_state), np.tensordot(g, weighting_function, axes=2)))
+
+                self.adjoint_gradients.append(gradient)
+
+            intensity = np.dot(intensity, self.source_weights)
+
+        return intensity, coords, other_data
 
     def dort(self, m_max=0, special_return=False):
         # not to be called by the user
@@ -134,63 +670,149 @@ class DORT(object):
 
         permittivity_substrate = self.snowpack.substrate.permittivity(self.sensor.frequency) if self.snowpack.substrate is not None else None
 
+        # in passive mode, the viewing angles can be added as streams with a zero weight (they do not contribute to the quadrature)
+        user_outmu = np.cos(self.sensor.theta) if self.exact_angles and self.sensor.mode == 'P' else None
+
         n_stream, mu, weight, outmu, outweight, \
-        n_stream_substrate = compute_stream(self.n_max_stream, self.permittivity, permittivity_substrate)
+        n_stream_substrate = compute_stream(self.n_max_stream, self.permittivity, permittivity_substrate, user_outmu=user_outmu,
+                                            tolerance=self.stream_geometry_tolerance)
 
         #
         # compute the incident intensity array depending on the sensor
 
         intensity_0, intensity_higher = self.prepare_intensity_array(outmu, outweight)  # TODO Ghi: make an iterator
 
+        if self.temperature is not None and np.ndim(self.temperature[0]) > 0:
+            # weighting functions mode, one column per source. The incident intensity is in the first column
+            intensity_0 = np.hstack((intensity_0, np.zeros((intensity_0.shape[0], len(self.temperature[0]) - 1))))
+
         #
         # need to compute coherent wave propagation ?
 
         compute_coherent_only = self.sensor.mode == 'A'
 
         # inform the EM model how many modes will be needed. This is only used for optimization purpose.
-        # alternative would be to start computing by m_max
-        for emmodel in self.emmodels:
-            if hasattr(emmodel, "set_max_mode"):
-                emmodel.set_max_mode(m_max)
+        # alternative would be to start computing by m_max. With the convergence test, the number of modes is announced
+        # progressively because it is not known in advance.
+        def set_max_mode(m_max):
+            for emmodel in self.emmodels:
+                if hasattr(emmodel, "set_max_mode"):
+                    emmodel.set_max_mode(m_max)
+
+        if self.mode_tolerance is None:
+            set_max_mode(m_max)
 
         #
         # compute the modes
 
         npol = 3 if self.sensor.mode == 'A' else 2
 
-        for m in range(0, m_max+1):  # TODO Ghi: parallelizable (be carefull with caching in the callables)
+        if special_return:  # debugage
+            return self.dort_modem_banded(0, n_stream, mu, weight, outmu, n_stream_substrate, intensity_0, special_return=special_return)
+
+        def solve_mode(m):
             if m == 0:
                 intensity_down_m = intensity_0
             else:
                 intensity_down_m = intensity_higher
 
             # compute the upwelling intensity for mode m
-            intensity_up_m = self.dort_modem_banded(m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m, special_return=special_return)
-
-            if special_return:  # debugage
-                return intensity_up_m
+            intensity_up_m = self.dort_modem(m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m)
 
             if compute_coherent_only:
-                # substrate the coherent contribution
-                intensity_up_m -= self.dort_modem_banded(m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m, compute_coherent_only=True)
+                # substrate the coherent contribution. Without scattering, it is computed stream by stream when the interfaces
+                # are diagonal, otherwise the full boundary system is solved.
+                intensity_coherent_m = self.dort_modem_coherent(m, n_stream, mu, outmu, intensity_down_m)
+                if intensity_coherent_m is None:
+                    intensity_coherent_m = self.dort_modem(m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m,
+                                                           compute_coherent_only=True)
+                intensity_up_m -= intensity_coherent_m
+
+            return intensity_up_m
+
+        if self.parallel_modes and m_max > 0:
+            # the modes are independent, solve them with a pool of threads
+            nthreads = multiprocessing.cpu_count() if self.parallel_modes is True else int(self.parallel_modes)
+            nthreads = min(nthreads, m_max + 1)
+
+            pool = ThreadPool(nthreads)
+            map_modes = pool.map
+        else:
+            # modes are computed one by one
+            nthreads = 1
+            pool = None
+            map_modes = lambda f, modes: [f(m) for m in modes]
 
-            # if self.sensor.mode == 'A': print("res mod=", m, intensity_up_m[0:3, 0:3])
-            # reconstruct the intensity
-            if m == 0:
-                intensity_up = extend_2pol_npol(intensity_up_m, npol)
-            else:
-                intensity_up[0::npol] += intensity_up_m[0::npol] * np.cos(m*self.sensor.phi)  # TODO Ghi: deals with an array of phi
-                intensity_up[1::npol] += intensity_up_m[1::npol] * np.cos(m*self.sensor.phi)  # TODO Ghi: deals with an array of phi
-                intensity_up[2::npol] += intensity_up_m[2::npol] * np.sin(m*self.sensor.phi)  # TODO Ghi: deals with an array of phi
+        # without convergence test all the modes are computed at once, otherwise they are computed by batch of nthreads modes
+        batch_size = m_max + 1 if self.mode_tolerance is None else nthreads
 
-                # TODO: implement a convergence test if we want to avoid long computation when self.m_max is too high for the phase function.
+        m_first = 0
+        n_small_contributions = 0  # number of successive modes with a contribution smaller than the tolerance
+        converged = False
+
+        try:
+            while m_first <= m_max and not converged:
+                modes = range(m_first, min(m_first + batch_size, m_max + 1))
+                if self.mode_tolerance is not None:
+                    set_max_mode(modes[-1])
+                if pool is not None:
+                    # the threads must only read the caches of the emmodels
+                    self.prefill_phase_caches(modes[-1], n_stream, mu)
+
+                for m, intensity_up_m in zip(modes, map_modes(solve_mode, modes)):
+                    # if self.sensor.mode == 'A': print("res mod=", m, intensity_up_m[0:3, 0:3])
+                    # reconstruct the intensity
+                    if m == 0:
+                        intensity_up = extend_2pol_npol(intensity_up_m, npol)
+                    else:
+                        delta_intensity_up = np.empty_like(intensity_up)
+                        delta_intensity_up[0::npol] = intensity_up_m[0::npol] * np.cos(m*self.sensor.phi)  # TODO Ghi: deals with an array of phi
+                        delta_intensity_up[1::npol] = intensity_up_m[1::npol] * np.cos(m*self.sensor.phi)  # TODO Ghi: deals with an array of phi
+                        delta_intensity_up[2::npol] = intensity_up_m[2::npol] * np.sin(m*self.sensor.phi)  # TODO Ghi: deals with an array of phi
+                        intensity_up += delta_intensity_up
+
+                        if self.mode_tolerance is not None:
+                            # convergence test. Two successive modes must have a small contribution because the odd or even modes
+                            # can be small due to the geometry (e.g. phi=pi/2)
+                            if np.max(np.abs(delta_intensity_up)) <= self.mode_tolerance * np.max(np.abs(intensity_up)):
+                                n_small_contributions += 1
+                            else:
+                                n_small_contributions = 0
+                            converged = n_small_contributions >= 2
+
+                    self.n_modes = m + 1  # number of modes used
+                    if converged:
+                        break
+
+                m_first += batch_size
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         if self.atmosphere is not None:
-            intensity_up = self.atmosphere.tbup(self.sensor.frequency, outmu, npol) + \
-                        self.atmosphere.trans(self.sensor.frequency, outmu, npol) * intensity_up
+            if self.temperature is not None and np.ndim(self.temperature[0]) > 0:
+                # weighting functions mode, the atmosphere emission only contributes to the incident column
+                intensity_up = self.atmosphere.trans(self.sensor.frequency, outmu, npol)[:, np.newaxis] * intensity_up
+                intensity_up[:, 0] += self.atmosphere.tbup(self.sensor.frequency, outmu, npol)
+                if self.jacobian:
+                    self.tangent_up = self.atmosphere.trans(self.sensor.frequency, outmu, npol)[:, np.newaxis, np.newaxis] * self.tangent_up
+            else:
+                intensity_up = self.atmosphere.tbup(self.sensor.frequency, outmu, npol) + \
+                            self.atmosphere.trans(self.sensor.frequency, outmu, npol) * intensity_up
 
         return outmu, intensity_up
 
+    def prefill_phase_caches(self, m, n_stream, mu):
+        # """compute the phase matrices of the scattering layers up to mode m with the same arguments as in the eigenvalue
+        # problems. The emmodels cache them (e.g. IBA.cached_phase), so that the threads solving the modes in parallel only read
+        # the caches and do not need to be serialized."""
+
+        for l, ft_even_phase in enumerate(self.ft_even_phase):
+            if ft_even_phase is not None:
+                mu_l = mu[l, 0:n_stream[l]]
+                ft_even_phase(m, np.concatenate((mu_l, -mu_l)))
+
     def prepare_intensity_array(self, outmu, outweight):
 
         if self.sensor.mode == 'A':
@@ -248,6 +870,111 @@ class DORT(object):
 
         return intensity_0, intensity_higher
 
+    def interface_matrix(self, interface, method, *args, **kwargs):
+        # """return the matrix computed by the given method of an interface or of the substrate. The matrices do not depend on the
+        # azimuthal mode and are computed once per frequency (the cache is reset in solve_single_frequency) and shared by
+        # the modes and by the diffuse and coherent passes.
+        #
+        # :param interface: interface or substrate instance
+        # :param method: name of the method (e.g. specular_reflection_matrix)
+        # :param args: arguments of the method. The last three ones are mu, npol and compute_coherent_only.
+        # :param as_diagonal: (keyword only) if True, return the diagonal as a vector or None if the matrix is not diagonal. The
+        #     `return_as_diagonal` option of the method is used when available. Default is False.
+        # """
+
+        as_diagonal = kwargs.pop("as_diagonal", False)
+
+        key = (id(interface), method, as_diagonal) + tuple(x.tobytes() if isinstance(x, np.ndarray) else x for x in args)
+
+        try:
+            return self.interface_cache[key]
+        except KeyError:
+            pass
+
+        f = getattr(interface, method)
+        if not as_diagonal:
+            matrix = f(*args)
+        elif has_diagonal_option(getattr(f, "__func__", f)):
+            matrix = f(*args, return_as_diagonal=True)
+        else:
+            mu, npol = args[-3:-1]
+            matrix = matrix_diagonal(self.interface_matrix(interface, method, *args), len(mu) * npol)
+
+        self.interface_cache[key] = matrix
+        return matrix
+
+    def dort_modem_coherent(self, m, n_stream, mu, outmu, intensity_down_m):
+        # """compute the coherent upwelling intensity for mode m, that is the solution of dort_modem_banded with compute_coherent_only=True.
+        # Without scattering, the streams are independent. If the interface and substrate matrices are diagonal, the solution is
+        # obtained with an adding recursion from the bottom to the top for each stream and polarization, avoiding the
+        # assembly and solve of the boundary system.
+        #
+        # :returns: the upwelling intensity or None if a matrix is not diagonal.
+        # """
+
+        n_stream0 = len(outmu)  # number of streams in the air
+        npol = 2 if m == 0 else 3
+        frequency = self.sensor.frequency
+
+        # reflectance at the top of layer l+1, looking downward inside layer l+1 (below the interface)
+        r_lp1 = None
+
+        for l in range(self.nlayer - 1, -1, -1):
+            nsl = n_stream[l]
+            nslnpol = nsl * npol
+            mu_l = mu[l, 0:nsl]
+
+            # reflectance at the bottom of layer l
+            if l < self.nlayer - 1:
+                ns_ = min(nslnpol, n_stream[l+1] * npol)
+                Rbottom_l = self.interface_matrix(self.interfaces[l], "specular_reflection_matrix", frequency, self.permittivity[l], self.permittivity[l+1],
+                                                  mu_l, npol, True, as_diagonal=True)
+                Tbottom_lp1 = self.interface_matrix(self.interfaces[l], "coherent_transmission_matrix", frequency, self.permittivity[l], self.permittivity[l+1],
+                                                    mu_l[0:(ns_//npol)], npol, True, as_diagonal=True)
+                Ttop_l = self.interface_matrix(self.interfaces[l+1], "coherent_transmission_matrix", frequency, self.permittivity[l+1], self.permittivity[l],
+                                               mu[l+1, 0:(ns_//npol)], npol, True, as_diagonal=True)
+                Rtop_lp1 = self.interface_matrix(self.interfaces[l+1], "specular_reflection_matrix", frequency, self.permittivity[l+1], self.permittivity[l],
+                                                 mu[l+1, 0:n_stream[l+1]], npol, True, as_diagonal=True)
+                if Rbottom_l is None or Tbottom_lp1 is None or Ttop_l is None or Rtop_lp1 is None:
+                    return None
+
+                # multiple reflections between the interface and the layers below
+                rho_l = Rbottom_l.copy()
+                rho_l[0:ns_] += Ttop_l * r_lp1[0:ns_] * Tbottom_lp1 / (1 - Rtop_lp1[0:ns_] * r_lp1[0:ns_])
+
+            elif self.snowpack.substrate is not None:
+                rho_l = self.interface_matrix(self.snowpack.substrate, "specular_reflection_matrix", frequency, self.permittivity[l], mu_l, npol, True, as_diagonal=True)
+                if rho_l is None:
+                    return None
+            else:
+                rho_l = np.zeros(nslnpol)  # fully absorbant substrate
+
+            # attenuation through the layer in both directions
+            mu_l = np.concatenate((mu_l, -mu_l))
+            optical_depth = np.repeat(self.ke[l](mu_l) / np.abs(mu_l), npol) * self.thickness[l]
+            r_lp1 = np.exp(-optical_depth[0:nslnpol]) * rho_l * np.exp(-optical_depth[nslnpol:])
+
+        # air-snow interface
+        nair = n_stream0 * npol
+        Rtop_0 = self.interface_matrix(self.interfaces[0], "specular_reflection_matrix", frequency, self.permittivity[0], 1, mu[0, 0:n_stream[0]], npol, True, as_diagonal=True)
+        Tbottom_air_down = self.interface_matrix(self.interfaces[0], "coherent_transmission_matrix", frequency, 1, self.permittivity[0], outmu, npol, True, as_diagonal=True)
+        Ttop_0 = self.interface_matrix(self.interfaces[0], "coherent_transmission_matrix", frequency, self.permittivity[0], 1, mu[0, 0:n_stream[0]], npol, True, as_diagonal=True)
+        Rbottom_air_down = self.interface_matrix(self.interfaces[0], "specular_reflection_matrix", frequency, 1, self.permittivity[0], outmu, npol, True, as_diagonal=True)
+
+        if Rtop_0 is None or Tbottom_air_down is None or Ttop_0 is None or Rbottom_air_down is None:
+            return None
+
+        r_0 = r_lp1[0:nair, np.newaxis]
+        I1down = Tbottom_air_down[:, np.newaxis] * intensity_down_m / (1 - Rtop_0[0:nair, np.newaxis] * r_0)  # just under the interface
+        I0up_m = Rbottom_air_down[:, np.newaxis] * intensity_down_m + Ttop_0[0:nair, np.newaxis] * r_0 * I1down
+
+        return np.array(I0up_m).squeeze()
+
+    def dort_modem(self, m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m, compute_coherent_only=False):
+        # compute the upwelling intensity for mode m. This method can be overloaded by subclasses to use another method
+        # than the boundary condition system of DORT
+        return self.dort_modem_banded(m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m, compute_coherent_only=compute_coherent_only)
+
     def dort_modem_banded(self, m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m, compute_coherent_only=False, special_return=False):
 
         n_stream0 = len(outmu)  # number of streams in the air
@@ -267,23 +994,43 @@ class DORT(object):
         il_bottom = il_top + n_stream * npol
 
         nboundary = sum(n_stream) * 2 * npol
-        nband = 3 * npol * np.max(n_stream)  # each layer appears in 3 blocks
-        # (bottom, top of the current layer, and top of layer below (for downward directons) and
-        # bottom of the layer above (for upward directions)
 
         debug_compute_BC = special_return in ["BC", "testeq"]  # compute the full matrix boundary condition
+        if debug_compute_BC and not DEBUG_DENSE_BOUNDARY_MATRIX:
+            raise SMRTError("The dense boundary condition matrix is only computed in debug mode (set DEBUG_DENSE_BOUNDARY_MATRIX to True)")
+
+        # the tangent-linear and adjoint computations need the blocks of each layer
+        compute_derivatives = (self.jacobian or self.cost_gradient is not None) and m == 0 and not compute_coherent_only \
+            and self.temperature is not None and not special_return
+
+        # the arrays of the workspace are overwritten by the next mode, they can not be used when the factorization is kept
+        workspace = self.workspace if not compute_derivatives else None
 
         # Boundary condition matrix
-        bBC = np.zeros((2*nband+1, nboundary))  # we use banded Boundary condition matrix
+        if special_return == "bBC" or special_return == "testeq":
+            boundary_system = _BandedBoundarySystem(n_stream, npol)
+        else:
+            boundary_system = boundary_systems[self.boundary_solver](n_stream, npol, workspace=workspace)
 
         # rhs vector size
         assert(len(intensity_down_m.shape) == 2)
         nvector = intensity_down_m.shape[1]
-        b = np.zeros((nboundary, nvector))
+        # Fortran order as required by LAPACK, to avoid a copy
+        b = workspace.zeros("b", (nboundary, nvector), order='F') if workspace is not None else np.zeros((nboundary, nvector))
 
         if debug_compute_BC:
             BC = np.zeros((nboundary, nboundary))  # full/dense Boundary condition matrix. Only for debugging.
 
+        # solve the eigenvalue problem for all the layers. The layers with the same number of streams are solved together
+        if self.ft_even_phase is None or compute_coherent_only:
+            ft_even_phase = [None] * self.nlayer
+        else:
+            ft_even_phase = self.ft_even_phase
+
+        eigenvalue_solutions = solve_eigenvalue_problems(m, self.ke, ft_even_phase, mu, weight, n_stream, cache=self.eigenvalue_cache)
+
+        tangent_layers = list()
+
         for l in range(0, self.nlayer):
             nsl = n_stream[l]  # number of streams in layer l
             nslnpol = nsl * npol  # number of streams * npol in layer l
@@ -291,18 +1038,13 @@ class DORT(object):
             nslm1npol = (n_stream[l-1] * npol) if l > 0 else (n_stream0 * npol)  # number of streams * npol in the layer l-1 (lm1)
             nslp1npol = (n_stream[l+1] * npol) if l < self.nlayer-1 else (n_stream_substrate * npol)  # number of streams * nplo in the layer l+1 (lp1)
 
-            # solve the eigenvalue problem for layer l
-            # TODO: deal with the case phase=0
-            if self.ft_even_phase is None or compute_coherent_only:
-                ft_even_phase_l = None
-            else:
-                ft_even_phase_l = self.ft_even_phase[l]
-
-            beta, Eu, Ed = solve_eigenvalue_problem(m, self.ke[l], ft_even_phase_l, mu[l, 0:nsl], weight[l, 0:nsl])
+            # eigenvalues and eigenvectors for layer l
+            beta, Eu, Ed = eigenvalue_solutions[l]
 
             # deduce the transmittance through the layers
-            transt = scipy.sparse.diags(np.exp(-np.maximum(beta, 0) * self.thickness[l]), 0)  # positive beta, reference at the bottom
-            transb = scipy.sparse.diags(np.exp(np.minimum(beta, 0) * self.thickness[l]), 0)   # negative beta, reference at the top
+            # the transmittances are diagonal matrices, they are stored as vectors and applied by broadcasting on the columns
+            transt = np.exp(-np.maximum(beta, 0) * self.thickness[l])[np.newaxis, :]  # positive beta, reference at the bottom
+            transb = np.exp(np.minimum(beta, 0) * self.thickness[l])[np.newaxis, :]   # negative beta, reference at the top
 
             # where we have chosen
             # beta>0  : z(0)(l) = z(l)    # reference is at the bottom
@@ -315,7 +1057,7 @@ class DORT(object):
             j = jl[l]
 
             # -------------------------------------------------------------------------------
-            # Eq 17 & 19 TOP of layer l
+            # interfaces at the top and bottom of layer l
 
             # compute reflection coefficient between l and l-1
             if l == 0:
@@ -326,120 +1068,532 @@ class DORT(object):
             else:
                 epslm1 = self.permittivity[l-1]
 
-            Rtop_l = self.interfaces[l].specular_reflection_matrix(self.sensor.frequency, self.permittivity[l], epslm1,
-                                                                 mu[l, 0:nsl], npol, compute_coherent_only)  # snow-snow
+            Rtop_l = self.interface_matrix(self.interfaces[l], "specular_reflection_matrix", self.sensor.frequency, self.permittivity[l], epslm1,
+                                           mu[l, 0:nsl], npol, compute_coherent_only)  # snow-snow
 
-            # fill the matrix
-            todiag(bBC, (il_topl, j), (Ed - Rtop_l * Eu) * transt)  # this line perform matrix multiplication between Rtop_l and Eu. Make sure that reflection_matrix return matrix!
+            if l < self.nlayer - 1:
+                ns_lp1 = min(nslnpol, nslp1npol)
+                Tbottom_lp1 = self.interface_matrix(self.interfaces[l], "coherent_transmission_matrix", self.sensor.frequency, self.permittivity[l], self.permittivity[l+1],
+                                                    mu[l, 0:(ns_lp1//npol)], npol, compute_coherent_only)  # snow-snow
 
-            if debug_compute_BC:
-                BC[il_topl:il_topl+nslnpol, j:j+nsl2npol] = (Ed - Rtop_l * Eu) * transt   # a mettre en (l,l), theta<0 et * transt  # a mettre en (l,l)
+            # compute reflection coefficient between l and l+1
+            if l < self.nlayer-1:
+                Rbottom_l = self.interface_matrix(self.interfaces[l], "specular_reflection_matrix", self.sensor.frequency, self.permittivity[l], self.permittivity[l+1], mu[l, 0:nsl], npol, compute_coherent_only)  # snow-snow
+            elif self.snowpack.substrate is not None:
+                Rbottom_l = self.interface_matrix(self.snowpack.substrate, "specular_reflection_matrix", self.sensor.frequency, self.permittivity[l], mu[l, 0:nsl], npol, compute_coherent_only)  # snow-sub
+                if not compute_coherent_only and hasattr(self.snowpack.substrate, "ft_even_diffuse_reflection_matrix"):
+                    full_weight_l = np.repeat(weight[l, :], npol)    # could be cached (per layer) because same for each mode
+                    Rbottom_l = Rbottom_l + self.snowpack.substrate.ft_even_diffuse_reflection_matrix(m, self.sensor.frequency, self.permittivity[l], mu[l, 0:nsl], npol) * full_weight_l  # snow-sub
+            else:
+                Rbottom_l = 0  # fully absorbant substrate
 
-            if l < self.nlayer - 1:
-                ns_ = min(nslnpol, nslp1npol)
-                Tbottom_lp1 = self.interfaces[l].coherent_transmission_matrix(self.sensor.frequency, self.permittivity[l], self.permittivity[l+1],
-                                                                              mu[l, 0:(ns_//npol)], npol, compute_coherent_only)  # snow-snow
-                todiag(bBC, (il_top[l+1], j), - Tbottom_lp1 * Ed[0:ns_, :] * transb)
-                if debug_compute_BC:
-                    BC[il_top[l+1]:il_top[l+1]+ns_, j:j+nsl2npol] = - Tbottom_lp1 * Ed[0:ns_, :] * transb  # a mettre en (l+1,l)
+            if l > 0:
+                ns_lm1 = min(nslnpol, nslm1npol)
+                Ttop_lm1 = self.interface_matrix(self.interfaces[l], "coherent_transmission_matrix", self.sensor.frequency, self.permittivity[l], self.permittivity[l-1], mu[l, 0:(ns_lm1//npol)], npol, compute_coherent_only)  # snow-snow
+
+            # -------------------------------------------------------------------------------
+            # fill the matrix. Eq 17 & 19 TOP and Eq 18 & 22 BOTTOM of layer l, top of layer l+1 and bottom of layer l-1
+
+            interface_matrices = (Rtop_l, Rbottom_l, (Tbottom_lp1, ns_lp1) if l < self.nlayer - 1 else None,
+                                  (Ttop_lm1, ns_lm1) if l > 0 else None)
+            rows = (il_topl, il_bottoml, il_top[l+1] if l < self.nlayer - 1 else None, il_bottom[l-1] if l > 0 else None)
 
+            for i, block in zip(rows, boundary_blocks(Eu, Ed, transt, transb, *interface_matrices)):
+                if block is not None:
+                    boundary_system.add_block((i, j), block)
+                    if debug_compute_BC:
+                        BC[i:i+len(block), j:j+nsl2npol] = block
+
+            if compute_derivatives:
+                tangent_layers.append((rows, interface_matrices, beta, Eu, Ed, transt, transb))
+
+            # -------------------------------------------------------------------------------
             # fill the vector
-            if m == 0 and self.temperature is not None and self.temperature[l] > 0:
+
+            if m == 0 and self.temperature is not None and np.any(self.temperature[l] > 0):
                 if Rtop_l is 0:
                     b[il_topl:il_topl+nslnpol, :] -= self.temperature[l]  # a mettre en (l)
                 else:
-                    b[il_topl:il_topl+nslnpol, :] -= ((1.0 - muleye(Rtop_l)) * self.temperature[l])[:, np.newaxis]  # a mettre en (l)
+                    b[il_topl:il_topl+nslnpol, :] -= np.outer(1.0 - muleye(Rtop_l), self.temperature[l])  # a mettre en (l)
                 # the muleye comes from the isotropic emission of the black body
 
-                if l < self.nlayer - 1 and self.temperature[l] > 0:
-                    b[il_top[l+1]:il_top[l+1]+ns_, :] += (muleye(Tbottom_lp1) * self.temperature[l])[:, np.newaxis]     # a mettre en (l+1)
+                if l < self.nlayer - 1:
+                    b[il_top[l+1]:il_top[l+1]+ns_lp1, :] += np.outer(muleye(Tbottom_lp1), self.temperature[l])     # a mettre en (l+1)
 
             if l == 0:  # Air-snow interface
-                Tbottom_air_down = self.interfaces[l].coherent_transmission_matrix(self.sensor.frequency, 1, self.permittivity[l],
-                                                                                   outmu, npol, compute_coherent_only)
-
-                b[il_topl:il_topl+n_stream0*npol, :] += Tbottom_air_down * intensity_down_m
-
-            # -------------------------------------------------------------------------------
-            # Eq 18 & 22 BOTTOM of layer l
-
-            # compute reflection coefficient between l and l-1
-            if l < self.nlayer-1:
-                Rbottom_l = self.interfaces[l].specular_reflection_matrix(self.sensor.frequency, self.permittivity[l], self.permittivity[l+1], mu[l, 0:nsl], npol, compute_coherent_only)  # snow-snow
-            elif self.snowpack.substrate is not None:
-                Rbottom_l = self.snowpack.substrate.specular_reflection_matrix(self.sensor.frequency, self.permittivity[l], mu[l, 0:nsl], npol, compute_coherent_only)  # snow-sub
-                if not compute_coherent_only and hasattr(self.snowpack.substrate, "ft_even_diffuse_reflection_matrix"):
-                    full_weight_l = np.repeat(weight[l, :], npol)    # could be cached (per layer) because same for each mode
-                    Rbottom_l += self.snowpack.substrate.ft_even_diffuse_reflection_matrix(m, self.sensor.frequency, self.permittivity[l], mu[l, 0:nsl], npol) * full_weight_l  # snow-sub
-            else:
-                Rbottom_l = 0  # fully absorbant substrate
+                Tbottom_air_down = self.interface_matrix(self.interfaces[l], "coherent_transmission_matrix", self.sensor.frequency, 1, self.permittivity[l],
+                                                         outmu, npol, compute_coherent_only)
 
-            # fill the matrix
-            todiag(bBC, (il_bottoml, j), (Eu - Rbottom_l * Ed) * transb)
-            if debug_compute_BC:
-                BC[il_bottoml:il_bottoml+nslnpol, j:j+nsl2npol] = (Eu - Rbottom_l * Ed) * transb  # a mettre en (l,l), theta >0
-
-            if l > 0:
-                ns_ = min(nslnpol, nslm1npol)
-                Ttop_lm1 = self.interfaces[l].coherent_transmission_matrix(self.sensor.frequency, self.permittivity[l], self.permittivity[l-1], mu[l, 0:(ns_//npol)], npol, compute_coherent_only)  # snow-snow
-                todiag(bBC, (il_bottom[l-1], j), -Ttop_lm1 * Eu[0:ns_, :] * transt)
-                if debug_compute_BC:
-                    BC[il_bottom[l-1]:il_bottom[l-1]+ns_, j:j+nsl2npol] = -Ttop_lm1 * Eu[0:ns_, :] * transt  # a mettre en (l-1)
+                b[il_topl:il_topl+n_stream0*npol, :] += matmul(Tbottom_air_down, intensity_down_m)
 
-            # fill the vector
-            if m == 0 and self.temperature is not None and self.temperature[l] > 0:
+            if m == 0 and self.temperature is not None and np.any(self.temperature[l] > 0):
                 if Rbottom_l is 0:
                     b[il_bottoml:il_bottoml+nslnpol, :] -= self.temperature[l]   # a mettre en (l)
                 else:
-                    b[il_bottoml:il_bottoml+nslnpol, :] -= ((1.0 - muleye(Rbottom_l)) * self.temperature[l])[:, np.newaxis]  # a mettre en (l)
+                    b[il_bottoml:il_bottoml+nslnpol, :] -= np.outer(1.0 - muleye(Rbottom_l), self.temperature[l])  # a mettre en (l)
                 if l > 0:
-                    b[il_bottom[l-1]:il_bottom[l-1]+ns_, :] += (muleye(Ttop_lm1) * self.temperature[l])[:, np.newaxis]  # a mettre en (l-1)
+                    b[il_bottom[l-1]:il_bottom[l-1]+ns_lm1, :] += np.outer(muleye(Ttop_lm1), self.temperature[l])  # a mettre en (l-1)
 
             if m == 0 and l == self.nlayer-1 and self.snowpack.substrate is not None and \
-                self.snowpack.substrate.temperature is not None and self.temperature is not None:
+                self.substrate_temperature is not None and self.temperature is not None:
                 ####Rtop_sub = self.interfaces[l].specular_reflection_matrix(npol, sensor.frequency, substrate.permittivity, permittivity[l], mu[l, 0:nsl], compute_coherent_only)  # sub-snow
                 ###raise Exception("finish the implementation here")
                 ###Rtop_sub = self.snowpack.substrate.emission_matrix(self.sensor.frequency, self.permittivity[l], mu[l, 0:nsl], compute_coherent_only)  # sub-snow
-                Ttop_sub = self.snowpack.substrate.absorption_matrix(self.sensor.frequency, self.permittivity[l], mu[l, 0:nsl], npol, compute_coherent_only)  # sub-snow
-                b[il_bottoml:il_bottoml+nslnpol, :] += (muleye(Ttop_sub) * self.snowpack.substrate.temperature)[:, np.newaxis]
+                Ttop_sub = self.interface_matrix(self.snowpack.substrate, "absorption_matrix", self.sensor.frequency, self.permittivity[l], mu[l, 0:nsl], npol, compute_coherent_only)  # sub-snow
+                b[il_bottoml:il_bottoml+nslnpol, :] += np.outer(muleye(Ttop_sub), self.substrate_temperature)
 
         #   solve the boundary system BCx=b
 
         if special_return == "BC":
             return BC, b
         elif special_return == "bBC":
-            return bBC, b
+            return boundary_system.banded_matrix(), b
 
         if special_return == "testeq":
             # test
             x = scipy.linalg.solve(BC, b, overwrite_a=True, overwrite_b=False)
-            x2 = scipy.linalg.solve_banded((nband, nband), bBC, b, overwrite_ab=True, overwrite_b=False)
+            x2 = boundary_system.solve(b.copy())
             np.testing.assert_allclose(x, x2, rtol=1e-06)
             print("both matrix are equal")
 
 
         #x = scipy.linalg.solve(BC, b, overwrite_a=True, overwrite_b=False)
-        x = scipy.linalg.solve_banded((nband, nband), bBC, b, overwrite_ab=True, overwrite_b=True)
-        x = np.matrix(x)
+        x = boundary_system.solve(b)
 
         # #  ! calculate the intensity emerging from the snowpack
         l = 0
         j = jl[l]  # should be 0
         nsl2npol = 2 * n_stream[l] * npol
-        I1up_m = Eu_0 * transt_0 * x[j:j+nsl2npol, :]
+        I1up_m = np.dot(Eu_0 * transt_0, x[j:j+nsl2npol, :])
 
-        if m == 0 and self.temperature is not None and self.temperature[0] > 0:
+        if m == 0 and self.temperature is not None and np.any(self.temperature[0] > 0):
             I1up_m += self.temperature[0]  # just under the interface
 
-        Rbottom_air_down = self.interfaces[0].specular_reflection_matrix(self.sensor.frequency, 1, self.permittivity[0],
-                                                                         outmu, npol, compute_coherent_only)
-        Ttop_0 = self.interfaces[0].coherent_transmission_matrix(self.sensor.frequency, self.permittivity[0],
-                                                                 1, mu[0, 0:n_stream[0]], npol, compute_coherent_only)  # snow-air
+        Rbottom_air_down = self.interface_matrix(self.interfaces[0], "specular_reflection_matrix", self.sensor.frequency, 1, self.permittivity[0],
+                                                 outmu, npol, compute_coherent_only)
+        Ttop_0 = self.interface_matrix(self.interfaces[0], "coherent_transmission_matrix", self.sensor.frequency, self.permittivity[0],
+                                       1, mu[0, 0:n_stream[0]], npol, compute_coherent_only)  # snow-air
+
+        I0up_m = matmul(Rbottom_air_down, intensity_down_m) + matmul(Ttop_0, I1up_m)[:npol*n_stream0]
+
+        if compute_derivatives:
+            # the derivatives are computed for the actual temperatures: the columns of the solution are combined with the
+            # source weights (incident intensity, temperatures of the layers and of the substrate)
+            x_sources = np.dot(x, self.source_weights)
+            rhs, dI1up = self.dort_modem_tangent_rhs(m, n_stream, mu, weight, jl, tangent_layers, x_sources)
 
-        I0up_m = Rbottom_air_down * np.matrix(intensity_down_m) + (Ttop_0 * I1up_m)[:npol*n_stream0]
+            Eu_transt_0 = Eu_0 * transt_0
+            nout = npol * n_stream0
+
+            if self.jacobian:
+                # tangent-linear: solve BC dx = -dBC x for all the parameters at once with the factorization of BC
+                dx = boundary_system.solve(rhs.reshape((nboundary, -1)).copy())
+                dI1up_total = dI1up + np.dot(Eu_transt_0, dx[0:Eu_transt_0.shape[1], :]).reshape(dI1up.shape)
+                self.tangent_up = matmul(Ttop_0, dI1up_total.reshape((len(dI1up), -1)))[:nout].reshape((nout, ) + rhs.shape[1:])
+
+            if self.cost_gradient is not None:
+                # adjoint: store what is needed to compute the gradient once the gradient of the cost is known
+                self.adjoint_state = boundary_system, rhs, dI1up, Eu_transt_0, Ttop_0, nout
 
         return np.array(I0up_m).squeeze()
 
+    def dort_modem_tangent_rhs(self, m, n_stream, mu, weight, jl, tangent_layers, x):
+        # compute the right-hand sides of the tangent-linear system BC dx = - dBC x for the derivatives with respect to ka, ks and
+        # the thickness of each layer. Only the blocks in the columns of the layer depend on its parameters. They are differentiated
+        # through the eigenvalue solution and the transmittances.
+        #
+        # :param x: solution of the boundary system (one column)
+        # :returns: the right-hand sides (nboundary, parameter, layer) and the direct derivative of the intensity emerging from the
+        # first layer (n_stream[0] * npol, parameter, layer), due to the eigenvectors and transmittance of the first layer.
+
+        npol = 2 if m == 0 else 3
+        nparam = 3
+
+        rhs = np.zeros((len(x), nparam, self.nlayer))
+        dI1up = np.zeros((n_stream[0] * npol, nparam, self.nlayer))
+
+        for l, (rows, interface_matrices, beta, Eu, Ed, transt, transb) in enumerate(tangent_layers):
+            nsl = n_stream[l]
+            n = nsl * npol
+            j = jl[l]
+            xl = x[j:j+2*n]
+
+            dbeta_ka, dbeta_ks, dE_ka, dE_ks = self.eigenvalue_solution_derivatives(m, l, mu[l, 0:nsl], weight[l, 0:nsl], beta,
+                                                                                    np.vstack((Eu, Ed)))
+
+            # (derivative of beta, derivative of E, derivative of the thickness) for ka, ks and thickness
+            derivatives = [(dbeta_ka, dE_ka, 0), (dbeta_ks, dE_ks, 0), (0, None, 1)]
+
+            for k, (dbeta, dE, dthickness) in enumerate(derivatives):
+                dtranst = - transt * (np.where(beta > 0, dbeta, 0) * self.thickness[l] + np.maximum(beta, 0) * dthickness)
+                dtransb = transb * (np.where(beta < 0, dbeta, 0) * self.thickness[l] + np.minimum(beta, 0) * dthickness)
+
+                dblocks = boundary_blocks(Eu, Ed, dtranst, dtransb, *interface_matrices)
+                if dE is not None:
+                    dblocks = [None if block is None else block + dblock for block, dblock
+                               in zip(dblocks, boundary_blocks(dE[0:n], dE[n:], transt, transb, *interface_matrices))]
+
+                for i, dblock in zip(rows, dblocks):
+                    if dblock is not None:
+                        rhs[i:i+len(dblock), k, l] -= np.dot(dblock, xl)
+
+                if l == 0:
+                    # the eigenvectors and the transmittance of the first layer are used for the emerging intensity
+                    dEu_transt = Eu * dtranst if dE is None else dE[0:n] * transt + Eu * dtranst
+                    dI1up[:, k, l] = np.dot(dEu_transt, xl)
+
+        return rhs, dI1up
+
+    def eigenvalue_solution_derivatives(self, m, l, mu, weight, beta, E):
+        # return the derivatives of the eigenvalues and eigenvectors of layer l with respect to ka and ks. The extinction is ka + ks
+        # and the phase matrix is assumed to be proportional to ks (the shape of the phase function is unchanged).
+        #
+        # :returns: dbeta_ka, dbeta_ks, dE_ka, dE_ks (dE are None for a non-scattering layer)
+
+        npol = 2 if m == 0 else 3
+
+        invmu = np.repeat(1.0 / mu, npol)
+        invmu = np.concatenate((invmu, -invmu))
+
+        A = compute_eigenvalue_matrix(m, self.ke[l], self.ft_even_phase[l], mu, weight)
+
+        if A is None:
+            # non-scattering layer, E is the identity
+            return invmu, invmu, None, None
+
+        ks = getattr(self.emmodels[l], "ks", None)
+        if ks is None:
+            raise SMRTError("The Jacobian requires the emmodels to provide the scattering coefficient (ks attribute)")
+
+        ke = np.repeat(self.ke[l](np.concatenate((mu, -mu))), npol)
+        dA_ks = A - np.diag(invmu * ke)  # scattering part of A
+        dA_ks = dA_ks / ks if ks > 0 else np.zeros_like(dA_ks)
+        dA_ks[np.diag_indices(len(A))] += invmu
+
+        dbeta_ka, dE_ka = eigenvalue_derivatives(beta, E, invmu[:, np.newaxis] * E)
+        dbeta_ks, dE_ks = eigenvalue_derivatives(beta, E, np.dot(dA_ks, E))
+
+        return dbeta_ka, dbeta_ks, dE_ka, dE_ks
+
+
+def check_viewing_angles(mu, outmu, exact_angles=False):
+    #"""raise an error if the cosines of the viewing angles mu are outside the range of the streams in the air outmu"""
+    if not exact_angles and (min(mu) < min(outmu) or max(mu) > max(outmu)):
+        raise SMRTError("viewing zenith angle is outside the range of stream angles computed by DORT. Increase the number of streams or change your viewing zenith angle range. In the future it will be possible to explicitly force the extrapolation.")
+
+
+def interpolate_streams(intensity, outmu, mu, npol, exact_angles=False):
+    #"""interpolate the intensity (first dimension: streams in the air and polarizations) at the cosines of the viewing angles mu.
+    # Returns an array with the viewing angles and the polarizations as first dimensions"""
+
+    # reshape the first dimension in two dimensions (theta, pola)
+    intensity = intensity.reshape([intensity.shape[0]//npol, npol]+list(intensity.shape[1:]))
+
+    if exact_angles:
+        # the viewing angles are streams, no interpolation is needed
+        return intensity[np.argmin(np.abs(outmu[np.newaxis, :] - mu[:, np.newaxis]), axis=1)]
+
+    # reverse is necessary for "old" scipy version
+    intfct = scipy.interpolate.interp1d(outmu[::-1], intensity[::-1, :, ...], axis=0)  # could use fill_value to be smart about extrapolation, but it's safer to return NaN (default)
+
+    # it seems there is a bug in scipy at least when checking the boundary, mu must be sorted, outmu does not !
+    i = np.argsort(mu)
+
+    # original that should work: intensity = intfct(mu)
+    return intfct(mu[i])[np.argsort(i)]  # mu[i] sort mu, and [np.argsort(i)] put in back
+
+
+def boundary_blocks(Eu, Ed, transt, transb, Rtop, Rbottom, Tbottom=None, Ttop=None):
+    #"""return the blocks of the boundary condition matrix in the columns of a layer: top and bottom of the layer, top of the layer
+    # below and bottom of the layer above. The blocks are linear in the eigenvectors and in the transmittances. Tbottom and Ttop are
+    # the tuples (transmission matrix, number of rows) or None when there is no layer below or above."""
+
+    blocks = [(Ed - matmul(Rtop, Eu)) * transt, (Eu - matmul(Rbottom, Ed)) * transb, None, None]
+
+    if Tbottom is not None:
+        T, ns = Tbottom
+        blocks[2] = - matmul(T, Ed[0:ns, :]) * transb
+
+    if Ttop is not None:
+        T, ns = Ttop
+        blocks[3] = - matmul(T, Eu[0:ns, :]) * transt
+
+    return blocks
+
+
+def dort_modem_adjoint(g, boundary_system, rhs, dI1up, Eu_transt_0, Ttop_0, nout):
+    #"""return the gradient (parameter, layer) of a cost with respect to ka, ks and the thickness of the layers given the
+    # gradient g of the cost with respect to the upwelling intensity in the air. The other arguments are the state saved by
+    # dort_modem_banded. The adjoint of the boundary system is solved once, with the transposed factorization, whatever
+    # the number of layers."""
+
+    n0 = Ttop_0.shape[0] if not np.isscalar(Ttop_0) else len(dI1up)
+
+    # adjoint of I0up = Ttop_0 I1up (the first nout rows) and of I1up = Eu_0 transt_0 x
+    g_full = np.zeros(n0)
+    g_full[0:nout] = g
+    h = matmul(Ttop_0.T if not np.isscalar(Ttop_0) else Ttop_0, g_full[:, np.newaxis])[:, 0]
+
+    c = np.zeros(len(rhs))
+    c[0:Eu_transt_0.shape[1]] = np.dot(Eu_transt_0.T, h)
+
+    adjoint = boundary_system.solve(c, trans=True)
+
+    return np.tensordot(adjoint, rhs, axes=1) + np.tensordot(h, dI1up, axes=1)
+
+
+def eigenvalue_derivatives(beta, E, dAE):
+    #"""return the derivatives of the eigenvalues beta and eigenvectors E (A E = E diag(beta)) for a perturbation dA of A, given
+    # the product dA E. The derivatives of the eigenvectors are taken without component along the eigenvector itself, which is
+    # allowed because the solution does not depend on the normalization of the eigenvectors."""
+
+    Q = np.linalg.solve(E, dAE)
+
+    dbeta = np.diag(Q).copy()
+
+    dif = beta[np.newaxis, :] - beta[:, np.newaxis]
+    degenerated = np.abs(dif) <= 1e-10 * np.max(np.abs(beta))  # including the diagonal
+    C = Q / np.where(degenerated, 1, dif)
+    C[degenerated] = 0
+
+    return dbeta.real, np.dot(E, C).real
+
+
+# The boundary systems are private classes: import_class takes the first class of the module (in alphabetical order) as the solver.
+
+class _NonDiagonalInterface(Exception):
+    # """raised when an interface or substrate matrix is not diagonal in the batched solution"""
+    pass
+
+
+class _BandedBoundarySystem(object):
+    # """Boundary condition system stored in the LAPACK banded format and solved with the LAPACK gbtrf/gbtrs routines.
+    #
+    # :param n_stream: number of streams in each layer
+    # :param npol: number of polarizations
+    # :param workspace: Workspace instance providing the band storage or None
+    # :param nbatch: number of independent systems with the same structure (e.g. one per snowpack) or None for a single system.
+    #     The systems are placed along the diagonal of a single banded matrix, which keeps the same bandwidth, and solved with a
+    #     single LAPACK call. The blocks are then given as stacks with the system as first dimension.
+    # """
+
+    def __init__(self, n_stream, npol, workspace=None, nbatch=None):
+        self.nbatch = nbatch
+        self.nboundary_system = sum(n_stream) * 2 * npol
+        self.nboundary = self.nboundary_system if nbatch is None else nbatch * self.nboundary_system
+        self.nband = 3 * npol * np.max(n_stream)  # each layer appears in 3 blocks
+        # (bottom, top of the current layer, and top of layer below (for downward directons) and
+        # bottom of the layer above (for upward directions)
+
+        # the dense blocks and their position. They are inserted at once in the band storage
+        self.block_positions = list()
+        self.blocks = list()
+        self.lu = None  # LU factorization, computed at the first solve
+        self.workspace = workspace
+
+    def add_block(self, ij, block):
+        # """add the dense block (or the stack of blocks, one per system) at the position ij=(row, column) of the matrix"""
+        self.block_positions.append(ij)
+        self.blocks.append(block)
+
+    def fill_band(self, bmat):
+        # """insert the blocks in the band storage"""
+        if self.nbatch is None:
+            todiag_blocks(bmat, self.block_positions, self.blocks)
+        else:
+            todiag_batch_blocks(bmat, self.block_positions, self.blocks, self.nboundary_system)
+
+    def banded_matrix(self):
+        # """return the matrix in the banded format"""
+        bBC = np.zeros((2*self.nband+1, self.nboundary))  # we use banded Boundary condition matrix
+        self.fill_band(bBC)
+        return bBC
+
+    def solve(self, b, trans=False):
+        # """solve the system (or the transposed system if trans is True) for the right-hand side(s) b. The LU factorization is
+        # computed at the first call and reused for the next right-hand sides (e.g. by the tangent-linear and adjoint
+        # computations). b is overwritten."""
+
+        if self.lu is None:
+            # LAPACK gbtrf requires nband additional rows at the top of the band storage for the fill-in
+            shape = (3*self.nband+1, self.nboundary)
+            ab = self.workspace.zeros("ab", shape, order='F') if self.workspace is not None else np.zeros(shape, order='F')
+            self.fill_band(ab[self.nband:])
+            self.lu, self.piv, info = scipy.linalg.lapack.dgbtrf(ab, self.nband, self.nband, overwrite_ab=True)
+            if info > 0:
+                raise np.linalg.LinAlgError("singular boundary condition matrix")
+
+        x, info = scipy.linalg.lapack.dgbtrs(self.lu, self.nband, self.nband, b, self.piv, trans=1 if trans else 0, overwrite_b=True)
+        return x
+
+
+class _BlockTridiagonalBoundarySystem(object):
+    # """Boundary condition system stored as blocks and solved with the block Thomas algorithm. The unknowns of layer l only appear
+    # in the equations of the interfaces at the top and bottom of layer l, so that the matrix is block-tridiagonal with one block row
+    # and column per layer. The cost is linear in the number of layers and does not depend on the widest layer coupling as the
+    # banded solver does.
+    #
+    # :param n_stream: number of streams in each layer
+    # :param npol: number of polarizations
+    # :param workspace: Workspace instance providing the blocks or None
+    # """
+
+    def __init__(self, n_stream, npol, workspace=None):
+        sizes = 2 * np.array(n_stream) * npol
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+        self.nlayer = len(sizes)
+
+        def zeros(name, k, shape):
+            return workspace.zeros((name, k), shape) if workspace is not None else np.zeros(shape)
+
+        self.diagonal = [zeros("diagonal", k, (sizes[k], sizes[k])) for k in range(self.nlayer)]
+        self.lower = [None] + [zeros("lower", k, (sizes[k], sizes[k-1])) for k in range(1, self.nlayer)]
+        self.upper = [zeros("upper", k, (sizes[k], sizes[k+1])) for k in range(self.nlayer - 1)] + [None]
+
+        # rows of the off-diagonal blocks that are not null
+        self.lower_rows = [(0, 0)] * self.nlayer
+
+        self.lu = None  # LU factorizations of the diagonal blocks after elimination, computed at the first solve
+
+    def add_block(self, ij, block):
+        # """add the dense block at the position ij=(row, column) of the matrix"""
+        i, j = ij
+        k = np.searchsorted(self.offsets, i, side='right') - 1  # block row
+        kc = np.searchsorted(self.offsets, j, side='right') - 1  # block column
+        i -= self.offsets[k]
+        j -= self.offsets[kc]
+        n, m = block.shape
+
+        if kc == k:
+            self.diagonal[k][i:i+n, j:j+m] = block
+        elif kc == k - 1:
+            self.lower[k][i:i+n, j:j+m] = block
+            r0, r1 = self.lower_rows[k]
+            self.lower_rows[k] = (i, i+n) if r0 == r1 else (min(r0, i), max(r1, i+n))
+        elif kc == k + 1:
+            self.upper[k][i:i+n, j:j+m] = block
+        else:
+            raise SMRTError("The boundary condition matrix is not block-tridiagonal")
+
+    def factorize(self):
+        # """eliminate the lower blocks and factorize the diagonal blocks"""
+
+        self.lu = [None] * self.nlayer
+        self.C = [None] * self.nlayer  # D_k^-1 U_k
+
+        for k in range(self.nlayer):
+            D = self.diagonal[k]
+
+            if k > 0:
+                # only the non-null rows of the lower block are used
+                r0, r1 = self.lower_rows[k]
+                D[r0:r1] -= np.dot(self.lower[k][r0:r1], self.C[k-1])
+
+            self.lu[k] = scipy.linalg.lu_factor(D, overwrite_a=True)
+            if k < self.nlayer - 1:
+                self.C[k] = scipy.linalg.lu_solve(self.lu[k], self.upper[k])
+
+    def solve(self, b, trans=False):
+        # """solve the system for the right-hand side(s) b with the block Thomas algorithm. The factorization is computed at the
+        # first call and reused for the next right-hand sides. b is overwritten."""
+
+        if self.lu is None:
+            self.factorize()
+
+        if trans:
+            return self.solve_transposed(b)
+
+        # forward elimination
+        y = [None] * self.nlayer
+
+        for k in range(self.nlayer):
+            bk = b[self.offsets[k]:self.offsets[k+1]]
+
+            if k > 0:
+                r0, r1 = self.lower_rows[k]
+                bk[r0:r1] -= np.dot(self.lower[k][r0:r1], y[k-1])
+
+            y[k] = scipy.linalg.lu_solve(self.lu[k], bk)
+
+        # back substitution
+        x = np.empty_like(b)
+        xk = y[-1]
+        x[self.offsets[-2]:] = xk
+        for k in range(self.nlayer - 2, -1, -1):
+            xk = y[k] - np.dot(self.C[k], xk)
+            x[self.offsets[k]:self.offsets[k+1]] = xk
+
+        return x
+
+    def solve_transposed(self, b):
+        # """solve the transposed system. The factorization BC = L U, with L block lower bidiagonal (diagonal blocks D_k after
+        # elimination and the lower blocks) and U block upper bidiagonal (identity and C_k), gives BC^T = U^T L^T."""
+
+        # forward substitution with U^T
+        w = [None] * self.nlayer
+        for k in range(self.nlayer):
+            w[k] = b[self.offsets[k]:self.offsets[k+1]]
+            if k > 0:
+                w[k] = w[k] - np.dot(self.C[k-1].T, w[k-1])
+
+        # backward substitution with L^T
+        x = np.empty_like(b)
+        for k in range(self.nlayer - 1, -1, -1):
+            wk = w[k]
+            if k < self.nlayer - 1:
+                r0, r1 = self.lower_rows[k+1]
+                wk = wk - np.dot(self.lower[k+1][r0:r1].T, x[self.offsets[k+1]+r0:self.offsets[k+1]+r1])
+            x[self.offsets[k]:self.offsets[k+1]] = scipy.linalg.lu_solve(self.lu[k], wk, trans=1)
+
+        return x
+
+
+boundary_systems = {"banded": _BandedBoundarySystem, "block_tridiagonal": _BlockTridiagonalBoundarySystem}
+
+
+def matmul(x, y):
+    #"""matrix product of x (scalar, sparse matrix or dense matrix) and the 2D array y. Diagonal sparse matrices are
+    # applied by broadcasting. Returns an ndarray."""
+    if np.isscalar(x):
+        return x * y
+    if scipy.sparse.isspmatrix_dia(x) and np.all(x.offsets == 0):
+        return x.diagonal()[:, np.newaxis] * y
+    return np.asarray(x.dot(y))
+
+
+def matrix_diagonal(x, n):
+    #"""return the diagonal of the (n x n) matrix x or None if x is not diagonal. A scalar x is taken as x * identity"""
+    if np.isscalar(x):
+        return np.full(n, x, dtype=np.float64)
+
+    d = np.asarray(x.diagonal()).ravel()
+    if scipy.sparse.issparse(x):
+        offdiagonal = (x - scipy.sparse.diags(d, 0)).count_nonzero()
+    else:
+        offdiagonal = np.count_nonzero(np.asarray(x) - np.diag(d))
+
+    return d if offdiagonal == 0 else None
+
+
+_diagonal_option_cache = dict()
+
+
+def has_diagonal_option(f):
+    #"""return True if the function f (method of an interface or substrate) accepts the return_as_diagonal argument. The result is memoized"""
+
+    try:
+        return _diagonal_option_cache[f]
+    except KeyError:
+        pass
+
+    try:
+        parameters = inspect.signature(f).parameters
+    except AttributeError:
+        parameters = inspect.getargspec(f).args  # python 2
+
+    _diagonal_option_cache[f] = "return_as_diagonal" in parameters
+    return _diagonal_option_cache[f]
+
 
 def muleye(x):
     #"""multiply x * 1v """
@@ -451,21 +1605,72 @@ def muleye(x):
 
 def todiag(bmat, ij, dmat):
     #"""insert the small dense dmat matrix in the diagonal bmat matrix"""
-    oi, oj = ij
+    todiag_blocks(bmat, [ij], [dmat])
+
+
+def todiag_blocks(bmat, ijs, dmats):
+    #"""insert the small dense dmats matrices at the positions ijs in the diagonal bmat matrix"""
+
+    shapes = tuple(np.shape(dmat) for dmat in dmats)
+    rows, cols, select = band_indices(bmat.shape[0], tuple((int(oi), int(oj)) for oi, oj in ijs), shapes)
+
+    values = np.concatenate([np.asarray(dmat).ravel() for dmat in dmats])
+    bmat[rows, cols] = values if select is None else values[select]
+
+
+def todiag_batch_blocks(bmat, ijs, dmats, stride):
+    #"""insert the stacks of small dense matrices dmats (system x rows x columns) at the positions ijs of each system in the diagonal
+    # bmat matrix. The systems are placed every stride rows and columns along the diagonal"""
+
+    nbatch = len(dmats[0])
+    shapes = tuple(np.shape(dmat)[1:] for dmat in dmats)
+    rows, cols, select = band_indices(bmat.shape[0], tuple((int(oi), int(oj)) for oi, oj in ijs), shapes)
 
-    u = (bmat.shape[0]-1) // 2
-    l = u  # special case here
+    values = np.concatenate([np.asarray(dmat).reshape(nbatch, -1) for dmat in dmats], axis=1)
+    if select is not None:
+        values = values[:, select]
 
-    n, m = dmat.shape
-    df = np.array(dmat).flatten('C')
+    # the position in the band storage of an element shifted along the diagonal only changes the column
+    bmat[rows[np.newaxis, :], cols[np.newaxis, :] + stride * np.arange(nbatch)[:, np.newaxis]] = values
 
-    for j in range(0, min(u+1, m)):
-        ldiag = min(n, m-j)
-        bmat[u+oi-oj-j, j+oj:j+oj+ldiag] = df[j::m+1][:ldiag]
 
-    for i in range(1, min(l+1, n)):
-        ldiag = min(n-i, m)
-        bmat[u+oi-oj+i, 0+oj:0+oj+ldiag] = df[i*m::m+1][:ldiag]
+_band_indices_cache = dict()
+
+
+def band_indices(nrow_band, ijs, shapes):
+    #"""return the row and column indices in the banded storage of the elements of the blocks of given shapes at the positions ijs,
+    # and the selection of the elements within the band (None if all are). The results are cached as the same structure
+    # (same n_stream profile and npol) is used for every mode and every call."""
+
+    key = (nrow_band, ijs, shapes)
+    try:
+        return _band_indices_cache[key]
+    except KeyError:
+        pass
+
+    u = (nrow_band - 1) // 2  # number of upper (= lower) diagonals
+
+    rows, cols = list(), list()
+    for (oi, oj), (n, m) in zip(ijs, shapes):
+        i = np.arange(n)[:, np.newaxis]
+        j = np.arange(m)[np.newaxis, :]
+        rows.append((u + oi - oj + i - j).ravel())  # the element (oi+i, oj+j) is stored at row u+(oi+i)-(oj+j) in the band storage
+        cols.append(np.broadcast_to(oj + j, (n, m)).ravel())
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+
+    select = (rows >= 0) & (rows < nrow_band)
+    if np.all(select):
+        select = None
+    else:
+        rows, cols, select = rows[select], cols[select], np.flatnonzero(select)
+
+    if len(_band_indices_cache) > 256:
+        _band_indices_cache.clear()  # simple bound of the memory usage
+    _band_indices_cache[key] = rows, cols, select
+
+    return rows, cols, select
 
 
 def extend_2pol_npol(x, npol):
@@ -500,13 +1705,234 @@ def solve_eigenvalue_problem(m, ke, ft_even_phase, mu, weight):
     # :param mu: cosines
     # :param weight: weights
 
-    # :returns: alpha, E, Q
+    # :returns: beta, Eu, Ed
     #"""
-    nsk = len(mu)
 
     npol = 2 if m == 0 else 3
+    n = npol * len(mu)
+
+    A = compute_eigenvalue_matrix(m, ke, ft_even_phase, mu, weight)
+
+    if A is None:
+        beta, E = nonscattering_eigenvalue_solution(m, ke, mu)
+    else:
+        # diagonalise the matrix. Use the up/down symmetry to solve a problem of half size when possible
+        beta, E = solve_reduced_eigenvalue_problem(A, n, npol)
+
+        if beta is None:
+            # the reduced problem is not applicable or ill-conditioned, diagonalise the full matrix. Eq (13)
+            beta, E = solve_full_eigenvalue_problem(A, n)
+
+    Eu = E[0:n, :]  # upwelling
+    Ed = E[n:, :]  # downwelling
+
+    return beta, Eu, Ed
+    # !-----------------------------------------------------------------------------!
+
+
+def solve_eigenvalue_problems(m, ke, ft_even_phase, mu, weight, n_stream, max_batch_size=16, cache=None):
+    # """solve the homogeneous equation for all the layers of a snowpack. The layers with the same number of streams are
+    # diagonalised together with a batched call to reduce the overhead of the python loop and LAPACK calls.
+    #
+    # :param m: mode
+    # :param ke: list of extinction coefficient functions of the layers
+    # :param ft_even_phase: list of ft_even_phase functions of the layers (or None)
+    # :param mu: cosines (nlayer x n_max_stream array)
+    # :param weight: weights (nlayer x n_max_stream array)
+    # :param n_stream: number of streams in each layer
+    # :param max_batch_size: maximum number of matrices diagonalised together. Limits the memory usage.
+    # :param cache: :py:class:`EigenvalueCache` instance (optional). Only the layers not found in the cache are diagonalised.
+    #
+    # :returns: list of (beta, Eu, Ed) for each layer
+    #"""
+
+    npol = 2 if m == 0 else 3
+    nlayer = len(ke)
+
+    solutions = [None] * nlayer
+
+    # group the layers by number of streams
+    groups = dict()
+    for l in range(nlayer):
+        groups.setdefault(n_stream[l], []).append(l)
+
+    for nsl, layers in groups.items():
+        n = npol * nsl
+
+        for i in range(0, len(layers), max_batch_size):
+            batch = list()  # layers to diagonalise
+            matrices = list()
+            keys = list()
+
+            for l in layers[i:i+max_batch_size]:
+                A = compute_eigenvalue_matrix(m, ke[l], ft_even_phase[l], mu[l, 0:nsl], weight[l, 0:nsl])
+
+                if A is None:
+                    beta, E = nonscattering_eigenvalue_solution(m, ke[l], mu[l, 0:nsl])
+                    solutions[l] = beta, E[0:n, :], E[n:, :]
+                    continue
+
+                if cache is not None:
+                    # the matrix A depends on m, ke, the phase matrix, mu and weight. It is used as the key.
+                    key = cache.key(m, A)
+                    solutions[l] = cache.get(key)
+                    if solutions[l] is not None:
+                        continue
+                    keys.append(key)
+
+                batch.append(l)
+                matrices.append(A)
+
+            if not batch:
+                continue
+
+            matrices = np.array(matrices)
+            beta, E, valid = solve_reduced_eigenvalue_problems(matrices, n, npol)
+
+            for k, l in enumerate(batch):
+                if valid[k]:
+                    solutions[l] = beta[k], E[k, 0:n, :], E[k, n:, :]
+                else:
+                    # the reduced problem is not applicable or ill-conditioned for this layer, diagonalise the full matrix
+                    beta_l, E_l = solve_full_eigenvalue_problem(matrices[k], n)
+                    solutions[l] = beta_l, E_l[0:n, :], E_l[n:, :]
+
+                if cache is not None:
+                    cache.set(keys[k], solutions[l])
 
-    n = npol*nsk
+    return solutions
+
+
+class Workspace(object):
+    """Pool of preallocated arrays used by DORT for the boundary system (matrix and right-hand sides). An array is reused when
+    the requested size is not larger than the allocated one, so that the memory is allocated once for a series of simulations.
+    Each thread has its own arrays (see DORT parallel_modes), they are released when the thread ends. The same instance can be
+    given to several DORT solvers.
+
+"""
+
+    def __init__(self):
+        self.allocations = 0  # number of arrays allocated, for information
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # the arrays are not worth pickling and the thread local storage can not be pickled
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def zeros(self, name, shape, order='C'):
+        """return an array of zeros of the given shape. The array is a view on the buffer `name` of the current thread and is
+        valid until the next request of the same name."""
+
+        buffers = self._local.__dict__.setdefault('buffers', dict())
+        size = int(np.prod(shape))
+
+        buffer = buffers.get(name)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size)
+            buffers[name] = buffer
+            self.allocations += 1
+
+        array = buffer[:size].reshape(shape, order=order)
+        array.fill(0)
+        return array
+
+    def clear(self):
+        """release the arrays of the current thread"""
+        self._local.__dict__.pop('buffers', None)
+
+
+class EigenvalueCache(object):
+    """Size-bounded cache (least recently used) of the eigenvalue solutions of the layers used by DORT. The same instance can be
+    given to several DORT solvers to share the solutions between the calls, e.g. for time series where only the top layers change.
+
+    :param maxsize: maximum number of solutions stored.
+
+"""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # the cache can be used by several threads (see DORT parallel_modes)
+
+    def __getstate__(self):
+        # the lock can not be pickled (e.g. to send the cache to another process)
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def key(self, m, A):
+        """return the key for the matrix A of mode m. The matrix A of the homogeneous equation depends on the mode, the extinction, the
+        phase matrix, the cosines and the weights. A digest of this matrix is used as a fingerprint."""
+
+        A = np.ascontiguousarray(A)
+        return (m, A.shape, hashlib.sha1(A.view(np.uint8)).hexdigest())
+
+    def get(self, key):
+        """return the solution (beta, Eu, Ed) for the key or None if it is not in the cache."""
+
+        with self._lock:
+            try:
+                solution = self._cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self._cache[key] = solution  # move at the end (most recently used)
+            self.hits += 1
+            return solution
+
+    def set(self, key, solution):
+        """store the solution (beta, Eu, Ed). The arrays are copied (they may be views on larger arrays) and made read-only as
+        they are shared."""
+
+        solution = tuple(np.array(x) for x in solution)
+        for x in solution:
+            x.flags.writeable = False
+
+        with self._lock:
+            self._cache[key] = solution
+
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)  # remove the least recently used
+
+    def clear(self):
+        """remove all the solutions and reset the counters."""
+
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __repr__(self):
+        return "EigenvalueCache(maxsize=%i, size=%i, hits=%i, misses=%i)" % (self.maxsize, len(self), self.hits, self.misses)
+
+
+def compute_eigenvalue_matrix(m, ke, ft_even_phase, mu, weight):
+    # """compute the matrix of the homogeneous equation for a single layer. Eq (12)
+    #
+    # :returns: the (2n x 2n) matrix or None if the layer is not scattering
+    #"""
+
+    if ft_even_phase is None:
+        # special case (important for the coherency)
+        return None
+
+    npol = 2 if m == 0 else 3
 
     # this coefficient comme from the 1/4pi normalization of the RT equation
     coef = 0.5 if m == 0 else 0.25
@@ -517,84 +1943,231 @@ def solve_eigenvalue_problem(m, ke, ft_even_phase, mu, weight):
     invmu = np.concatenate((invmu, -invmu))
     mu = np.concatenate((mu, -mu))
 
-    if ft_even_phase is None:
-        # special case (important for the coherency)
-        beta = invmu * np.repeat(ke(mu), npol)
-        E = np.eye(2*n, 2*n)  # TODO: test with a sparse matrix if more performant
+    # calculate the A matrix. Eq (12)
+    A = ft_even_phase(m, mu)
+
+    if (np.isscalar(A) and A == 0) or not np.any(A):
+        # no scattering for this mode (e.g. emmodel returning a null phase matrix), the solution is trivial
+        return None
+
+    weight = np.tile(np.repeat(-coef * weight, npol), 2)    # could be cached (per layer) because same for each mode
+    A = A * weight[np.newaxis, :]  # not in-place, the emmodels may return a cached phase matrix
+    A[np.diag_indices(len(A))] += np.repeat(ke(mu), npol)
+    A = invmu[:, np.newaxis] * A
+
+    return A
+
+
+def is_nonscattering(emmodel, albedo_threshold=0):
+    # """return True if the single scattering albedo of the emmodel is smaller than or equal to albedo_threshold. The emmodels
+    # without ka and ks attributes are considered as scattering."""
+
+    ks = getattr(emmodel, "ks", None)
+    ka = getattr(emmodel, "ka", None)
+    if ks is None or ka is None or np.ndim(ks) > 0 or np.ndim(ka) > 0:
+        return False
+
+    return ks <= albedo_threshold * (ka + ks)
+
+
+def nonscattering_eigenvalue_solution(m, ke, mu):
+    # """return the trivial solution of the homogeneous equation for a non-scattering layer
+    #
+    # :returns: beta, E
+    #"""
+
+    npol = 2 if m == 0 else 3
+
+    invmu = 1.0 / mu
+    invmu = np.repeat(invmu, npol)
+    invmu = np.concatenate((invmu, -invmu))
+    mu = np.concatenate((mu, -mu))
+
+    beta = invmu * np.repeat(ke(mu), npol)
+    E = np.eye(len(beta), len(beta))  # TODO: test with a sparse matrix if more performant
+
+    return beta, E
+
+
+def solve_full_eigenvalue_problem(A, n):
+    # """diagonalise the full (2n x 2n) matrix A of a layer
+    #
+    # :returns: beta, E sorted as expected by dort_modem_banded
+    # """
+
+    try:
+        beta, E = scipy.linalg.eig(A, overwrite_a=True)
+    except scipy.linalg.LinAlgError:
+        raise_diagonalization_error("the eig method did not converge")
+
+    if not np.allclose(beta.imag, 0) or not np.allclose(E.imag, 0):
+        raise_diagonalization_error("complex eigenvalues or eigenvectors, the largest imaginary part is %g" %
+                                    max(np.max(np.abs(beta.imag)), np.max(np.abs(E.imag))))
+
+    beta = beta.real
+    #E = E.real
+
+    # get the positive and negative beta
+    # this should be improve a the mathematical level because there is no need to solve
+    # the eigenvalue for + and - well according to inverse optical path equivalent,
+    # the + and - should be equal
+
+    # debub only
+    if True:
+        idx2 = np.argsort(beta)
+        idx2[0:n] = idx2[0:n][::-1]
+        beta = beta[idx2]
+        E = E[:, idx2]
+
+    return beta, E
+
+
+def solve_reduced_eigenvalue_problem(A, n, npol):
+    # """diagonalise the (2n x 2n) matrix A of a layer using the up/down symmetry. See :py:func:`solve_reduced_eigenvalue_problems`.
+    #
+    # :returns: beta, E sorted as expected by dort_modem_banded or None, None if the matrix does not have the expected symmetry or
+    # the reduced problem is ill-conditioned.
+    # """
+
+    beta, E, valid = solve_reduced_eigenvalue_problems(A[np.newaxis, :, :], n, npol)
+
+    if valid[0]:
+        return beta[0], E[0]
     else:
-        # calculate the A matrix. Eq (12)
+        return None, None
+
+
+def solve_reduced_eigenvalue_problems(A, n, npol):
+    # """diagonalise a stack of (2n x 2n) matrices A using the up/down symmetry of the discrete ordinate system (as in DISORT, Stamnes et al. 1988).
+    #
+    # With D=diag(1, 1, -1) for each stream (the third Stokes component changes sign when the directions are reversed) the matrix has the structure
+    # A = [[a, b], [-D b D, -D a D]]. The eigenvalues are +-sqrt of the eigenvalues of the (n x n) product (a - bD) (a + bD) and the eigenvectors are
+    # deduced from those of the product. This requires about 8 times less operations than the full problem.
+    #
+    # :param A: (k x 2n x 2n) array
+    # :returns: beta, E sorted as expected by dort_modem_banded and a boolean array indicating for each matrix whether the matrix has the
+    # expected symmetry and the reduced problem is well-conditioned. beta and E are meaningless where this array is False.
+    # """
 
-        A = ft_even_phase(m, mu)
+    a = A[:, 0:n, 0:n]
+    b = A[:, 0:n, n:]
 
-        if A is 0:
-            beta = invmu * np.repeat(ke(mu), npol)
-            E = np.eye(2*n, 2*n)  # TODO: test with a sparse matrix if more performant
-        else:
-            # solve the eigen value problem
-            weight = np.tile(np.repeat(-coef * weight, npol), 2)    # could be cached (per layer) because same for each mode
-            A *= weight[np.newaxis, :]
-            A[np.diag_indices(2*n)] += np.repeat(ke(mu), npol)
-            A = invmu[:, np.newaxis] * A
+    if npol == 3:
+        d = np.tile([1., 1., -1.], n // 3)
+        bd = b * d[np.newaxis, np.newaxis, :]
+        mdad = -d[np.newaxis, :, np.newaxis] * a * d[np.newaxis, np.newaxis, :]
+        mdbd = -d[np.newaxis, :, np.newaxis] * bd
+    else:
+        d = None
+        bd = b
+        mdad = -a
+        mdbd = -b
+
+    def isclose(x, y):  # same as np.allclose, for each matrix of the stack
+        return np.all(np.abs(x - y) <= 1e-8 + 1e-5 * np.abs(y), axis=(1, 2))
+
+    valid = isclose(A[:, n:, n:], mdad) & isclose(A[:, n:, 0:n], mdbd)
+
+    apb = a + bd
+
+    try:
+        beta2, S = np.linalg.eig(np.matmul(a - bd, apb))
+    except np.linalg.LinAlgError:
+        return None, None, np.zeros(len(A), dtype=bool)
+
+    # the eigenvalues of the product are the square of beta. They must be real and positive and not too close to zero
+    # otherwise the recovery of the eigenvectors is inaccurate.
+    scale = np.max(np.abs(beta2), axis=1)[:, np.newaxis]
+    valid &= ~np.any(np.abs(beta2.imag) > 1e-8 * scale, axis=1)
+    valid &= ~np.any(beta2.real <= 1e-8 * scale, axis=1)
+    valid &= ~np.any(np.abs(S.imag) > 1e-8, axis=(1, 2))
+
+    beta2 = beta2.real
+    S = S.real
+
+    i = np.argsort(beta2, axis=1)
+    k = np.arange(len(A))
+    beta2 = beta2[k[:, np.newaxis], i]
+    S = S[k[:, np.newaxis, np.newaxis], np.arange(n)[np.newaxis, :, np.newaxis], i[:, np.newaxis, :]]
+    beta = np.sqrt(np.maximum(beta2, 0))
+
+    # recover the half-sum and half-difference of the upwelling and downwelling components
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Dif = np.matmul(apb, S) / beta[:, np.newaxis, :]
+    X = 0.5 * (S + Dif)
+    Y = 0.5 * (S - Dif)
+    if d is not None:
+        DX = d[np.newaxis, :, np.newaxis] * X
+        DY = d[np.newaxis, :, np.newaxis] * Y
+    else:
+        DX, DY = X, Y
 
-            # diagonalise the matrix. Eq (13)
-            try:
-                beta, E = scipy.linalg.eig(A, overwrite_a=True)
-            except scipy.linalg.LinAlgError:
-                diagonalization_failed = True
-                reason = "eig method"
-            else:
-                diagonalization_failed = (not np.allclose(beta.imag, 0)) or (not np.allclose(E.imag, 0))
-                if diagonalization_failed:
-                    print(np.allclose(beta.imag, 0), np.allclose(E.imag, 0))
-                    print(np.max(np.abs(E.imag)))
-                reason = "not close"
+    # negative beta first, sorted by increasing absolute value, then positive beta
+    E = np.empty((len(A), 2*n, 2*n))
+    E[:, 0:n, 0:n] = Y
+    E[:, n:, 0:n] = DX
+    E[:, 0:n, n:] = X
+    E[:, n:, n:] = DY
 
-            if diagonalization_failed:
+    return np.concatenate((-beta, beta), axis=1), E, valid
 
-                raise SMRTError("""The diagonalization failed in DORT which is possibly caused by single scattering albedo larger than 1.
+
+def raise_diagonalization_error(reason=None):
+
+    raise SMRTError("""The diagonalization failed in DORT which is possibly caused by single scattering albedo larger than 1.
 It is often due to grain size too large (or too low stickiness parameter) to respect the Rayleigh/low-frequency assumption required by some ememodel (DMRT ShortRange, IBA, ...)"
-It is recommended to reduce the size of the bigger grains.""")
+It is recommended to reduce the size of the bigger grains.""" + ("" if reason is None else "\nReason: %s." % reason))
 
-            #np.testing.assert_allclose(beta.imag, 0, atol=np.linalg.norm(beta)*1e-5)
 
-            if np.iscomplexobj(E):
-                mask = abs(E.imag)>np.linalg.norm(E)*1e-5
-                if np.any(mask):
-                    print(np.any(mask, axis=1))
-                    print(beta[np.any(mask, axis=1)])
-                    print(beta)
+_stream_geometry_cache = dict()
 
-            #np.testing.assert_allclose(E.imag, 0, atol=np.linalg.norm(E)*1e-5)
 
-            beta = beta.real
-            #E = E.real
+def compute_stream(n_max_stream, permittivity, permittivity_substrate, user_outmu=None, tolerance=1e-12):
+    #     """Compute the optimal angles of each layer (see :py:func:`compute_stream_geometry`). The geometry only depends on
+    # the permittivity profile and is memoized, the permittivities being rounded to the relative tolerance to build the key. The
+    # returned arrays are shared and read-only.
+    # """
 
-            # get the positive and negative beta
-            # this should be improve a the mathematical level because there is no need to solve
-            # the eigenvalue for + and - well according to inverse optical path equivalent,
-            # the + and - should be equal
+    digits = max(int(np.ceil(-np.log10(tolerance))), 1)  # number of significant digits
 
-            # debub only
-            if True:
-                idx2 = np.argsort(beta)
-                idx2[0:n] = idx2[0:n][::-1]
-                beta = beta[idx2]
-                E = E[:, idx2]
+    def rounded(x):
+        return complex(float('%.*g' % (digits, np.real(x))), float('%.*g' % (digits, np.imag(x))))
 
-    Eu = E[0:n, :]  # upwelling
-    Ed = E[n:, :]  # downwelling
+    permittivity = tuple(rounded(eps) for eps in permittivity)
+    if permittivity_substrate is not None:
+        permittivity_substrate = rounded(permittivity_substrate)
+    if user_outmu is not None:
+        user_outmu = tuple(np.round(np.atleast_1d(user_outmu), digits))
 
-    return beta, Eu, Ed
-    # !-----------------------------------------------------------------------------!
+    key = (n_max_stream, permittivity, permittivity_substrate, user_outmu)
+    try:
+        return _stream_geometry_cache[key]
+    except KeyError:
+        pass
+
+    geometry = compute_stream_geometry(n_max_stream, np.array(permittivity), permittivity_substrate,
+                                       user_outmu=None if user_outmu is None else np.array(user_outmu))
+    for x in geometry:
+        if isinstance(x, np.ndarray):
+            x.flags.writeable = False
+
+    if len(_stream_geometry_cache) > 256:
+        _stream_geometry_cache.clear()  # simple bound of the memory usage
+    _stream_geometry_cache[key] = geometry
 
+    return geometry
 
-def compute_stream(n_max_stream, permittivity, permittivity_substrate):
+
+def compute_stream_geometry(n_max_stream, permittivity, permittivity_substrate, user_outmu=None):
     #     """Compute the optimal angles of each layer. Use for this a Gauss-Legendre quadrature for the most refringent layer and
     # use Snell-law to prograpate the direction in the other layers takig care of the total reflection.
 
     #     :param n_max_stream: number of stream
     #     :param permittivity: permittivity of each layer
     #     :type permittivity: ndarray
+    #     :param user_outmu: cosines of additional directions in the air (e.g. the viewing angles). They are added as streams with
+    #     a zero weight (propagated with Snell-law in all the layers), so that they receive the radiation of the other streams
+    #     without contributing to the quadrature.
     #     :returns: mu, weight, outmu
     # """
 
@@ -665,19 +2238,65 @@ def compute_stream(n_max_stream, permittivity, permittivity_substrate):
         relsin = real_index * np.sqrt(1 - mu_most_refringent[:]**2)
         n_stream_substrate = np.sum (relsin < 1)   # count where real reflection occurs
 
-    return n_stream, mu, abs(weight), outmu, outweight, n_stream_substrate
+    weight = abs(weight)
+
+    if user_outmu is not None:
+        # remove the directions already computed
+        user_outmu = np.unique(user_outmu)[::-1]
+        user_outmu = user_outmu[np.all(np.abs(user_outmu[:, np.newaxis] - outmu[np.newaxis, :]) > 1e-10, axis=1)]
+
+        # directions in the most refringent layer (always real coming from the air), then in all the layers
+        relsin = np.sqrt(1 - user_outmu**2) / np.real(np.sqrt(permittivity[k_most_refringent]))
+        user_mu_most_refringent = np.sqrt(1 - relsin**2)
+
+        real_index = np.real(np.sqrt(permittivity[k_most_refringent] / permittivity[:]))
+        relsin = real_index[:, np.newaxis] * np.sqrt(1 - user_mu_most_refringent[np.newaxis, :]**2)
+        user_mu = np.sqrt(1 - relsin**2)
+
+        # insert the new streams keeping the order of decreasing cosine. As the directions come from the air, they are
+        # before the totally reflected streams in all the layers
+        position = np.searchsorted(-mu_most_refringent, -user_mu_most_refringent)
+        mu = np.insert(mu, position, user_mu, axis=1)
+        weight = np.insert(weight, position, 0, axis=1)
+        n_stream = n_stream + len(user_outmu)
+
+        position = np.searchsorted(-outmu, -user_outmu)
+        outmu = np.insert(outmu, position, user_outmu)
+        outweight = np.insert(outweight, position, 0)
+
+        if permittivity_substrate is not None:
+            # same as for the other streams
+            relsin = np.real(np.sqrt(permittivity_substrate / permittivity[-1])) * np.sqrt(1 - user_mu_most_refringent**2)
+            n_stream_substrate += np.sum(relsin < 1)
+        else:
+            n_stream_substrate = n_stream[-1]
+
+    return n_stream, mu, weight, outmu, outweight, n_stream_substrate
+
+
+_gaussquad_cache = dict()
 
 
 def gaussquad(n):
-    #     """return the gauss-legendre roots and weight, only the positive roots are return.
+    #     """return the gauss-legendre roots and weight, only the positive roots are return. The result is memoized, the arrays
+    # are read-only.
 
     #     :param n: number of (positive) points in the quadrature. Must be larger than 2
     # """
     assert n >= 2
 
+    try:
+        return _gaussquad_cache[n]
+    except KeyError:
+        pass
+
     mu, weight = scipy.special.orthogonal.p_roots(2*n)
 
-    mu = mu[-1:n-1:-1]
-    weight = weight[-1:n-1:-1]
+    mu = mu[-1:n-1:-1].copy()
+    weight = weight[-1:n-1:-1].copy()
+    mu.flags.writeable = False
+    weight.flags.writeable = False
+
+    _gaussquad_cache[n] = mu, weight
 
     return mu, weight
@@ -0,0 +1,394 @@
+# coding: utf-8
+
+"""The doubling-adding solver computes the reflection and transmission operators of each layer and combines them with the operators
+of the interfaces by adding, from the substrate up to the surface. It uses the same discretization in streams and azimuthal
+modes as :py:mod:`~smrt.rtsolver.dort` and gives the same results, but the cost is linear in the number of layers and the operators
+of each layer are independent of the rest of the snowpack.
+
+The operators of a layer are obtained by doubling: the propagator of a thin sub-layer is computed with a matrix exponential
+(exact for the discretized equation) and converted into reflection and transmission operators, then the sub-layer thickness is
+doubled until the layer thickness is reached. The number of doublings grows only as the logarithm of the optical depth so that
+thick and optically deep layers are cheap. The thermal emission of a (isothermal) layer follows from the Kirchhoff law.
+
+The solver accepts the same emmodel interface (`ke`, `ft_even_phase`, `effective_permittivity`), interfaces and substrates as
+:py:mod:`~smrt.rtsolver.dort` as well as most of its options (modes, weighting functions, ...).
+
+Usage::
+
+    m = make_model("iba", "doubling_adding")
+
+"""
+
+# stdlib import
+import hashlib
+
+# other import
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+
+# local import
+from .dort import DORT, EigenvalueCache, compute_eigenvalue_matrix, nonscattering_eigenvalue_solution, muleye
+
+
+class DoublingAdding(DORT):
+    """Doubling-adding solver
+
+        :param n_max_stream: number of stream in the most refringent layer
+        :param m_max: number of mode (azimuth)
+        :param thin_optical_depth: maximum optical depth (norm of the matrix of the homogeneous equation times the thickness) of
+            the sub-layer where the doubling starts.
+        :param operator_cache: cache of the operators. Either an :py:class:`OperatorCache` instance that can be shared between
+            several solvers or an integer giving the maximum size of a cache private to this instance. With a shared cache, the
+            operators of the unchanged layers and sub-stacks are reused and only the changed part of the snowpack is re-solved
+            (e.g. a new substrate or new snow layers at the top). Default is None (no cache).
+
+    The other parameters (weighting_functions, parallel_modes, mode_tolerance) are as in :py:class:`~smrt.rtsolver.dort.DORT`.
+
+    """
+
+    # the batched solution of the snowpacks (DORT.solve_batch) uses the DORT boundary system
+    _broadcast_capability = DORT._broadcast_capability - {"snowpack"}
+
+    def __init__(self, n_max_stream=32, m_max=2, thin_optical_depth=0.5, operator_cache=None, weighting_functions=False,
+                 parallel_modes=False, mode_tolerance=None):
+        # """
+        # :param n_max_stream: number of stream in the most refringent layer
+        # :param m_max: number of mode (azimuth)
+        # :param thin_optical_depth: optical depth of the starting sub-layer
+        # :param operator_cache: OperatorCache instance or maximum size of the cache
+
+        # """
+        super(DoublingAdding, self).__init__(n_max_stream=n_max_stream, m_max=m_max, weighting_functions=weighting_functions,
+                                             parallel_modes=parallel_modes, mode_tolerance=mode_tolerance)
+        self.thin_optical_depth = thin_optical_depth
+
+        if operator_cache is not None and not isinstance(operator_cache, OperatorCache):
+            operator_cache = OperatorCache(maxsize=operator_cache)
+        self.operator_cache = operator_cache
+
+    def dort_modem(self, m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m, compute_coherent_only=False):
+        # compute the upwelling intensity for mode m by adding the layers from the substrate to the surface
+
+        npol = 2 if m == 0 else 3
+        ncol = intensity_down_m.shape[1]
+        frequency = self.sensor.frequency
+
+        compute_emission = m == 0 and self.temperature is not None
+
+        # reflection operator and emission at the bottom of the last layer (looking downward)
+        l = self.nlayer - 1
+        nsl = n_stream[l]
+        n = nsl * npol
+
+        if self.snowpack.substrate is not None:
+            R = self.interface_matrix(self.snowpack.substrate, "specular_reflection_matrix", frequency, self.permittivity[l], mu[l, 0:nsl], npol, compute_coherent_only)
+            if not compute_coherent_only and hasattr(self.snowpack.substrate, "ft_even_diffuse_reflection_matrix"):
+                full_weight_l = np.repeat(weight[l, :], npol)
+                R = R + self.snowpack.substrate.ft_even_diffuse_reflection_matrix(m, frequency, self.permittivity[l], mu[l, 0:nsl], npol) * full_weight_l
+            R = dense_matrix(R, n)
+            J = np.zeros((n, ncol))
+
+            if compute_emission and self.substrate_temperature is not None:
+                Ttop_sub = self.interface_matrix(self.snowpack.substrate, "absorption_matrix", frequency, self.permittivity[l], mu[l, 0:nsl], npol, compute_coherent_only)
+                J += np.outer(muleye(Ttop_sub), self.substrate_temperature)
+        else:
+            R = np.zeros((n, n))  # fully absorbant substrate
+            J = np.zeros((n, ncol))
+
+        elements = self.stack_elements(m, n_stream, mu, weight, outmu, ncol, compute_emission, compute_coherent_only)
+
+        R, J = self.add_stack(elements, R, J)
+
+        I0up_m = np.dot(R, intensity_down_m) + J
+
+        return np.array(I0up_m).squeeze()
+
+    def stack_elements(self, m, n_stream, mu, weight, outmu, ncol, compute_emission, compute_coherent_only):
+        # """return the elements of the stack (interfaces and layers) from the surface to the bottom of the last layer. Each element
+        # is a tuple (key, operators) where key is a fingerprint of the element (None without cache) and operators a function
+        # returning the operators (Rt, Td, Tu, Rb, Ju, Jd) of the element. The operators of the layers are only computed when needed."""
+
+        npol = 2 if m == 0 else 3
+        n_stream0 = len(outmu)  # number of streams in the air
+        nair = n_stream0 * npol
+        frequency = self.sensor.frequency
+
+        def interface_element(Rt, Td, Tu, Rb):
+            ops = (Rt, Td, Tu, Rb, np.zeros((len(Rt), ncol)), np.zeros((len(Rb), ncol)))
+            key = digest(*ops[0:4]) if self.operator_cache is not None else None
+            return key, lambda: ops
+
+        def layer_element(l):
+            nsl = n_stream[l]
+            ft_even_phase = None if (self.ft_even_phase is None or compute_coherent_only) else self.ft_even_phase[l]
+            A = compute_eigenvalue_matrix(m, self.ke[l], ft_even_phase, mu[l, 0:nsl], weight[l, 0:nsl])
+            if A is None:
+                A, _ = nonscattering_eigenvalue_solution(m, self.ke[l], mu[l, 0:nsl])  # the eigenvalues define the layer
+
+            temperature = self.temperature[l] if compute_emission else np.zeros(ncol)
+
+            if self.operator_cache is None:
+                key, layer_key = None, None
+            else:
+                layer_key = digest(A, self.thickness[l], self.thin_optical_depth)
+                key = digest(layer_key, temperature)
+
+            def operators():
+                Rt, Td, Tu, Rb = self.layer_operators(A, self.thickness[l], layer_key)
+                # Kirchhoff law: in an isothermal enclosure the intensity is isotropic and equal to the temperature
+                Ju = np.outer(1 - np.sum(Rt, axis=1) - np.sum(Tu, axis=1), temperature)
+                Jd = np.outer(1 - np.sum(Td, axis=1) - np.sum(Rb, axis=1), temperature)
+                return Rt, Td, Tu, Rb, Ju, Jd
+
+            return key, operators
+
+        # air-snow interface
+        n = n_stream[0] * npol
+        Rbottom_air_down = self.interface_matrix(self.interfaces[0], "specular_reflection_matrix", frequency, 1, self.permittivity[0], outmu, npol, compute_coherent_only)
+        Tbottom_air_down = self.interface_matrix(self.interfaces[0], "coherent_transmission_matrix", frequency, 1, self.permittivity[0], outmu, npol, compute_coherent_only)
+        Ttop_0 = self.interface_matrix(self.interfaces[0], "coherent_transmission_matrix", frequency, self.permittivity[0], 1, mu[0, 0:n_stream[0]], npol, compute_coherent_only)
+        Rtop_0 = self.interface_matrix(self.interfaces[0], "specular_reflection_matrix", frequency, self.permittivity[0], 1, mu[0, 0:n_stream[0]], npol, compute_coherent_only)
+
+        elements = [interface_element(dense_matrix(Rbottom_air_down, nair), embedded_matrix(Tbottom_air_down, n, nair, nair),
+                                      dense_matrix(Ttop_0, n)[0:nair, :], dense_matrix(Rtop_0, n))]
+
+        for l in range(self.nlayer):
+            elements.append(layer_element(l))
+
+            if l < self.nlayer - 1:
+                # interface between layer l and l+1. The matrices are the same as in the boundary conditions of DORT
+                n = n_stream[l] * npol
+                nlp1 = n_stream[l+1] * npol
+                ns_ = min(n, nlp1)
+                eps_l, eps_lp1 = self.permittivity[l], self.permittivity[l+1]
+
+                Rbottom_l = self.interface_matrix(self.interfaces[l], "specular_reflection_matrix", frequency, eps_l, eps_lp1, mu[l, 0:n_stream[l]], npol, compute_coherent_only)
+                Tbottom_l = self.interface_matrix(self.interfaces[l], "coherent_transmission_matrix", frequency, eps_l, eps_lp1, mu[l, 0:(ns_//npol)], npol, compute_coherent_only)
+                Ttop_lp1 = self.interface_matrix(self.interfaces[l+1], "coherent_transmission_matrix", frequency, eps_lp1, eps_l, mu[l+1, 0:(ns_//npol)], npol, compute_coherent_only)
+                Rtop_lp1 = self.interface_matrix(self.interfaces[l+1], "specular_reflection_matrix", frequency, eps_lp1, eps_l, mu[l+1, 0:n_stream[l+1]], npol, compute_coherent_only)
+
+                elements.append(interface_element(dense_matrix(Rbottom_l, n), embedded_matrix(Tbottom_l, nlp1, n, ns_),
+                                                  embedded_matrix(Ttop_lp1, n, nlp1, ns_), dense_matrix(Rtop_lp1, nlp1)))
+
+        return elements
+
+    def add_stack(self, elements, R, J):
+        # """add the elements (from the top to the bottom) above the substrate with reflection operator R and emission J.
+        # Returns the reflection operator and emission at the top of the stack.
+        #
+        # With a cache, the sub-stacks made of the lower elements and the substrate are stored, so that when only the upper elements
+        # change (e.g. new snow) the adding restarts from the deepest unchanged sub-stack. The combined operators of all the elements are
+        # also stored when the same stack is solved again with another substrate, so that the next substrates only require a single
+        # adding."""
+
+        cache = self.operator_cache
+
+        if cache is None:
+            for key, operators in reversed(elements):
+                R, J = add_below(*(operators() + (R, J)))
+            return R, J
+
+        nelement = len(elements)
+
+        # keys of the sub-stacks made of the elements i to nelement-1 and the substrate
+        substack_keys = [None] * nelement + [digest(R, J)]
+        for i in range(nelement - 1, -1, -1):
+            substack_keys[i] = digest(elements[i][0], substack_keys[i + 1])
+
+        solution = cache.get(substack_keys[0])
+        if solution is not None:
+            return solution
+
+        # key of the stack without the substrate
+        stack_key = digest(*[key for key, operators in elements])
+
+        # search the deepest unchanged sub-stack
+        start = nelement
+        for i in range(1, nelement):
+            solution = cache.get(substack_keys[i]) if substack_keys[i] in cache else None
+            if solution is not None:
+                start = i
+                R, J = solution
+                break
+
+        if start == nelement and ("solved", stack_key) in cache:
+            # the same stack has already been solved with another substrate, compute its combined operators
+            stack_operators = cache.get(stack_key)
+            if stack_operators is None:
+                stack_operators = elements[0][1]()
+                for key, operators in elements[1:]:
+                    stack_operators = combine_layers(stack_operators, operators())
+                cache.set(stack_key, stack_operators)
+            R, J = add_below(*(stack_operators + (R, J)))
+            cache.set(substack_keys[0], (R, J))
+            return R, J
+
+        for i in range(start - 1, -1, -1):
+            R, J = add_below(*(elements[i][1]() + (R, J)))
+            cache.set(substack_keys[i], (R, J))
+
+        cache.set(("solved", stack_key), ())
+
+        return R, J
+
+    def layer_operators(self, A, thickness, key=None):
+        # """return the reflection and transmission operators Rt, Td, Tu, Rb of a layer. Rt and Td apply to the intensity incident
+        # at the top, Tu and Rb to the intensity incident at the bottom. A is the matrix of the homogeneous equation, or the
+        # eigenvalues for a non-scattering layer. The operators are stored in the cache with the key if given."""
+
+        if key is not None:
+            operators = self.operator_cache.get(key)
+            if operators is not None:
+                return operators
+
+        if A.ndim == 1:
+            # no scattering, the operators are diagonal
+            n = len(A) // 2
+            Tu = np.diag(np.exp(-A[0:n] * thickness))
+            Td = np.diag(np.exp(A[n:] * thickness))
+            operators = np.zeros((n, n)), Td, Tu, np.zeros((n, n))
+        else:
+            n = len(A) // 2
+
+            # thickness of the sub-layer where the doubling starts
+            norm = np.max(np.sum(np.abs(A), axis=1))
+            if np.isfinite(thickness):
+                ndoubling = int(np.ceil(np.log2(norm * thickness / self.thin_optical_depth))) if norm * thickness > self.thin_optical_depth else 0
+                h = thickness / 2**ndoubling
+            else:
+                ndoubling = None  # semi-infinite layer, double until the transmission vanishes
+                h = self.thin_optical_depth / norm
+
+            operators = thin_layer_operators(A, h, n)
+
+            if ndoubling is None:
+                for i in range(200):
+                    operators = double_layer(*operators)
+                    if np.max(np.abs(operators[1])) < 1e-16 and np.max(np.abs(operators[2])) < 1e-16:
+                        break
+            else:
+                for i in range(ndoubling):
+                    operators = double_layer(*operators)
+
+        if key is not None:
+            self.operator_cache.set(key, operators)
+
+        return operators
+
+
+def thin_layer_operators(A, h, n):
+    # """return the operators Rt, Td, Tu, Rb of a homogeneous layer of thickness h from the propagator exp(A h) of the
+    # homogeneous equation dI/dz = A I where z is the depth and I=(upward intensity, downward intensity). The layer must be thin
+    # enough for the upward block of the propagator to be well conditioned."""
+
+    P = scipy.linalg.expm(A * h)
+
+    # the intensities at the top (0) and bottom (h) of the layer are related by:
+    # Iup(h) = P11 Iup(0) + P12 Idown(0) and Idown(h) = P21 Iup(0) + P22 Idown(0)
+    Tu = np.linalg.inv(P[0:n, 0:n])
+    Rt = - np.dot(Tu, P[0:n, n:])
+    Td = P[n:, n:] + np.dot(P[n:, 0:n], Rt)
+    Rb = np.dot(P[n:, 0:n], Tu)
+
+    return Rt, Td, Tu, Rb
+
+
+def double_layer(Rt, Td, Tu, Rb):
+    # """return the operators of a layer made of two identical layers with the operators Rt, Td, Tu, Rb"""
+
+    n = len(Rt)
+    G = np.linalg.inv(np.eye(n) - np.dot(Rb, Rt))  # multiple reflections between the two layers
+
+    GTd = np.dot(G, Td)
+    GRbTu = np.dot(G, np.dot(Rb, Tu))
+
+    return Rt + np.dot(Tu, np.dot(Rt, GTd)), \
+        np.dot(Td, GTd), \
+        np.dot(Tu, Tu + np.dot(Rt, GRbTu)), \
+        Rb + np.dot(Td, GRbTu)
+
+
+def combine_layers(upper, lower):
+    # """return the operators (Rt, Td, Tu, Rb, Ju, Jd) of the stack made of the upper element above the lower element"""
+
+    Rt1, Td1, Tu1, Rb1, Ju1, Jd1 = upper
+    Rt2, Td2, Tu2, Rb2, Ju2, Jd2 = lower
+
+    nTd, nTu = Td1.shape[1], Tu2.shape[1]
+
+    # multiple reflections between the two elements
+    X = np.linalg.solve(np.eye(len(Rb1)) - np.dot(Rb1, Rt2), np.hstack((Td1, np.dot(Rb1, Tu2), np.dot(Rb1, Ju2) + Jd1)))
+    GTd, GRbTu, GJ = X[:, 0:nTd], X[:, nTd:nTd + nTu], X[:, nTd + nTu:]
+
+    return Rt1 + np.dot(Tu1, np.dot(Rt2, GTd)), \
+        np.dot(Td2, GTd), \
+        np.dot(Tu1, Tu2 + np.dot(Rt2, GRbTu)), \
+        Rb2 + np.dot(Td2, GRbTu), \
+        Ju1 + np.dot(Tu1, Ju2 + np.dot(Rt2, GJ)), \
+        Jd2 + np.dot(Td2, GJ)
+
+
+def add_below(Rt, Td, Tu, Rb, Ju, Jd, R, J):
+    # """add a layer or an interface (operators Rt, Td, Tu, Rb and emission Ju, Jd) above a stack described by its reflection
+    # operator R and emission J at the top. Returns the reflection operator and the emission at the top of the layer."""
+
+    nTd = Td.shape[1]
+
+    # multiple reflections between the layer and the stack below
+    X = np.linalg.solve(np.eye(len(Rb)) - np.dot(Rb, R), np.hstack((Td, np.dot(Rb, J) + Jd)))
+
+    R_top = Rt + np.dot(Tu, np.dot(R, X[:, 0:nTd]))
+    J_top = Ju + np.dot(Tu, np.dot(R, X[:, nTd:]) + J)
+
+    return R_top, J_top
+
+
+def dense_matrix(x, n):
+    # """return the (n x n) dense array of x (scalar, sparse or dense matrix)"""
+    if np.isscalar(x):
+        return x * np.eye(n)
+    if scipy.sparse.issparse(x):
+        return x.toarray()
+    return np.asarray(x)
+
+
+def embedded_matrix(x, n, m, ns):
+    # """return a (n x m) dense array with the (ns x ns) matrix x in the upper left corner. Used for the transmission between layers
+    # with different number of streams"""
+    y = np.zeros((n, m))
+    y[0:ns, 0:ns] = dense_matrix(x, ns)
+    return y
+
+
+def digest(*args):
+    # """return a fingerprint of the arrays, numbers and strings given in argument"""
+
+    h = hashlib.sha1()
+    for x in args:
+        if isinstance(x, str):
+            h.update(x.encode())
+        else:
+            x = np.ascontiguousarray(x)
+            h.update(str((x.dtype, x.shape)).encode())
+            h.update(x.view(np.uint8))
+    return h.hexdigest()
+
+
+class OperatorCache(EigenvalueCache):
+    """Size-bounded cache (least recently used) of the operators used by the :py:class:`DoublingAdding` solver. It stores the
+    operators of the layers, of the sub-stacks above the substrate and of the full stacks. The same instance must be given to
+    successive solvers (e.g. in the rtsolver_kwargs of :py:func:`~smrt.core.model.make_model`) so that only the changed part of the
+    snowpack is re-solved. This is useful for retrievals of the soil parameters under a fixed snowpack, where the substrate
+    is added to the combined operators of the snowpack, or for new snow above an unchanged snowpack.
+
+    :param maxsize: maximum number of operators stored.
+
+"""
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._cache
+
+    def __repr__(self):
+        return "OperatorCache(maxsize=%i, size=%i, hits=%i, misses=%i)" % (self.maxsize, len(self), self.hits, self.misses)
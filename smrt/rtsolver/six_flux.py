@@ -0,0 +1,220 @@
+# coding: utf-8
+
+"""The six-flux solver is a fast and approximate solver of the radiative transfer equation in passive mode, similar to the one
+used in MEMLS (Wiesmann and Mätzler, 1999). It is intended for screening runs and ensemble pre-filtering where the accuracy of
+:py:mod:`~smrt.rtsolver.dort` is not needed.
+
+In each layer, the radiation is described by six fluxes: upward, downward and four horizontal fluxes. As in MEMLS, the vertical
+fluxes are those within the cone of the critical angle of the air-snow interface (cosine omega = sqrt(1 - 1 / eps) where eps is
+the real part of the effective permittivity) and the horizontal fluxes are the radiation trapped in the snowpack. The scattering
+coefficient ks of the emmodel is split between the backward direction (coefficient gamma_b), each of the four sideward
+directions (coefficient gamma_c) and the forward direction. The fractions are obtained by integrating the phase function of the
+emmodel for a vertical incidence over the backward cone and over the sideward directions (see :py:func:`scattering_fractions`).
+For an isotropic phase function, this gives the MEMLS coefficients gamma_b = ks (1 - omega) / 2 and gamma_c = ks omega / 4. The
+horizontal fluxes are eliminated assuming they are in local equilibrium, which gives a two-flux problem with the effective
+coefficients:
+
+    gamma_a2 = ka (ka + 6 gamma_c) / (ka + 2 gamma_c)
+    gamma_b2 = gamma_b + 4 gamma_c^2 / (ka + 2 gamma_c)
+
+The two fluxes propagate in the direction given by the viewing angle refracted in each layer (Snell's law). The reflection,
+transmission and emission of each layer follow from the two-flux solution and are computed for all the layers at once. The layers
+are then combined with the interfaces and the substrate by adding, from the bottom to the surface.
+
+The solver uses the `ka`, `ks` and `effective_permittivity` of the emmodels and the specular reflection of the interfaces and
+substrates. The differences with DORT increase with the scattering (see the tests). The solver itself is about 20 to 30 times
+faster than DORT with 32 streams, the run time is then dominated by the computation of the emmodels.
+
+Usage::
+
+    m = make_model("iba", "six_flux")
+
+"""
+
+# other import
+import numpy as np
+
+# local import
+from ..core.error import SMRTError
+from ..core.result import Result
+from .dort import matrix_diagonal, has_diagonal_option
+
+
+class SixFlux(object):
+    """Six-flux solver (passive mode only)
+
+        :param backscatter_fraction: fraction of ks scattered backward (gamma_b = backscatter_fraction * ks). By default, it is
+            derived from the phase function of the emmodel of each layer as in MEMLS (see :py:func:`scattering_fractions`). A
+            value replaces the physical split by an empirical tuning parameter, e.g. to fit the results of DORT for a given type
+            of snowpack.
+        :param sidescatter_fraction: fraction of ks scattered in each of the four sideward directions
+            (gamma_c = sidescatter_fraction * ks). Same default and usage as backscatter_fraction.
+
+    """
+
+    # this specifies which dimension this solver is able to deal with. Those not in this list must be managed by the called (Model object)
+    _broadcast_capability = {"theta", "polarization"}
+
+    def __init__(self, backscatter_fraction=None, sidescatter_fraction=None):
+        # """
+        # :param backscatter_fraction: gamma_b / ks, derived from the phase function if None
+        # :param sidescatter_fraction: gamma_c / ks, derived from the phase function if None
+
+        # """
+        self.backscatter_fraction = backscatter_fraction
+        self.sidescatter_fraction = sidescatter_fraction
+
+    def solve(self, snowpack, emmodels, sensor, atmosphere=None):
+        """solve the radiative transfer equation for a given snowpack, emmodels and sensor configuration.
+
+        :param snowpack: snowpack to solve
+        :param emmodels: list of emmodel instances, one per layer
+        :param sensor: sensor configuration (passive only)
+        :param atmosphere: atmosphere above the snowpack (optional)
+
+        :returns: :py:class:`~smrt.core.result.Result` instance
+"""
+
+        if sensor.mode != 'P':
+            raise SMRTError("The six-flux solver is only available in passive mode")
+
+        npol = 2
+        frequency = sensor.frequency
+        mu0 = np.atleast_1d(np.cos(sensor.theta))
+
+        permittivity = np.array([emmodel.effective_permittivity() for emmodel in emmodels])
+        ka = np.array([emmodel.ka for emmodel in emmodels], dtype=np.float64)
+        ks = np.array([emmodel.ks for emmodel in emmodels], dtype=np.float64)
+        thickness = np.array(snowpack.layer_thicknesses, dtype=np.float64)
+        temperature = np.array([layer.temperature for layer in snowpack.layers], dtype=np.float64)
+
+        # direction of the fluxes in each layer (nlayer x ntheta)
+        mu = np.sqrt(1 - (1 - mu0[np.newaxis, :]**2) / np.real(permittivity)[:, np.newaxis])
+
+        # split of the scattering coefficient
+        backscatter_fraction, sidescatter_fraction = self.backscatter_fraction, self.sidescatter_fraction
+        if backscatter_fraction is None or sidescatter_fraction is None:
+            fractions = np.array([scattering_fractions(emmodel, eps) for emmodel, eps in zip(emmodels, permittivity)])
+            if backscatter_fraction is None:
+                backscatter_fraction = fractions[:, 0]
+            if sidescatter_fraction is None:
+                sidescatter_fraction = fractions[:, 1]
+
+        # reflection, transmission and emissivity of the layers, for the two polarizations (nlayer x ntheta*npol)
+        r, t = two_flux_layers(ka, backscatter_fraction * ks, sidescatter_fraction * ks, thickness[:, np.newaxis] / mu)
+        r = np.repeat(r, npol, axis=1)
+        t = np.repeat(t, npol, axis=1)
+        emission = (1 - r - t) * temperature[:, np.newaxis]
+
+        # substrate
+        nlayer = snowpack.nlayer
+        if snowpack.substrate is not None:
+            R = reflection_diagonal(snowpack.substrate, "specular_reflection_matrix",
+                                    (frequency, permittivity[-1], mu[-1], npol, False))
+            substrate_temperature = snowpack.substrate.temperature
+            E = (1 - R) * substrate_temperature if substrate_temperature is not None else np.zeros_like(R)
+        else:
+            # fully absorbant substrate without emission
+            R = np.zeros(len(mu0) * npol)
+            E = np.zeros_like(R)
+
+        # add the layers and the interfaces from the bottom to the surface
+        for l in range(nlayer - 1, -1, -1):
+            # layer l
+            denominator = 1 - r[l] * R
+            E = emission[l] + t[l] * (E + R * emission[l]) / denominator
+            R = r[l] + t[l]**2 * R / denominator
+
+            # interface at the top of layer l, seen from the medium above
+            eps_above = permittivity[l-1] if l > 0 else 1
+            mu_above = mu[l-1] if l > 0 else mu0
+            s = reflection_diagonal(snowpack.interfaces[l], "specular_reflection_matrix",
+                                    (frequency, eps_above, permittivity[l], mu_above, npol, False))
+            denominator = 1 - s * R
+            E = (1 - s) * E / denominator
+            R = s + (1 - s)**2 * R / denominator
+
+        intensity = E
+        if atmosphere is not None:
+            intensity = atmosphere.tbup(frequency, mu0, npol) + \
+                atmosphere.trans(frequency, mu0, npol) * (intensity + R * atmosphere.tbdown(frequency, mu0, npol))
+
+        return Result(intensity.reshape((len(mu0), npol)), [('theta', sensor.theta), ('polarization', ['V', 'H'])])
+
+
+def scattering_fractions(emmodel, permittivity, n=8):
+    # """return the fractions of the scattering coefficient scattered backward and in each of the four sideward directions of the
+    # six-flux model. As in MEMLS, the vertical fluxes are those within the cone of the critical angle around the vertical
+    # (cosine omega). The phase function of the emmodel for a vertical and unpolarized incidence (mode m=0) is integrated with
+    # a Gauss-Legendre quadrature of n points over the forward cone, the sideward directions and the backward cone."""
+
+    if getattr(emmodel, "ks", 0) == 0:
+        return 0., 0.
+
+    omega = np.sqrt(max(1 - 1 / np.real(permittivity), 0))  # cosine of the critical angle
+
+    x, w = np.polynomial.legendre.leggauss(n)
+    bounds = [(omega, 1), (-omega, omega), (-1, -omega)]  # forward cone, sideward directions, backward cone
+    mu = np.concatenate([0.5 * (b - a) * x + 0.5 * (b + a) for a, b in bounds] + [[1.]])  # the last stream is the incidence
+    weight = np.concatenate([0.5 * (b - a) * w for a, b in bounds])
+
+    if hasattr(emmodel, "set_max_mode"):
+        emmodel.set_max_mode(0)  # passive mode
+    # the rows of the phase matrix are the scattered streams, the columns the incident streams, the polarization is the fast index
+    P = np.asarray(emmodel.ft_even_phase(0, mu))
+    if P.ndim == 0:
+        return 0., 0.
+    npol = 2
+    p = P[:-npol, -npol:].reshape((len(weight), npol, npol)).sum(axis=(1, 2))  # scattered intensity, all polarizations
+
+    power = weight * p
+    total = np.sum(power)
+    if total <= 0:
+        return 0., 0.
+
+    return np.sum(power[2 * n:]) / total, np.sum(power[n:2 * n]) / total / 4
+
+
+def two_flux_layers(ka, gamma_b, gamma_c, path_length):
+    # """return the reflection and transmission coefficients of layers given the absorption, backward and sideward scattering
+    # coefficients of the six-flux model (1D arrays, one value per layer) and the path length in each layer (2D array, one row
+    # per layer)."""
+
+    # reduction of the six-flux to the two-flux problem, the horizontal fluxes are eliminated
+    with np.errstate(invalid='ignore', divide='ignore'):
+        side = np.where(gamma_c > 0, 4 * gamma_c**2 / (ka + 2 * gamma_c), 0)
+    gamma_a2 = ka + 4 * gamma_c - 2 * side
+    gamma_b2 = gamma_b + side
+
+    gamma = np.sqrt(gamma_a2 * (gamma_a2 + 2 * gamma_b2))
+    r0 = (gamma_b2 / (gamma_a2 + gamma_b2 + gamma))[:, np.newaxis]  # reflection of a semi-infinite layer
+    t0 = np.exp(-gamma[:, np.newaxis] * path_length)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        denominator = 1 - (r0 * t0)**2
+        r = r0 * (1 - t0**2) / denominator
+        t = t0 * (1 - r0**2) / denominator
+
+    # limit without absorption
+    conservative = (gamma == 0)
+    if np.any(conservative):
+        optical_depth = gamma_b2[conservative, np.newaxis] * path_length[conservative]
+        t[conservative] = 1 / (1 + optical_depth)
+        r[conservative] = 1 - t[conservative]
+
+    return r, t
+
+
+def reflection_diagonal(interface, method, args):
+    # """return the diagonal of the reflection matrix computed by the given method of an interface or substrate"""
+
+    f = getattr(interface, method)
+    if has_diagonal_option(getattr(f, "__func__", f)):
+        return np.asarray(f(*args, return_as_diagonal=True), dtype=np.float64)
+    else:
+        # interface without the return_as_diagonal option
+        mu, npol = args[-3:-1]
+        diagonal = matrix_diagonal(f(*args), len(mu) * npol)
+        if diagonal is None:
+            raise SMRTError("The six-flux solver requires interfaces and substrates with a specular reflection")
+        return diagonal
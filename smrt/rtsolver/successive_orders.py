@@ -0,0 +1,348 @@
+# coding: utf-8
+
+"""The successive orders of scattering solver computes the intensity scattered once, twice, ... in the snowpack and adds the
+orders until the contribution of the last order is negligible. It uses the same discretization in streams and azimuthal modes as
+:py:mod:`~smrt.rtsolver.dort` and converges to the same solution, but it does not diagonalise the matrix of each layer. It is
+efficient for media with a low single scattering albedo (e.g. dry snow at low frequency), where a few orders are sufficient.
+
+For each order, the source of the next order (the scattering of the intensity of the current order) is computed at depth nodes
+in each layer and is interpolated linearly between the nodes. The propagation of the sources along each stream, including the
+multiple reflections between the interfaces and the substrate, is exact. The emission and the incident intensity are the
+sources of the order zero.
+
+The number of orders needed grows rapidly with the single scattering albedo and the optical depth. The convergence rate is
+estimated from the last orders and the mode is solved by DORT when the tolerance can not be reached within `max_order`
+orders. DORT is also used for the stacks not supported by this solver: interfaces or substrates with a non-specular reflection,
+and semi-infinite layers. The number of orders used for each mode is returned in `other_data['n_orders']` of the
+:py:class:`~smrt.core.result.Result` (0 when the mode was solved by DORT).
+
+Usage::
+
+    m = make_model("iba", "successive_orders")
+
+"""
+
+# other import
+import numpy as np
+import xarray as xr
+
+# local import
+from .dort import DORT
+
+
+class SuccessiveOrders(DORT):
+    """Successive orders of scattering solver
+
+        :param n_max_stream: number of stream in the most refringent layer
+        :param m_max: number of mode (azimuth)
+        :param order_tolerance: the scattering orders are added until the contribution of the last order is smaller than
+            order_tolerance times the upwelling intensity (maximum over the streams and polarizations).
+        :param max_order: maximum number of scattering orders. When the convergence rate estimated from the last orders shows
+            that the tolerance will not be reached within max_order orders, the mode is solved by DORT.
+        :param optical_depth_step: maximum optical depth (extinction times thickness) between two depth nodes where the
+            sources are computed.
+
+    The other parameters (weighting_functions, parallel_modes, mode_tolerance, exact_angles) are as in :py:class:`~smrt.rtsolver.dort.DORT`.
+
+    """
+
+    # the batched solution of the snowpacks (DORT.solve_batch) uses the DORT boundary system
+    _broadcast_capability = DORT._broadcast_capability - {"snowpack"}
+
+    def __init__(self, n_max_stream=32, m_max=2, order_tolerance=1e-4, max_order=30, optical_depth_step=0.05,
+                 weighting_functions=False, parallel_modes=False, mode_tolerance=None, exact_angles=False):
+        # """
+        # :param n_max_stream: number of stream in the most refringent layer
+        # :param m_max: number of mode (azimuth)
+        # :param order_tolerance: relative tolerance to stop adding orders
+        # :param max_order: maximum number of scattering orders before switching to DORT
+        # :param optical_depth_step: maximum optical depth between the depth nodes
+
+        # """
+        super(SuccessiveOrders, self).__init__(n_max_stream=n_max_stream, m_max=m_max, weighting_functions=weighting_functions,
+                                               parallel_modes=parallel_modes, mode_tolerance=mode_tolerance,
+                                               exact_angles=exact_angles)
+        self.order_tolerance = order_tolerance
+        self.max_order = max_order
+        self.optical_depth_step = optical_depth_step
+
+    def solve_single_frequency(self, snowpack, emmodels, sensor, atmosphere=None):
+        # not to be called by the user
+
+        self.n_orders = dict()
+        intensity, coords, other_data = super(SuccessiveOrders, self).solve_single_frequency(snowpack, emmodels, sensor, atmosphere)
+
+        modes = sorted(self.n_orders)
+        other_data['n_orders'] = xr.DataArray([self.n_orders[m] for m in modes], [('mode', modes)])
+
+        return intensity, coords, other_data
+
+    def dort_modem(self, m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m, compute_coherent_only=False):
+        # compute the upwelling intensity for mode m by successive orders of scattering. The mode is solved by DORT when the
+        # stack is not supported or when the convergence is too slow
+
+        stack = self.stack_operators(m, n_stream, mu, weight, outmu, intensity_down_m.shape[1], compute_coherent_only)
+
+        intensity_up_m, n_orders = None, 0
+        if stack is not None:
+            intensity_up_m, n_orders = self.add_orders(stack, intensity_down_m)
+            intensity_up_m = intensity_up_m.squeeze() if intensity_up_m is not None else None
+
+        if intensity_up_m is None:
+            intensity_up_m, n_orders = DORT.dort_modem(self, m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down_m,
+                                                       compute_coherent_only=compute_coherent_only), 0
+
+        if not compute_coherent_only:
+            self.n_orders[m] = n_orders
+
+        return intensity_up_m
+
+    def add_orders(self, stack, intensity_down_m):
+        # """add the scattering orders. Returns the upwelling intensity and the number of scattering orders, or None, 0 if the
+        # tolerance can not be reached within max_order orders"""
+
+        layers, interfaces, substrate = stack
+        scattering = [S for (nnode, t, ce, cx, S, source) in layers]
+
+        # order zero: emission, incident intensity and substrate emission
+        sources = [source for (nnode, t, ce, cx, S, source) in layers]
+        intensity_up, intensity = self.propagate(stack, sources, intensity_down_m, substrate[1])
+
+        total = intensity_up
+        previous_contribution = None
+
+        for order in range(1, self.max_order + 1):
+            if all(S is None for S in scattering):
+                return total, 0
+
+            sources = [np.matmul(S, I) if S is not None else None for S, I in zip(scattering, intensity)]
+            intensity_up, intensity = self.propagate(stack, sources, np.zeros_like(intensity_down_m), None)
+            total = total + intensity_up
+
+            contribution = np.max(np.abs(intensity_up))
+            target = self.order_tolerance * np.max(np.abs(total))
+            if contribution <= target:
+                return total, order
+
+            if previous_contribution is not None:
+                # the contributions decrease geometrically, the ratio gives the number of orders still needed
+                ratio = contribution / previous_contribution
+                if ratio >= 1 or order + np.log(target / contribution) / np.log(ratio) > self.max_order:
+                    return None, 0
+            previous_contribution = contribution
+
+        return None, 0
+
+    def stack_operators(self, m, n_stream, mu, weight, outmu, ncol, compute_coherent_only):
+        # """return the operators of the layers, interfaces and substrate used by propagate, or None if the stack is not
+        # supported (non-diagonal interface or substrate matrices, semi-infinite layers)"""
+
+        npol = 2 if m == 0 else 3
+        frequency = self.sensor.frequency
+        compute_emission = m == 0 and self.temperature is not None
+
+        # air-snow interface, as in DoublingAdding.stack_elements
+        nair, n = len(outmu) * npol, n_stream[0] * npol
+        air = (self.interface_matrix(self.interfaces[0], "specular_reflection_matrix", frequency, 1, self.permittivity[0], outmu, npol, compute_coherent_only, as_diagonal=True),
+               self.interface_matrix(self.interfaces[0], "coherent_transmission_matrix", frequency, 1, self.permittivity[0], outmu, npol, compute_coherent_only, as_diagonal=True),
+               self.interface_matrix(self.interfaces[0], "coherent_transmission_matrix", frequency, self.permittivity[0], 1, mu[0, 0:n_stream[0]], npol, compute_coherent_only, as_diagonal=True),
+               self.interface_matrix(self.interfaces[0], "specular_reflection_matrix", frequency, self.permittivity[0], 1, mu[0, 0:n_stream[0]], npol, compute_coherent_only, as_diagonal=True))
+        interfaces = [diagonals(air, (nair, nair, n, n))]
+
+        layers = []
+        for l in range(self.nlayer):
+            if not np.isfinite(self.thickness[l]):
+                return None
+
+            nsl = n_stream[l]
+            mu_l = np.concatenate((mu[l, 0:nsl], -mu[l, 0:nsl]))
+            ke = np.repeat(self.ke[l](mu_l), npol)
+            invmu = np.repeat(1 / np.abs(mu_l), npol)
+
+            # depth nodes
+            nnode = max(int(np.ceil(np.max(ke) * self.thickness[l] / self.optical_depth_step)), 1) + 1
+            h = self.thickness[l] / (nnode - 1)
+
+            # propagation between two nodes with a linear source
+            x = ke * invmu * h
+            t, e0, e1 = exponential_integrals(x)
+            ce, cx = h * invmu * e1, h * invmu * (e0 - e1)  # coefficients of the source at the entry and exit nodes
+
+            ft_even_phase = None if (self.ft_even_phase is None or compute_coherent_only) else self.ft_even_phase[l]
+            S = scattering_matrix(m, ft_even_phase, mu[l, 0:nsl], weight[l, 0:nsl])
+
+            if compute_emission:
+                # Kirchhoff law: the emission balances the extinction minus the scattering of an isotropic intensity
+                absorption = ke - np.sum(S, axis=1) if S is not None else ke
+                source = np.outer(absorption, self.temperature[l])[np.newaxis, :, :] * np.ones((nnode, 1, 1))
+            else:
+                source = None
+
+            layers.append((nnode, t, ce, cx, S, source))
+
+            if l < self.nlayer - 1:
+                # interface between layer l and l+1, as in DoublingAdding.stack_elements
+                ns_ = min(nsl * npol, n_stream[l+1] * npol)
+                eps_l, eps_lp1 = self.permittivity[l], self.permittivity[l+1]
+                interfaces.append(diagonals((
+                    self.interface_matrix(self.interfaces[l], "specular_reflection_matrix", frequency, eps_l, eps_lp1, mu[l, 0:nsl], npol, compute_coherent_only, as_diagonal=True),
+                    self.interface_matrix(self.interfaces[l], "coherent_transmission_matrix", frequency, eps_l, eps_lp1, mu[l, 0:(ns_//npol)], npol, compute_coherent_only, as_diagonal=True),
+                    self.interface_matrix(self.interfaces[l+1], "coherent_transmission_matrix", frequency, eps_lp1, eps_l, mu[l+1, 0:(ns_//npol)], npol, compute_coherent_only, as_diagonal=True),
+                    self.interface_matrix(self.interfaces[l+1], "specular_reflection_matrix", frequency, eps_lp1, eps_l, mu[l+1, 0:n_stream[l+1]], npol, compute_coherent_only, as_diagonal=True)),
+                    (nsl * npol, ns_, ns_, n_stream[l+1] * npol)))
+
+        # substrate
+        l = self.nlayer - 1
+        n = n_stream[l] * npol
+        if self.snowpack.substrate is not None:
+            if not compute_coherent_only and hasattr(self.snowpack.substrate, "ft_even_diffuse_reflection_matrix"):
+                return None
+            R = self.interface_matrix(self.snowpack.substrate, "specular_reflection_matrix", frequency, self.permittivity[l], mu[l, 0:n_stream[l]], npol, compute_coherent_only, as_diagonal=True)
+            if compute_emission and self.substrate_temperature is not None:
+                absorption = self.interface_matrix(self.snowpack.substrate, "absorption_matrix", frequency, self.permittivity[l], mu[l, 0:n_stream[l]], npol, compute_coherent_only, as_diagonal=True)
+                if absorption is None:
+                    return None
+                J = np.outer(np.broadcast_to(absorption, n), self.substrate_temperature)
+            else:
+                J = None
+        else:
+            R, J = np.zeros(n), None  # fully absorbant substrate
+
+        if R is None or any(interface is None for interface in interfaces):
+            return None
+
+        return layers, interfaces, (np.broadcast_to(R, n), J)
+
+    def propagate(self, stack, sources, intensity_down_m, substrate_source):
+        # """propagate the sources of each layer (at the depth nodes, for the upward and downward streams) and the incident and
+        # substrate sources along the streams, with the multiple reflections between the interfaces. Returns the upwelling intensity
+        # in the air and the intensity at the depth nodes of each layer."""
+
+        layers, interfaces, (R, J) = stack
+        ncol = intensity_down_m.shape[1]
+
+        # intensity generated by the sources of each layer with no incident intensity at the top and at the bottom of the layer
+        particular = [propagate_sources(nnode, t, ce, cx, source) for (nnode, t, ce, cx, S, source), source in zip(layers, sources)]
+
+        # from the bottom to the top: reflectance and upwelling source below each layer (rho, g) and at the top of each
+        # layer (r, j), such that Iup = r Idown + j
+        rho = R
+        g = substrate_source if substrate_source is not None else np.zeros((len(R), ncol))
+        below = [None] * len(layers)
+        top = [None] * len(layers)
+
+        for l in range(len(layers) - 1, -1, -1):
+            nnode, t, ce, cx, S, source = layers[l]
+            n = len(t) // 2
+            P_up, P_down = particular[l]
+            t_up, t_down = t[0:n]**(nnode - 1), t[n:]**(nnode - 1)  # transmission of the layer
+
+            below[l] = rho, g
+            r = t_up * rho * t_down
+            j = t_up[:, np.newaxis] * (rho[:, np.newaxis] * P_down[-1] + g) + P_up[0]
+            top[l] = r, j
+
+            if l > 0:
+                # interface between the layers l-1 and l
+                Rb, Tb, Tt, Rt = interfaces[l]
+                ns_ = len(Tb)
+                denominator = 1 - Rt[0:ns_] * r[0:ns_]
+                rho = np.array(Rb, dtype=np.float64)
+                rho[0:ns_] += Tt * r[0:ns_] * Tb / denominator
+                g = np.zeros((len(rho), ncol))
+                g[0:ns_] = Tt[:, np.newaxis] * j[0:ns_] / denominator[:, np.newaxis]
+
+        # air-snow interface
+        Rb, Tb, Tt, Rt = interfaces[0]
+        nair = len(Tb)
+        r, j = top[0]
+        transmitted = np.zeros((len(r), ncol))
+        transmitted[0:nair] = Tb[:, np.newaxis] * intensity_down_m
+        I_down_top = (transmitted + Rt[:, np.newaxis] * j) / (1 - Rt * r)[:, np.newaxis]
+        intensity_up = Rb[:, np.newaxis] * intensity_down_m + Tt[0:nair, np.newaxis] * (r[:, np.newaxis] * I_down_top + j)[0:nair]
+
+        # from the top to the bottom: intensity at the nodes of each layer
+        intensity = []
+        for l in range(len(layers)):
+            nnode, t, ce, cx, S, source = layers[l]
+            n = len(t) // 2
+            P_up, P_down = particular[l]
+            power = np.arange(nnode)[:, np.newaxis, np.newaxis]
+
+            I_down = t[n:, np.newaxis]**power * I_down_top + P_down
+            rho, g = below[l]
+            I_up_bottom = rho[:, np.newaxis] * I_down[-1] + g
+            I_up = t[0:n, np.newaxis]**power[::-1] * I_up_bottom + P_up
+            intensity.append(np.concatenate((I_up, I_down), axis=1))
+
+            if l < len(layers) - 1:
+                Rb, Tb, Tt, Rt = interfaces[l + 1]
+                ns_ = len(Tb)
+                r, j = top[l + 1]
+                transmitted = np.zeros((len(r), ncol))
+                transmitted[0:ns_] = Tb[:, np.newaxis] * I_down[-1, 0:ns_]
+                I_down_top = (transmitted + Rt[:, np.newaxis] * j) / (1 - Rt * r)[:, np.newaxis]
+
+        return intensity_up, intensity
+
+
+def propagate_sources(nnode, t, ce, cx, source):
+    # """return the upward and downward intensities at the nnode depth nodes of a layer generated by the source (nnode x 2n x ncol
+    # array, or None) without incident intensity. t, ce, cx are the transmission between two nodes and the coefficients of the
+    # source at the entry and exit nodes for each stream (upward streams first)"""
+
+    n = len(t) // 2
+    if source is None:
+        return np.zeros((1, n, 1)), np.zeros((1, n, 1))  # broadcastable to any number of nodes and columns
+
+    t, ce, cx = t[:, np.newaxis], ce[:, np.newaxis], cx[:, np.newaxis]
+
+    P_up = np.zeros((nnode, n, source.shape[2]))
+    P_down = np.zeros_like(P_up)
+
+    for k in range(nnode - 1):
+        P_down[k + 1] = t[n:] * P_down[k] + ce[n:] * source[k, n:] + cx[n:] * source[k + 1, n:]
+        i = nnode - 2 - k
+        P_up[i] = t[0:n] * P_up[i + 1] + ce[0:n] * source[i + 1, 0:n] + cx[0:n] * source[i, 0:n]
+
+    return P_up, P_down
+
+
+def diagonals(matrices, sizes):
+    # """return the diagonals of the interface matrices as arrays of the given sizes, or None if a matrix is not diagonal"""
+
+    if any(x is None for x in matrices):
+        return None
+    return tuple(np.broadcast_to(np.asarray(x, dtype=np.float64), size) for x, size in zip(matrices, sizes))
+
+
+def exponential_integrals(x):
+    # """return exp(-x), (1 - exp(-x)) / x and (1 - exp(-x) - x exp(-x)) / x**2. The two last are the integrals of exp(-x(1-s))
+    # and exp(-x(1-s)) (1-s) for s from 0 to 1, that is the weights of a linear source at the exit and entry of a path of optical
+    # depth x"""
+
+    t = np.exp(-x)
+    small = x < 1e-3
+    xs = np.where(small, 1, x)  # avoid the division by zero
+
+    e0 = np.where(small, 1 - x / 2 + x**2 / 6, -np.expm1(-x) / xs)
+    e1 = np.where(small, 0.5 - x / 3 + x**2 / 8, (-np.expm1(-x) - x * t) / xs**2)
+
+    return t, e0, e1
+
+
+def scattering_matrix(m, ft_even_phase, mu, weight):
+    # """return the matrix of the scattering source for mode m, that is the term of the matrix of the homogeneous equation
+    # (see dort.compute_eigenvalue_matrix) not divided by mu, or None if the layer is not scattering"""
+
+    if ft_even_phase is None:
+        return None
+
+    npol = 2 if m == 0 else 3
+    coef = 0.5 if m == 0 else 0.25  # 1/4pi normalization of the RT equation
+
+    P = ft_even_phase(m, np.concatenate((mu, -mu)))
+    if (np.isscalar(P) and P == 0) or not np.any(P):
+        return None
+
+    return P * np.tile(np.repeat(coef * weight, npol), 2)[np.newaxis, :]
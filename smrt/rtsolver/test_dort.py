@@ -1,13 +1,33 @@
 
+import copy
+
 import numpy as np
+import xarray as xr
+from nose.tools import raises
 
-from smrt import make_snowpack
-from smrt.core.sensor import passive
-from smrt.core.model import Model
+from smrt import make_snowpack, make_soil
+from smrt.core.sensor import passive, active
+from smrt.core.model import Model, make_emmodel
+from smrt.core.error import SMRTError
 
 from smrt.interface.transparent import Transparent
+from smrt.interface.flat import Flat
 from smrt.emmodel.nonescattering import NoneScattering
-from smrt.rtsolver.dort import DORT
+from smrt.emmodel.iba import IBA
+from smrt.atmosphere.simple_isotropic_atmosphere import SimpleIsotropicAtmosphere
+from smrt.substrate.reflector_backscatter import make_reflector
+from smrt.rtsolver import dort
+from smrt.rtsolver.dort import DORT, compute_stream, solve_reduced_eigenvalue_problem, solve_full_eigenvalue_problem, \
+    solve_eigenvalue_problem, solve_eigenvalue_problems, EigenvalueCache, compute_stream_geometry, Workspace
+
+
+def four_layer_snowpack(temperature=260, substrate="soil", **kwargs):
+    # snowpack with layers of different numbers of streams, on a rough soil by default
+
+    if substrate == "soil":
+        substrate = make_soil("soil_wegmuller", complex(10, 1), 270, roughness_rms=1e-2)
+    return make_snowpack([0.1, 0.3, 0.2, 1], "exponential", density=[150, 350, 250, 400], temperature=temperature,
+                         corr_length=[1e-4, 2e-4, 2e-4, 3e-4], substrate=substrate, **kwargs)
 
 
 def test_noabsoprtion():
@@ -21,3 +41,531 @@ def test_noabsoprtion():
     res = m.run(sensor, sp)
 
     np.testing.assert_allclose(res.data, temp)
+
+
+class DORTWithoutFrequency(DORT):
+    # the frequency dimension is managed by the Model
+    _broadcast_capability = DORT._broadcast_capability - {"frequency"}
+
+
+def test_frequency_broadcasting():
+
+    sp = make_snowpack([0.3, 10], "exponential", density=[250, 350], temperature=[260, 265], corr_length=[1e-4, 2e-4])
+    sensor = passive([10e9, 19e9, 37e9], theta=[40, 55])
+
+    res = Model("iba", DORT).run(sensor, sp)
+    res_loop = Model("iba", DORTWithoutFrequency).run(sensor, sp)
+
+    assert res.data.dims == res_loop.data.dims
+    np.testing.assert_allclose(res.data.frequency, res_loop.data.frequency)
+    np.testing.assert_allclose(res.data, res_loop.data)
+
+
+def test_reduced_eigenvalue_problem():
+
+    sp = make_snowpack([1], "exponential", density=[300], temperature=260, corr_length=2e-4)
+    sensor = active(13e9, 40)
+    em = make_emmodel("iba", sensor, sp.layers[0])
+
+    n_stream, mu, weight, outmu, outweight, n_stream_substrate = compute_stream(8, np.array([em.effective_permittivity()]), None)
+    mu = np.concatenate((mu[0], -mu[0]))
+    weight = np.concatenate((weight[0], weight[0]))
+
+    for m, npol in [(0, 2), (1, 3), (2, 3)]:
+        coef = 0.5 if m == 0 else 0.25
+        A = -coef * em.ft_even_phase(m, mu) * np.repeat(weight, npol)[np.newaxis, :]
+        A[np.diag_indices(len(A))] += np.repeat(em.ke(mu), npol)
+        A = np.repeat(1 / mu, npol)[:, np.newaxis] * A
+        n = len(A) // 2
+
+        beta, E = solve_reduced_eigenvalue_problem(A.copy(), n, npol)
+        beta_full, E_full = solve_full_eigenvalue_problem(A.copy(), n)
+
+        np.testing.assert_allclose(beta, beta_full, rtol=1e-8)
+        np.testing.assert_allclose(np.dot(A, E), E * beta[np.newaxis, :], atol=1e-8 * np.max(np.abs(beta)))
+
+
+@raises(SMRTError)
+def test_full_eigenvalue_problem_failure():
+    # rotation matrix, the eigenvalues are complex
+    solve_full_eigenvalue_problem(np.array([[0., 1.], [-1., 0.]]), 1)
+
+
+def test_stream_geometry_memo():
+
+    permittivity = np.array([1.5 + 1e-4j, 1.8 + 2e-4j, 1.6 + 1e-4j])
+
+    geometry = compute_stream(16, permittivity, 10 + 1j)
+    assert compute_stream(16, permittivity.copy(), 10 + 1j) is geometry  # memoized
+    assert not geometry[1].flags.writeable
+
+    n_stream, mu, weight, outmu, outweight, n_stream_substrate = compute_stream_geometry(16, permittivity, 10 + 1j)
+    np.testing.assert_equal(geometry[0], n_stream)
+    for l, n in enumerate(n_stream):  # the arrays are only filled up to the number of streams in each layer
+        np.testing.assert_allclose(geometry[1][l, :n], mu[l, :n], rtol=1e-10)
+        np.testing.assert_allclose(geometry[2][l, :n], weight[l, :n], rtol=1e-10)
+    np.testing.assert_allclose(geometry[3], outmu, rtol=1e-10)
+    assert geometry[5] == n_stream_substrate
+
+    # a larger tolerance reuses the geometry of close permittivities
+    geometry = compute_stream(16, permittivity, 10 + 1j, tolerance=1e-4)
+    assert compute_stream(16, permittivity * (1 + 1e-7), 10 + 1j, tolerance=1e-4) is geometry
+    assert compute_stream(16, permittivity * (1 + 1e-7), 10 + 1j) is not geometry
+
+
+def test_batched_eigenvalue_problems():
+
+    sp = make_snowpack([0.1, 0.2, 0.3, 1], "exponential", density=[200, 300, 250, 350], temperature=260,
+                       corr_length=[1e-4, 2e-4, 1.5e-4, 2e-4])
+    sensor = active(13e9, 40)
+    emmodels = [make_emmodel("iba", sensor, layer) for layer in sp.layers]
+    permittivity = np.array([em.effective_permittivity() for em in emmodels])
+
+    n_stream, mu, weight, outmu, outweight, n_stream_substrate = compute_stream(8, permittivity, None)
+    ke = [em.ke for em in emmodels]
+    ft_even_phase = [em.ft_even_phase for em in emmodels[:-1]] + [None]  # the last layer is solved as non-scattering
+
+    for m in [0, 1, 2]:
+        # a small batch size to test the splitting
+        solutions = solve_eigenvalue_problems(m, ke, ft_even_phase, mu, weight, n_stream, max_batch_size=2)
+
+        for l in range(len(emmodels)):
+            nsl = n_stream[l]
+            beta, Eu, Ed = solve_eigenvalue_problem(m, ke[l], ft_even_phase[l], mu[l, 0:nsl], weight[l, 0:nsl])
+
+            np.testing.assert_allclose(solutions[l][0], beta, rtol=1e-10)
+            np.testing.assert_allclose(solutions[l][1], Eu, atol=1e-10)
+            np.testing.assert_allclose(solutions[l][2], Ed, atol=1e-10)
+
+
+def test_eigenvalue_cache():
+
+    sp = make_snowpack([0.1, 0.2, 1], "exponential", density=[200, 300, 350], temperature=260, corr_length=[1e-4, 2e-4, 2e-4])
+    sp2 = make_snowpack([0.05, 0.2, 1], "exponential", density=[250, 300, 350], temperature=260, corr_length=[1e-4, 2e-4, 2e-4])
+    sensor = passive(37e9, 55)
+
+    cache = EigenvalueCache(maxsize=10)
+    m_cached = Model("iba", "dort", rtsolver_kwargs=dict(eigenvalue_cache=cache))
+    m = Model("iba", "dort")
+
+    m_cached.run(sensor, sp)
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    # only the first layer has changed
+    res = m_cached.run(sensor, sp2)
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert len(cache) == 4
+
+    np.testing.assert_allclose(res.TbV(), m.run(sensor, sp2).TbV(), rtol=1e-12)
+
+
+def test_weighting_functions():
+
+    # the permittivities do not depend on the temperature so that Tb is linear in the temperatures
+    def snowpack(temperature, substrate_temperature):
+        substrate = make_soil("soil_wegmuller", complex(10, 1), substrate_temperature, roughness_rms=1e-2)
+        return make_snowpack([0.1, 0.3, 1], "exponential", density=[200, 300, 350], temperature=temperature,
+                             corr_length=[1e-4, 2e-4, 2e-4], ice_permittivity_model=complex(3.18, 0.001), substrate=substrate)
+
+    atmos = SimpleIsotropicAtmosphere(30., 6., 0.90)
+    sensor = passive([19e9, 37e9], [40, 55])
+
+    m = Model("iba", "dort", rtsolver_kwargs=dict(weighting_functions=True))
+    res = m.run(sensor, snowpack([250, 260, 265], 270), atmosphere=atmos)
+
+    np.testing.assert_allclose(res.TbV(), Model("iba", "dort").run(sensor, snowpack([250, 260, 265], 270), atmosphere=atmos).TbV(), rtol=1e-10)
+
+    # the Tb of another temperature profile is obtained with the weighting functions
+    wf = res.other_data['weighting_function']
+    tb = res.other_data['incident_contribution'] + wf.dot(xr.DataArray([240, 255, 270], coords=[('layer', wf.layer.values)])) + \
+        res.other_data['substrate_weighting_function'] * 273
+
+    tb_ref = Model("iba", "dort").run(sensor, snowpack([240, 255, 270], 273), atmosphere=atmos)
+    np.testing.assert_allclose(tb.sel(polarization='V'), tb_ref.TbV(), rtol=1e-10)
+    assert wf.dims == ('frequency', 'theta', 'polarization', 'layer')
+
+
+class CountingIBA(IBA):
+    # count the computations of the phase matrices
+    n_precompute = 0
+
+    def precompute_ft_even_phase(self, *args, **kwargs):
+        CountingIBA.n_precompute += 1
+        return super(CountingIBA, self).precompute_ft_even_phase(*args, **kwargs)
+
+
+def test_parallel_modes():
+
+    sp = make_snowpack([0.1, 0.3, 1], "exponential", density=[200, 300, 350], temperature=260, corr_length=[1e-4, 2e-4, 2e-4])
+    sensor = active(13e9, [30, 40])
+
+    res = Model("iba", "dort", rtsolver_kwargs=dict(m_max=4)).run(sensor, sp)
+
+    CountingIBA.n_precompute = 0
+    res_parallel = Model(CountingIBA, "dort", rtsolver_kwargs=dict(m_max=4, parallel_modes=3)).run(sensor, sp)
+
+    np.testing.assert_allclose(res_parallel.sigmaVV(), res.sigmaVV(), rtol=1e-12)
+    np.testing.assert_allclose(res_parallel.sigmaHV(), res.sigmaHV(), rtol=1e-12)
+
+    # the phase matrices are computed once per layer before starting the threads
+    assert CountingIBA.n_precompute == sp.nlayer
+
+
+def test_coherent_recursion():
+
+    sp = four_layer_snowpack()
+    sensor = active(13e9, [30, 40])
+
+    solver = DORT(n_max_stream=16)
+    solver.solve(sp, [make_emmodel("iba", sensor, layer) for layer in sp.layers], sensor)
+
+    permittivity_substrate = sp.substrate.permittivity(sensor.frequency)
+    n_stream, mu, weight, outmu, outweight, n_stream_substrate = compute_stream(16, solver.permittivity, permittivity_substrate)
+    assert len(set(n_stream)) > 1  # test with different number of streams in the layers
+
+    intensity_0, intensity_higher = solver.prepare_intensity_array(outmu, outweight)
+
+    for m, intensity_down in [(0, intensity_0), (1, intensity_higher)]:
+        coherent = solver.dort_modem_coherent(m, n_stream, mu, outmu, intensity_down)
+        coherent_banded = solver.dort_modem_banded(m, n_stream, mu, weight, outmu, n_stream_substrate, intensity_down,
+                                                   compute_coherent_only=True)
+        np.testing.assert_allclose(coherent, coherent_banded, atol=1e-10 * np.max(np.abs(coherent_banded)))
+
+
+def test_mode_convergence():
+
+    sp = make_snowpack([0.1, 0.3, 1], "exponential", density=[200, 300, 350], temperature=260, corr_length=[1e-4, 2e-4, 2e-4])
+    sensor = active(13e9, [30, 40])
+
+    res = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, m_max=20, mode_tolerance=1e-3)).run(sensor, sp)
+    n_modes = int(res.other_data['n_modes'])
+    assert n_modes < 21
+
+    res_ref = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, m_max=n_modes - 1)).run(sensor, sp)
+    np.testing.assert_allclose(res.sigmaVV(), res_ref.sigmaVV(), rtol=1e-6)
+
+
+def test_banded_assembly():
+
+    sp = four_layer_snowpack(substrate=None)
+    sensor = passive(37e9, 55)
+
+    solver = DORT(n_max_stream=8)
+    solver.solve(sp, [make_emmodel("iba", sensor, layer) for layer in sp.layers], sensor)
+
+    try:
+        dort.DEBUG_DENSE_BOUNDARY_MATRIX = True
+        BC, b = solver.dort(special_return="BC")
+    finally:
+        dort.DEBUG_DENSE_BOUNDARY_MATRIX = False
+    bBC, b = solver.dort(special_return="bBC")
+
+    # convert the banded storage to a dense matrix
+    u = (bBC.shape[0] - 1) // 2
+    dense = np.zeros_like(BC)
+    for i in range(bBC.shape[0]):
+        dense += np.diag(bBC[i, max(0, u - i):bBC.shape[1] - max(0, i - u)], u - i)
+
+    np.testing.assert_array_equal(dense, BC)
+
+
+def test_block_tridiagonal_boundary_solver():
+
+    sp = four_layer_snowpack()
+
+    for sensor in [passive(37e9, 55), active(13e9, 40)]:
+        res = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, sp)
+        res_bt = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, boundary_solver="block_tridiagonal")).run(sensor, sp)
+
+        np.testing.assert_allclose(res_bt.data, res.data, rtol=1e-8)
+
+
+class ScaledScattering(object):
+    # emmodel with the absorption and scattering coefficients of another emmodel incremented by dka and dks
+    def __init__(self, emmodel, dka=0, dks=0):
+        self.emmodel = emmodel
+        self.ka = emmodel.ka + dka
+        self.ks = emmodel.ks + dks
+
+    def ke(self, mu):
+        return self.emmodel.ke(mu) + (self.ka - self.emmodel.ka) + (self.ks - self.emmodel.ks)
+
+    def ft_even_phase(self, m, mu, npol=None):
+        return self.emmodel.ft_even_phase(m, mu, npol) * (self.ks / self.emmodel.ks)
+
+    def effective_permittivity(self):
+        return self.emmodel.effective_permittivity()
+
+
+def test_jacobian():
+
+    substrate = make_soil("soil_wegmuller", complex(10, 1), 270, roughness_rms=1e-2)
+    sp = make_snowpack([0.1, 0.3, 1], "exponential", density=[200, 300, 350], temperature=[250, 260, 265],
+                       corr_length=[1e-4, 2e-4, 2e-4], ice_permittivity_model=complex(3.18, 0.001), substrate=substrate)
+    sensor = passive(37e9, [40, 55])
+
+    emmodels = [ScaledScattering(make_emmodel("iba", sensor, layer)) for layer in sp.layers]
+    res = DORT(n_max_stream=16, jacobian=True).solve(sp, emmodels, sensor)
+    jacobian = res.other_data['jacobian']
+
+    np.testing.assert_allclose(res.data, DORT(n_max_stream=16).solve(sp, emmodels, sensor).data, rtol=1e-10)
+
+    # compare with centered finite differences
+    for l in range(sp.nlayer):
+        for parameter in ['ka', 'ks', 'thickness', 'temperature']:
+            tb = list()
+            for sign in [-1, 1]:
+                perturbed_sp = copy.deepcopy(sp)
+                perturbed_emmodels = list(emmodels)
+                if parameter == 'ka':
+                    h = 1e-4 * emmodels[l].ka
+                    perturbed_emmodels[l] = ScaledScattering(emmodels[l].emmodel, dka=sign * h)
+                elif parameter == 'ks':
+                    h = 1e-4 * emmodels[l].ks
+                    perturbed_emmodels[l] = ScaledScattering(emmodels[l].emmodel, dks=sign * h)
+                elif parameter == 'thickness':
+                    h = 1e-5
+                    perturbed_sp.layers[l].thickness += sign * h
+                else:
+                    h = 0.1
+                    perturbed_sp.layers[l].temperature += sign * h
+                tb.append(DORT(n_max_stream=16).solve(perturbed_sp, perturbed_emmodels, sensor).data)
+
+            finite_difference = (tb[1] - tb[0]) / (2 * h)
+            np.testing.assert_allclose(jacobian.sel(parameter=parameter, layer=l), finite_difference, rtol=1e-5)
+
+    # selection of the parameters
+    res = DORT(n_max_stream=16, jacobian=['ks', 'temperature']).solve(sp, emmodels, sensor)
+    assert list(res.other_data['jacobian'].parameter.values) == ['ks', 'temperature']
+    np.testing.assert_allclose(res.other_data['jacobian'], jacobian.sel(parameter=['ks', 'temperature']))
+
+
+@raises(SMRTError)
+def test_jacobian_permittivity():
+    # the derivative with respect to the effective permittivity is not available
+    DORT(jacobian=['ka', 'permittivity'])
+
+
+def test_adjoint_gradient():
+
+    sp = four_layer_snowpack(temperature=[250, 260, 265, 270], ice_permittivity_model=complex(3.18, 0.001))
+    atmos = SimpleIsotropicAtmosphere(30., 6., 0.90)
+    sensor = passive([19e9, 37e9], [40, 55])
+
+    def cost_gradient(tb):  # gradient of the sum of the squared residuals
+        return 2 * (tb - 200)
+
+    for boundary_solver in ["banded", "block_tridiagonal"]:
+        m = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, boundary_solver=boundary_solver, jacobian=True,
+                                                      cost_gradient=cost_gradient))
+        res = m.run(sensor, sp, atmosphere=atmos)
+
+        # the gradient is the transposed Jacobian applied to the gradient with respect to Tb
+        gradient = (res.other_data['jacobian'] * cost_gradient(res.data)).sum(['theta', 'polarization'])
+
+        np.testing.assert_allclose(res.other_data['gradient'], gradient.transpose(*res.other_data['gradient'].dims), rtol=1e-10)
+
+
+def test_exact_angles():
+
+    sp = four_layer_snowpack(temperature=[250, 260, 265, 270], ice_permittivity_model=complex(3.18, 0.001))
+
+    m = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=32, exact_angles=True))
+    res = m.run(passive(37e9, [40, 55]), sp)
+
+    # the zero-weight streams do not contribute to the quadrature, adding more does not change the solution
+    res_more = m.run(passive(37e9, [5, 40, 55, 70]), sp)
+    np.testing.assert_allclose(res_more.data.isel(theta=[1, 2]), res.data, rtol=1e-8)
+
+    # and the result is consistent with the interpolation at high stream number
+    res_interp = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=64)).run(passive(37e9, [40, 55]), sp)
+    np.testing.assert_allclose(res.data, res_interp.data, atol=2)
+
+
+def test_adaptive_streams():
+
+    sp = four_layer_snowpack(temperature=[250, 260, 265, 270], ice_permittivity_model=complex(3.18, 0.001))
+    sensor = passive([19e9, 37e9], [40, 55])
+
+    res = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, stream_tolerance=1e-2, max_stream=64)).run(sensor, sp)
+    n_max_stream = int(res.other_data['n_max_stream'])
+    assert 16 < n_max_stream <= 64
+
+    res_fixed = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=n_max_stream)).run(sensor, sp)
+    np.testing.assert_allclose(res.data, res_fixed.data)
+
+    # the number of streams is not increased beyond max_stream
+    res = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, stream_tolerance=1e-12, max_stream=32,
+                                                    richardson=True)).run(sensor, sp)
+    assert int(res.other_data['n_max_stream']) == 32
+
+    # and the extrapolated result differs from the last solution
+    res_fixed = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=32)).run(sensor, sp)
+    assert not np.allclose(res.data, res_fixed.data)
+
+
+class CountingFlat(Flat):
+    # flat interface counting the calls
+    ncall = 0
+
+    @classmethod
+    def specular_reflection_matrix(cls, *args, **kwargs):
+        cls.ncall += 1
+        return super(CountingFlat, cls).specular_reflection_matrix(*args, **kwargs)
+
+
+def test_interface_matrix_cache():
+
+    sp = four_layer_snowpack(substrate=None, interface=CountingFlat)
+
+    res = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, m_max=3)).run(active(13e9, 40), sp)
+    ncall = CountingFlat.ncall
+
+    # the reflection matrices are computed once for the modes m > 0 (npol=3), not for every mode
+    CountingFlat.ncall = 0
+    Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, m_max=1)).run(active(13e9, 40), sp)
+    assert CountingFlat.ncall == ncall
+
+    # the diagonals give the same results as the matrices
+    sp_flat = four_layer_snowpack(substrate=None)
+    res_flat = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, m_max=3)).run(active(13e9, 40), sp_flat)
+    np.testing.assert_allclose(res.data, res_flat.data)
+
+
+def test_workspace():
+
+    sp = four_layer_snowpack()
+
+    workspace = Workspace()
+
+    for boundary_solver in ["banded", "block_tridiagonal"]:
+        for sensor in [passive([19e9, 37e9], 55), active(13e9, 40)]:
+            kwargs = dict(n_max_stream=16, boundary_solver=boundary_solver)
+            res = Model("iba", "dort", rtsolver_kwargs=kwargs).run(sensor, sp)
+            res_ws = Model("iba", "dort", rtsolver_kwargs=dict(kwargs, workspace=workspace)).run(sensor, sp)
+            np.testing.assert_allclose(res_ws.data, res.data, rtol=1e-12)
+
+    # the arrays are reused for the next snowpacks
+    allocations = workspace.allocations
+    for sensor in [passive([19e9, 37e9], 55), active(13e9, 40)]:
+        Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16, workspace=workspace)).run(sensor, sp)
+    assert workspace.allocations == allocations
+
+
+class NullPhase(object):
+    # emmodel with the extinction of another emmodel and no scattering, without the ka and ks attributes
+    def __init__(self, emmodel):
+        self.emmodel = emmodel
+
+    def ke(self, mu):
+        return self.emmodel.ke(mu)
+
+    def ft_even_phase(self, m, mu, npol=None):
+        return np.zeros_like(self.emmodel.ft_even_phase(m, mu, npol))
+
+    def effective_permittivity(self):
+        return self.emmodel.effective_permittivity()
+
+
+def test_nonscattering_fast_path():
+
+    sp = four_layer_snowpack(temperature=[250, 260, 265, 270], ice_permittivity_model=complex(3.18, 0.001))
+    sensor = passive(37e9, [40, 55])
+
+    # the null phase matrix of the nonscattering emmodel gives the trivial solution
+    emmodel = NoneScattering(sensor, sp.layers[0])
+    n_stream, mu, weight, outmu, outweight, n_stream_substrate = compute_stream(8, np.array([emmodel.effective_permittivity()]), None)
+    beta, Eu, Ed = solve_eigenvalue_problem(0, emmodel.ke, emmodel.ft_even_phase, mu[0], weight[0])
+    np.testing.assert_array_equal(np.vstack((Eu, Ed)), np.eye(len(beta)))
+
+    # all the layers are considered as non-scattering, same as emmodels with a null phase matrix (diagonalised otherwise)
+    emmodels = [make_emmodel("iba", sensor, layer) for layer in sp.layers]
+    res = DORT(n_max_stream=16, nonscattering_albedo=1).solve(sp, emmodels, sensor)
+    res_null_phase = DORT(n_max_stream=16).solve(sp, [NullPhase(emmodel) for emmodel in emmodels], sensor)
+    np.testing.assert_allclose(res.data, res_null_phase.data, rtol=1e-10)
+
+    # weakly scattering layers
+    sensor = passive(1.4e9, [40, 55])
+    emmodels = [make_emmodel("iba", sensor, layer) for layer in sp.layers]
+    assert all(emmodel.ks < 1e-2 * emmodel.ka for emmodel in emmodels)
+
+    res = DORT(n_max_stream=16).solve(sp, emmodels, sensor)
+    res_fast = DORT(n_max_stream=16, nonscattering_albedo=1e-2).solve(sp, emmodels, sensor)
+    np.testing.assert_allclose(res_fast.data, res.data, rtol=1e-3)
+
+
+class DORTWithoutSnowpack(DORT):
+    # the snowpacks are solved one by one by the Model
+    _broadcast_capability = DORT._broadcast_capability - {"snowpack"}
+
+
+def test_solve_batch():
+
+    substrate = make_soil("flat", complex(10, 1), 270)
+
+    def snowpack(density, corr_length):
+        return make_snowpack([0.1, 0.3, 1], "exponential", density=density, temperature=[250, 260, 270],
+                             corr_length=corr_length, substrate=substrate)
+
+    # two groups of snowpacks with the same structure and a snowpack with a different one
+    snowpacks = [snowpack([150, 350, 400], [c * 1e-4, 2e-4, 3e-4]) for c in [0.5, 1, 2]] + \
+        [snowpack([200, 300, 400], [c * 1e-4, 2e-4, 3e-4]) for c in [1, 2]] + \
+        [make_snowpack([0.2, 1], "exponential", density=[250, 350], temperature=[260, 270], corr_length=[1e-4, 2e-4])]
+
+    sensor = passive([19e9, 37e9], theta=[40, 55])
+    atmosphere = SimpleIsotropicAtmosphere(tbdown=30, tbup=6, trans=0.9)
+    dimension = ("site", list("abcdef"))
+
+    res = Model("iba", DORT, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, snowpacks, atmosphere=atmosphere,
+                                                                        snowpack_dimension=dimension, batch=True)
+    res_loop = Model("iba", DORTWithoutSnowpack, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, snowpacks, atmosphere=atmosphere,
+                                                                                            snowpack_dimension=dimension)
+
+    assert res.data.dims == res_loop.data.dims
+    assert list(res.data.site.values) == dimension[1]
+    np.testing.assert_allclose(res.data, res_loop.data, rtol=1e-10)
+
+    # not supported by the batched solution, the snowpacks are solved one by one
+    sensor = active(13e9, theta_inc=[30, 40])
+    res = Model("iba", DORT, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, snowpacks[:2], batch=True)
+    res_loop = Model("iba", DORTWithoutSnowpack, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, snowpacks[:2])
+    np.testing.assert_allclose(res.data, res_loop.data)
+
+
+class DORTSmallBatch(DORT):
+    # the snowpacks are given by chunks of 2 to solve_batch, the snowpacks solved one by one are counted
+    _batch_size = 2
+    n_single = 0
+
+    def solve_single_frequency(self, *args, **kwargs):
+        DORTSmallBatch.n_single += 1
+        return super(DORTSmallBatch, self).solve_single_frequency(*args, **kwargs)
+
+
+def test_solve_batch_chunks():
+
+    def snowpack(corr_length, substrate):
+        return make_snowpack([0.1, 0.3, 1], "exponential", density=[150, 350, 400], temperature=[250, 260, 270],
+                             corr_length=[corr_length, 2e-4, 3e-4], substrate=substrate)
+
+    # the reflector with a backscattering coefficient is not supported by the batched solution, only the snowpacks of its
+    # chunk are solved one by one
+    soil = make_soil("flat", complex(10, 1), 270)
+    reflector = make_reflector(temperature=270, specular_reflection=0.3, backscattering_coefficient={'VV': 0.1, 'HH': 0.1})
+    snowpacks = [snowpack(c, soil) for c in [0.5e-4, 1e-4, 2e-4]] + [snowpack(1.5e-4, reflector), snowpack(3e-4, soil)]
+
+    sensor = passive([19e9, 37e9], theta=[40, 55])
+
+    DORTSmallBatch.n_single = 0
+    res = Model("iba", DORTSmallBatch, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, snowpacks, progressbar=True, batch=True)
+    res_loop = Model("iba", DORTWithoutSnowpack, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, snowpacks)
+
+    assert DORTSmallBatch.n_single == 2 * 2  # two snowpacks, two frequencies
+
+    # by default, the snowpacks are solved one by one
+    DORTSmallBatch.n_single = 0
+    res_default = Model("iba", DORTSmallBatch, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, snowpacks)
+    assert DORTSmallBatch.n_single == len(snowpacks) * 2
+    np.testing.assert_allclose(res_default.data, res_loop.data)
+    assert list(res.data.Snowpack.values) == list(range(len(snowpacks)))
+    np.testing.assert_allclose(res.data, res_loop.data, rtol=1e-10)
@@ -0,0 +1,104 @@
+import numpy as np
+
+from smrt import make_snowpack, make_soil
+from smrt.core.sensor import passive, active
+from smrt.core.model import Model
+
+from smrt.interface.transparent import Transparent
+from smrt.emmodel.nonescattering import NoneScattering
+from smrt.rtsolver.dort import DORT
+from smrt.rtsolver.doubling_adding import DoublingAdding, OperatorCache, thin_layer_operators, double_layer
+
+
+def test_noabsoprtion():
+
+    temp = 250
+    sp = make_snowpack([100], None, density=[300], temperature=[temp], interface=[Transparent])
+
+    sensor = passive(37e9, theta=[30, 40])
+
+    m = Model(NoneScattering, DoublingAdding)
+    res = m.run(sensor, sp)
+
+    np.testing.assert_allclose(res.data, temp)
+
+
+def test_doubling():
+
+    # doubling a thin layer must give the same operators as the direct computation for the double thickness
+    rng = np.random.RandomState(0)
+    n = 4
+    A = np.diag(np.hstack((np.full(n, 3.), np.full(n, -3.)))) + 0.2 * rng.rand(2 * n, 2 * n)
+    A[n:, :] *= -1
+
+    doubled = double_layer(*thin_layer_operators(A, 0.05, n))
+    direct = thin_layer_operators(A, 0.1, n)
+
+    for x, y in zip(doubled, direct):
+        np.testing.assert_allclose(x, y, atol=1e-12)
+
+
+def snowpack_with_soil(soil_permittivity=complex(10, 1), new_snow=None):
+
+    thickness, density, temperature, corr_length = [0.1, 0.3, 0.2, 1], [150, 350, 250, 400], [250, 260, 265, 270], [1e-4, 2e-4, 2e-4, 3e-4]
+    if new_snow is not None:
+        thickness, density, temperature, corr_length = [new_snow] + thickness, [100] + density, [245] + temperature, [5e-5] + corr_length
+
+    substrate = make_soil("soil_wegmuller", soil_permittivity, 270, roughness_rms=1e-2)
+    return make_snowpack(thickness, "exponential", density=density, temperature=temperature,
+                         corr_length=corr_length, substrate=substrate, ice_permittivity_model=complex(3.18, 0.001))
+
+
+def test_same_as_dort_passive():
+
+    sp = snowpack_with_soil()
+    sensor = passive([19e9, 37e9], theta=[40, 55])
+
+    res_dort = Model("iba", DORT, rtsolver_kwargs=dict(n_max_stream=16, weighting_functions=True)).run(sensor, sp)
+    res = Model("iba", DoublingAdding, rtsolver_kwargs=dict(n_max_stream=16, weighting_functions=True)).run(sensor, sp)
+
+    np.testing.assert_allclose(res.data, res_dort.data, rtol=1e-8)
+    np.testing.assert_allclose(res.other_data['weighting_function'], res_dort.other_data['weighting_function'], atol=1e-8)
+
+
+def test_same_as_dort_active():
+
+    sp = snowpack_with_soil()
+    sensor = active(13e9, theta_inc=[30, 40])
+
+    res_dort = Model("iba", DORT, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, sp)
+    res = Model("iba", DoublingAdding, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, sp)
+
+    np.testing.assert_allclose(res.data, res_dort.data, rtol=1e-8, atol=1e-15)
+
+
+class CountingDoublingAdding(DoublingAdding):
+    # record the thickness of the layers whose operators are computed (i.e. not found in the cache)
+    built = []
+
+    def layer_operators(self, A, thickness, key=None):
+        if key not in self.operator_cache:
+            CountingDoublingAdding.built.append(thickness)
+        return super(CountingDoublingAdding, self).layer_operators(A, thickness, key)
+
+
+def test_operator_cache():
+
+    sensor = passive(37e9, theta=[40, 55])
+    cache = OperatorCache()
+
+    # soil moisture sweep under the same snowpack, then new snow above the same snowpack. The operators of the snow layers are
+    # computed for the first snowpack only, then only those of the new snow layer
+    snowpacks = [snowpack_with_soil(soil_permittivity=complex(eps, 1)) for eps in [5, 10, 15]] + \
+        [snowpack_with_soil(new_snow=h) for h in [0.01, 0.02]]
+    expected_built = [[1, 0.2, 0.3, 0.1], [], [], [0.01], [0.02]]
+
+    for sp, expected in zip(snowpacks, expected_built):
+        del CountingDoublingAdding.built[:]
+        res = Model("iba", DoublingAdding, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, sp)
+        res_cache = Model("iba", CountingDoublingAdding, rtsolver_kwargs=dict(n_max_stream=16, operator_cache=cache)).run(sensor, sp)
+        np.testing.assert_allclose(res_cache.data, res.data, rtol=1e-10)
+        assert CountingDoublingAdding.built == expected
+
+    assert cache.hits > 0
+    assert len(cache) > 0
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from smrt import make_snowpack, make_soil, make_model
+from smrt.core.sensor import passive, active
+from smrt.core.error import SMRTError
+from smrt.core.model import Model
+
+from smrt.interface.transparent import Transparent
+from smrt.emmodel.nonescattering import NoneScattering
+from smrt.rtsolver.six_flux import SixFlux, two_flux_layers, scattering_fractions
+
+
+def snowpack_with_soil():
+
+    substrate = make_soil("soil_wegmuller", complex(10, 1), 270, roughness_rms=1e-2)
+    return make_snowpack([0.1, 0.3, 0.2, 1], "exponential", density=[150, 350, 250, 400], temperature=[250, 260, 265, 270],
+                         corr_length=[1e-4, 2e-4, 2e-4, 3e-4], substrate=substrate, ice_permittivity_model=complex(3.18, 0.001))
+
+
+class IsotropicScattering(object):
+    # emmodel with prescribed coefficients and an isotropic phase function, as assumed by MEMLS
+    def __init__(self, sensor, layer):
+        self.ka, self.ks = layer.ka, layer.ks
+        self._effective_permittivity = layer.effective_permittivity
+
+    def ke(self, mu):
+        return np.full(len(mu), self.ka + self.ks)
+
+    def ft_even_phase(self, m, mu, npol=2):
+        return np.full((npol * len(mu), npol * len(mu)), self.ks / (4 * np.pi) if m == 0 else 0.)
+
+    def effective_permittivity(self):
+        return self._effective_permittivity
+
+
+def test_noabsoprtion():
+
+    temp = 250
+    sp = make_snowpack([100], None, density=[300], temperature=[temp], interface=[Transparent])
+
+    sensor = passive(37e9, theta=[30, 40])
+
+    m = Model(NoneScattering, SixFlux)
+    res = m.run(sensor, sp)
+
+    np.testing.assert_allclose(res.data, temp)
+
+
+def test_energy_conservation():
+
+    # without absorption, the energy is either reflected or transmitted
+    r, t = two_flux_layers(np.zeros(3), np.array([1., 2., 3.]), np.array([1., 1., 0.]), np.full((3, 2), 0.5))
+
+    np.testing.assert_allclose(r + t, 1)
+
+
+def test_memls():
+
+    # the coefficients and the brightness temperature of a semi-infinite layer with an isotropic phase function are those of
+    # the six-flux model of MEMLS (Wiesmann and Matzler, 1999)
+    eps, ka, ks, temperature = 1.6, 0.5, 2., 260.
+    omega = np.sqrt((eps - 1) / eps)
+    gb6 = 0.5 * ks * (1 - omega)
+    gc6 = 0.25 * ks * omega
+    gtr = 4 * gc6 / (ka + 2 * gc6)
+    ga2 = ka * (1 + gtr)
+    gb2 = gb6 + gtr * gc6
+    gamma = np.sqrt(ga2 * (ga2 + 2 * gb2))
+    r0 = gb2 / (ga2 + gb2 + gamma)
+
+    sp = make_snowpack([1000], None, density=[300], temperature=[temperature], interface=[Transparent])
+    sp.layers[0].ka, sp.layers[0].ks, sp.layers[0].effective_permittivity = ka, ks, eps
+    sensor = passive(37e9, theta=[30, 40, 55])
+
+    em = IsotropicScattering(sensor, sp.layers[0])
+    np.testing.assert_allclose(scattering_fractions(em, eps), (gb6 / ks, gc6 / ks), rtol=1e-10)
+
+    res = Model(IsotropicScattering, SixFlux).run(sensor, sp)
+    np.testing.assert_allclose(res.data, temperature * (1 - r0), rtol=1e-10)
+
+
+def test_same_as_dort():
+
+    # the six-flux solver is approximate, the differences with DORT increase with the scattering
+    sp = snowpack_with_soil()
+
+    for frequency, atol in [(1.4e9, 0.05), (5e9, 0.1), (10.7e9, 2), (19e9, 15), (37e9, 12)]:
+        sensor = passive(frequency, theta=[30, 40, 55])
+
+        res_dort = make_model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=32)).run(sensor, sp)
+        res = make_model("iba", "six_flux").run(sensor, sp)
+
+        np.testing.assert_allclose(res.TbV(), res_dort.TbV(), atol=atol)
+        np.testing.assert_allclose(res.TbH(), res_dort.TbH(), atol=atol)
+
+
+def test_active_not_implemented():
+
+    sp = snowpack_with_soil()
+
+    with pytest.raises(SMRTError):
+        make_model("iba", "six_flux").run(active(13e9, 40), sp)
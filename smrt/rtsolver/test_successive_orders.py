@@ -0,0 +1,70 @@
+import numpy as np
+
+from smrt import make_snowpack, make_model
+from smrt.core.sensor import passive, active
+from smrt.core.model import Model
+
+from smrt.interface.transparent import Transparent
+from smrt.emmodel.nonescattering import NoneScattering
+from smrt.rtsolver.successive_orders import SuccessiveOrders, exponential_integrals
+from smrt.rtsolver.test_doubling_adding import snowpack_with_soil
+
+
+def test_noabsoprtion():
+
+    temp = 250
+    sp = make_snowpack([100], None, density=[300], temperature=[temp], interface=[Transparent])
+
+    sensor = passive(37e9, theta=[30, 40])
+
+    m = Model(NoneScattering, SuccessiveOrders)
+    res = m.run(sensor, sp)
+
+    np.testing.assert_allclose(res.data, temp)
+
+
+def test_exponential_integrals():
+
+    # the series for the small optical depths must join the exact formulas
+    x = np.array([1e-3 * (1 - 1e-9), 1e-3 * (1 + 1e-9)])
+    for y in exponential_integrals(x):
+        np.testing.assert_allclose(y[0], y[1], rtol=1e-9)
+
+
+def test_same_as_dort_passive():
+
+    sp = snowpack_with_soil()
+    sensor = passive([6.9e9, 10.7e9], theta=[40, 55])
+
+    res_dort = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=32, weighting_functions=True)).run(sensor, sp)
+    res = Model("iba", SuccessiveOrders, rtsolver_kwargs=dict(n_max_stream=32, weighting_functions=True)).run(sensor, sp)
+
+    assert np.all(res.other_data['n_orders'] > 0)
+    np.testing.assert_allclose(res.data, res_dort.data, atol=0.01)
+    np.testing.assert_allclose(res.other_data['weighting_function'], res_dort.other_data['weighting_function'], atol=1e-3)
+
+
+def test_same_as_dort_active():
+
+    sp = snowpack_with_soil()
+    sensor = active(5.4e9, theta_inc=[30, 40])
+
+    res_dort = Model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, sp)
+    res = Model("iba", SuccessiveOrders, rtsolver_kwargs=dict(n_max_stream=16)).run(sensor, sp)
+
+    assert np.all(res.other_data['n_orders'] > 0)
+    np.testing.assert_allclose(res.sigmaVV(), res_dort.sigmaVV(), rtol=1e-3)
+    np.testing.assert_allclose(res.sigmaHH(), res_dort.sigmaHH(), rtol=1e-3)
+
+
+def test_switch_to_dort():
+
+    # the convergence is too slow at high frequency, DORT is used
+    sp = snowpack_with_soil()
+    sensor = passive(37e9, theta=[40, 55])
+
+    res_dort = make_model("iba", "dort", rtsolver_kwargs=dict(n_max_stream=32)).run(sensor, sp)
+    res = make_model("iba", "successive_orders", rtsolver_kwargs=dict(n_max_stream=32)).run(sensor, sp)
+
+    assert np.all(res.other_data['n_orders'] == 0)
+    np.testing.assert_allclose(res.data, res_dort.data, rtol=1e-12)
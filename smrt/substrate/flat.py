@@ -17,30 +17,32 @@ class Flat(Substrate):
     args = []
     optional_args = {}
 
-    def specular_reflection_matrix(self, npol, frequency, eps_1, mu1, compute_coherent_only):
+    def specular_reflection_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only, return_as_diagonal=False):
         """compute the specular reflection coefficients for an array of incidence angles (given by their cosine)
            in medium 1. Medium 2 is where the beam is transmitted.
 
-        :param npol: number of polarization
         :param eps_1: permittivity of the medium where the incident beam is coming from.
         :param mu1: array of cosine of incident angles
+        :param npol: number of polarization
+        :param return_as_diagonal: if True, return the diagonal of the matrix as a vector
 
-        :return: the reflection matrix
+        :return: the reflection matrix or its diagonal
 """
         eps_2 = self.permittivity(frequency)
 
-        return fresnel_reflection_matrix(npol, eps_1, eps_2, mu1)
+        return fresnel_reflection_matrix(eps_1, eps_2, mu1, npol, return_as_diagonal=return_as_diagonal)
 
-    def absorption_matrix(self, npol, frequency, eps_1, mu1, compute_coherent_only):
+    def absorption_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only, return_as_diagonal=False):
         """compute the absorption coefficients for an array of incidence angles (given by their cosine)
            in medium 1.
 
-        :param npol: number of polarization
         :param eps_1: permittivity of the medium where the incident beam is propagating.
         :param mu1: array of cosine of incident angles
+        :param npol: number of polarization
+        :param return_as_diagonal: if True, return the diagonal of the matrix as a vector
 
-        :return: the transmission matrix
+        :return: the transmission matrix or its diagonal
 """
         eps_2 = self.permittivity(frequency)
 
-        return fresnel_transmission_matrix(npol, eps_1, eps_2, mu1)
+        return fresnel_transmission_matrix(eps_1, eps_2, mu1, npol, return_as_diagonal=return_as_diagonal)
@@ -53,7 +53,7 @@ class Reflector(Substrate):
     args = []
     optional_args = {'specular_reflection': None, 'backscatter_coefficient': None}
 
-    def specular_reflection_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only):
+    def specular_reflection_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only, return_as_diagonal=False):
 
         if npol > 2:
             raise NotImplementedError("active model is not yet implemented, need modification for the third compunant")
@@ -71,9 +71,9 @@ class Reflector(Substrate):
         else:  # we have a scalar, both polarization are the same
             spec_refl_coeff = np.repeat(self._get_refl(self.specular_reflection, mu1), npol)
 
-        return scipy.sparse.diags(spec_refl_coeff, 0)
+        return spec_refl_coeff if return_as_diagonal else scipy.sparse.diags(spec_refl_coeff, 0)
 
-    def absorption_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only):
+    def absorption_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only, return_as_diagonal=False):
 
         if self.specular_reflection is None and self.backscatter_coefficient is None:
             self.specular_reflection = 1
@@ -88,7 +88,7 @@ class Reflector(Substrate):
         else:  # we have a scalar, both polarization are the same
             abs_coeff = 1 - np.repeat(self._get_refl(self.specular_reflection, mu1), npol)
 
-        return scipy.sparse.diags(abs_coeff, 0)
+        return abs_coeff if return_as_diagonal else scipy.sparse.diags(abs_coeff, 0)
 
     def _get_refl(self, specular_reflection, mu1):
         if callable(specular_reflection):  # we have a function, call it and see what we get
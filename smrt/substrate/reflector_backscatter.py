@@ -52,7 +52,7 @@ class Reflector(Substrate):
     args = []
     optional_args = {'specular_reflection': None, 'backscattering_coefficient': None}
 
-    def specular_reflection_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only):
+    def specular_reflection_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only, return_as_diagonal=False):
 
         if npol > 2 and not hasattr(self, "stop_pol2_warning"):
             print("active model is not yet fully implemented, need modification for the third component")  # !!!
@@ -68,7 +68,7 @@ class Reflector(Substrate):
         else:  # we have a scalar, both polarization are the same
             spec_refl_coeff = np.repeat(self._get_refl(self.specular_reflection, mu1), npol)
 
-        return scipy.sparse.diags(spec_refl_coeff, 0)
+        return spec_refl_coeff if return_as_diagonal else scipy.sparse.diags(spec_refl_coeff, 0)
 
     def ft_even_diffuse_reflection_matrix(self, m, frequency, eps_1, mu1, npol):
 
@@ -99,7 +99,7 @@ class Reflector(Substrate):
 
         return scipy.sparse.diags(diffuse_refl_coeff, 0)
 
-    def absorption_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only):
+    def absorption_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only, return_as_diagonal=False):
 
         if self.specular_reflection is None and self.backscattering_coefficient is None:
             self.specular_reflection = 1
@@ -115,7 +115,7 @@ class Reflector(Substrate):
         else:  # we have a scalar, both polarization are the same
             abs_coeff = 1 - np.repeat(self._get_refl(self.specular_reflection, mu1), npol)
 
-        return scipy.sparse.diags(abs_coeff, 0)
+        return abs_coeff if return_as_diagonal else scipy.sparse.diags(abs_coeff, 0)
 
     def _get_refl(self, specular_reflection, mu1):
         if callable(specular_reflection):  # we have a function, call it and see what we get
@@ -38,7 +38,7 @@ class SoilWegmuller(Substrate):
         rv[~mask] = rh[~mask] * mu1[~mask]**0.655   #  <-- * ou ** ??
         rv[mask] = rh[mask] * (0.635-0.0014*(np.arccos(mu1[mask])*180/np.pi-60))
 
-    def specular_reflection_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only=False):
+    def specular_reflection_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only=False, return_as_diagonal=False):
 
         eps_2 = self.permittivity(frequency)
 
@@ -53,9 +53,9 @@ class SoilWegmuller(Substrate):
         if npol == 4:
             raise NotImplementedError("to be implemented, the matrix is not diagonal anymore")
 
-        return scipy.sparse.diags(reflection_coefficients, 0)
+        return reflection_coefficients if return_as_diagonal else scipy.sparse.diags(reflection_coefficients, 0)
 
-    def absorption_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only):
+    def absorption_matrix(self, frequency, eps_1, mu1, npol, compute_coherent_only, return_as_diagonal=False):
 
         # this function is a bit complex because we have to change first and second component but not the third one.
         # this is an approximation, as the third component should be affected by the roughness...
@@ -78,4 +78,4 @@ class SoilWegmuller(Substrate):
         if npol == 4:
             raise NotImplementedError("to be implemented, the matrix is not diagonal anymore")
 
-        return scipy.sparse.diags(transmission_coefficients, 0)
+        return transmission_coefficients if return_as_diagonal else scipy.sparse.diags(transmission_coefficients, 0)
@@ -26,3 +26,18 @@ def test_multifrequency():
     testpack = setup_snowpack()
 
     m.run(sensor, testpack)
+
+
+def test_parallel_run_snowpack_list():
+
+    m = Model(DMRT_ShortRange, DORT)
+
+    sensor = amsre('37V')
+    snowpacks = [make_snowpack([0.2], StickyHardSpheres, density=[density], temperature=265, radius=0.3e-3, stickiness=0.2)
+                 for density in [200, 250, 300, 350, 400]]
+
+    res_serial = m.run(sensor, snowpacks)
+    res_parallel = m.run(sensor, snowpacks, parallel=2, chunksize=2)
+
+    np.testing.assert_allclose(res_parallel.TbV(), res_serial.TbV())
+    np.testing.assert_allclose(res_parallel.TbH(), res_serial.TbH())
@@ -0,0 +1,44 @@
+# coding: utf-8
+
+"""Evaluate the effect of merging the similar adjacent layers of a snowpack (see :py:meth:`~smrt.core.snowpack.Snowpack.merge_layers`)
+on the simulations. Detailed profiles (e.g. from snow evolution models) often contain many layers with almost identical properties.
+Merging them reduces the computation time, at the cost of a bias that can be evaluated with :py:func:`merging_bias` on
+representative snowpacks before running large simulations.
+
+Example::
+
+    from smrt.utils.layer_merging import merging_bias
+
+    m = make_model("iba", "dort")
+    merged_snowpack, bias = merging_bias(m, sensor, snowpack, frac_volume_tolerance=0.02, temperature_tolerance=1)
+    print(bias.attrs['nlayer'], "->", bias.attrs['nlayer_merged'], "layers, maximum bias:", float(abs(bias).max()))
+
+"""
+
+
+def merging_bias(model, sensor, snowpack, atmosphere=None, **tolerances):
+    """merge the similar adjacent layers of the snowpack and return the bias of the simulation with respect to the original
+    snowpack.
+
+    :param model: :py:class:`~smrt.core.model.Model` instance used for the simulations
+    :param sensor: sensor configuration
+    :param snowpack: snowpack to merge
+    :param atmosphere: atmosphere (optional)
+    :param tolerances: tolerances given to :py:meth:`~smrt.core.snowpack.Snowpack.merge_layers`
+
+    :returns: the merged snowpack and the bias (merged minus original) of the `data` of the results as a DataArray, that is the
+        brightness temperature in passive mode and the backscattered intensity in active mode (the conversion to backscattering
+        coefficient is done by :py:meth:`~smrt.core.result.Result.sigmaVV` and similar methods). The number of layers before and
+        after the merging are in the `nlayer` and `nlayer_merged` attributes of the DataArray.
+"""
+
+    merged_snowpack = snowpack.merge_layers(**tolerances)
+
+    reference = model.run(sensor, snowpack, atmosphere=atmosphere)
+    merged = model.run(sensor, merged_snowpack, atmosphere=atmosphere)
+
+    bias = merged.data - reference.data
+    bias.attrs['nlayer'] = snowpack.nlayer
+    bias.attrs['nlayer_merged'] = merged_snowpack.nlayer
+
+    return merged_snowpack, bias